@@ -0,0 +1,289 @@
+"""Turns a domain's configuration (ex: domain-info.yaml) into a DomainPlan.
+
+A DomainPlan is everything provision-domain.py will ask CloudSearch for: the
+analysis schemes and the index fields, with the locale_specific fields
+already expanded into one field per locale and every field's traits already
+checked against its type. It is built once, is immutable, and is what gets
+printed in a dry run, compared against the domain's current configuration
+and finally executed.
+"""
+
+import collections
+import hashlib
+import json
+import re
+
+import stopwords
+
+# Most of the fields have the same available traits so we're going to group
+# the fields into a few categories. Each category will be called a stem.
+# The available traits are listed at
+# http://docs.aws.amazon.com/cloudsearch/latest/developerguide/configuring-index-fields.html
+# They can be verified by playing with the AWS console,
+# selecting each field type and seeing which fields are enabled.
+STEM_TO_FIELD = {
+    "plain": {"int", "double", "literal", "date", "latlong"},
+    "plain-array": {"int-array", "double-array", "literal-array",
+        "date-array"},
+    "text": {"text"},
+    "text-array": {"text-array"}
+}
+
+# This gives the available traits for each stem
+STEM_FIELD_AVAILABLE_TRAITS = {
+    "plain": {"search", "facet", "return", "sort"},
+    "plain-array": {"search", "facet", "return"},
+    "text": {"search", "return", "sort", "highlight"},
+    "text-array": {"search", "return", "highlight"}
+}
+
+# The reverse of STEM_TO_FIELD: maps each field type to its stem.
+FIELD_TYPE_TO_STEM = dict((field_type, stem)
+    for stem, field_types in STEM_TO_FIELD.iteritems()
+    for field_type in field_types)
+
+# Maps each field type to the traits that can be enabled for it.
+FIELD_TYPE_TO_TRAITS = dict(
+    (field_type, frozenset(STEM_FIELD_AVAILABLE_TRAITS[stem]))
+    for field_type, stem in FIELD_TYPE_TO_STEM.iteritems())
+
+# The keys (from describe-index-fields) under which CloudSearch stores the
+# options of each field type.
+FIELD_TYPE_TO_OPTIONS_KEY = {
+    "int": "IntOptions",
+    "double": "DoubleOptions",
+    "literal": "LiteralOptions",
+    "text": "TextOptions",
+    "date": "DateOptions",
+    "latlong": "LatLonOptions",
+    "int-array": "IntArrayOptions",
+    "double-array": "DoubleArrayOptions",
+    "literal-array": "LiteralArrayOptions",
+    "text-array": "TextArrayOptions",
+    "date-array": "DateArrayOptions",
+}
+
+# The analysis scheme that expands a field into one field per locale.
+LOCALE_SPECIFIC = "locale_specific"
+
+
+class PlanError(ValueError):
+    """Raised when a domain's configuration is invalid."""
+    pass
+
+
+class FieldError(ValueError):
+    """Raised when a document's fields don't match a DomainPlan."""
+    pass
+
+
+class FieldSpec(collections.namedtuple("FieldSpec",
+        ["name", "type", "traits", "analysis_scheme", "source"])):
+    """An index field to define.
+
+    traits is the frozenset of traits to enable (the others available for
+    type are disabled), and analysis_scheme may be None. source is the name
+    of the field in the configuration this came from, which is different
+    from name for locale_specific fields (ex: "title" for "title_en").
+    """
+    __slots__ = ()
+
+    def define_arguments(self):
+        """Returns the arguments to pass to define-index-field to define this
+        field, with the exception of --domain-name.
+
+            >>> spec = FieldSpec("kind", "literal", frozenset(["return"]),
+            ...     None, "kind")
+            >>> spec.define_arguments()  # doctest: +NORMALIZE_WHITESPACE
+            ['--type', 'literal', '--facet-enabled', 'false',
+             '--search-enabled', 'false', '--sort-enabled', 'false',
+             '--name', 'kind']
+        """
+        # The configure tool enables all available traits by default, so
+        # we disable the ones we don't want.
+        arguments = ["--type", self.type]
+        for trait in sorted(FIELD_TYPE_TO_TRAITS[self.type] - self.traits):
+            arguments += ["--{}-enabled".format(trait), "false"]
+
+        if self.analysis_scheme:
+            arguments += ["--analysis-scheme", self.analysis_scheme]
+
+        arguments += ["--name", self.name]
+        return arguments
+
+    def expected_options(self):
+        """Returns the options we expect describe-index-fields to report.
+
+            >>> options = FieldSpec("kind", "literal", frozenset(["return"]),
+            ...     None, "kind").expected_options()
+            >>> sorted(options.items())  # doctest: +NORMALIZE_WHITESPACE
+            [('FacetEnabled', False), ('ReturnEnabled', True),
+             ('SearchEnabled', False), ('SortEnabled', False)]
+        """
+        options = dict(("{}Enabled".format(trait.capitalize()),
+            trait in self.traits) for trait in FIELD_TYPE_TO_TRAITS[self.type])
+        if self.analysis_scheme:
+            options["AnalysisScheme"] = self.analysis_scheme
+
+        return options
+
+
+# An analysis scheme to define. argument is what to pass to
+# define-analysis-scheme's --analysis-scheme: the scheme as JSON, with any
+# stop words dictionary loaded into it.
+SchemeSpec = collections.namedtuple("SchemeSpec", ["name", "argument"])
+
+
+class DomainPlan(collections.namedtuple("DomainPlan",
+        ["schemes", "fields"])):
+    """Everything to configure on a domain, as tuples of SchemeSpecs and
+    FieldSpecs. The schemes must be defined first since fields can't
+    reference schemes that don't exist yet.
+    """
+    __slots__ = ()
+
+    def to_json(self):
+        """Returns the plan as something json.dumps can serialize."""
+        return {
+            "schemes": [dict(scheme._asdict()) for scheme in self.schemes],
+            "fields": [dict(field._asdict(), traits=sorted(field.traits))
+                for field in self.fields],
+        }
+
+    def digest(self):
+        """Returns a hash of the plan: two plans with the same digest will
+        configure a domain the same way."""
+        return hashlib.sha1(json.dumps(self.to_json(),
+            sort_keys=True)).hexdigest()
+
+
+def normalize_locale(locale):
+    """Normalizes a locale the way the configuration's locales are named:
+    lowercased, with anything that isn't a letter or digit turned into an
+    underscore.
+
+        >>> normalize_locale("pt-BR")
+        'pt_br'
+    """
+    return re.sub(r"[^a-z0-9]", "_", locale.lower())
+
+
+class LocaleFields(object):
+    """Renames the locale_specific fields of documents for their locale, the
+    same way the DomainPlan names them (ex: "title" becomes "title_fr")."""
+
+    def __init__(self, plan):
+        self.fields = dict((field.name, field) for field in plan.fields)
+        self.sources = frozenset(field.source for field in plan.fields
+            if field.name != field.source)
+
+    def expand(self, fields, locale):
+        """Returns fields (a dict of a document's fields) with the locale
+        specific ones renamed for locale.
+
+        Raises FieldError if a field isn't in the plan, or if a locale
+        specific field is given without a locale the plan has.
+        """
+        expanded = {}
+        for name, value in fields.iteritems():
+            if name in self.sources:
+                if not locale:
+                    raise FieldError("Field {!r} is locale specific but the "
+                        "document has no locale.".format(name))
+                name = "{}_{}".format(name, normalize_locale(locale))
+                if name not in self.fields:
+                    raise FieldError("Locale {!r} isn't in the "
+                        "configuration.".format(locale))
+
+            if name not in self.fields:
+                raise FieldError("Unknown field {!r}.".format(name))
+
+            expanded[name] = value
+
+        return expanded
+
+
+def make_scheme_arg(scheme):
+    """Returns the --analysis-scheme argument of define-analysis-scheme for a
+    scheme from the configuration, loading its stop words dictionary (a path
+    relative to the current directory) if it has one."""
+    if 'Stopwords' in scheme['AnalysisOptions']:
+        scheme = dict(scheme)
+        scheme['AnalysisOptions'] = dict(scheme['AnalysisOptions'])
+        stopwords_file = scheme['AnalysisOptions']['Stopwords']
+        stopwords_list = stopwords.load(stopwords_file)
+        scheme['AnalysisOptions']['Stopwords'] = json.dumps(stopwords_list)
+
+    return json.dumps(scheme)
+
+
+def _build_schemes(config):
+    schemes = []
+    for scheme in config.get("analysis_schemes") or []:
+        if "AnalysisSchemeName" not in scheme:
+            raise PlanError("Analysis scheme {!r} has no "
+                "AnalysisSchemeName.".format(scheme))
+
+        try:
+            argument = make_scheme_arg(scheme)
+        except IOError as e:
+            raise PlanError("Could not load the stop words of analysis "
+                "scheme {!r}: {}".format(scheme["AnalysisSchemeName"], e))
+
+        schemes.append(SchemeSpec(scheme["AnalysisSchemeName"], argument))
+
+    return tuple(schemes)
+
+
+def _build_fields(config):
+    locales = sorted((config.get("locales") or {}).iteritems())
+
+    fields = []
+    for field in config.get("fields") or []:
+        name = field.get("name")
+        field_type = field.get("type")
+        if not name or not field_type:
+            raise PlanError("Field {!r} needs a name and a type.".format(
+                field))
+
+        available_traits = FIELD_TYPE_TO_TRAITS.get(field_type)
+        if available_traits is None:
+            raise PlanError("Unknown field type {!r} for field {!r}.".format(
+                field_type, name))
+
+        traits = frozenset(field.get("traits") or [])
+        if not traits <= available_traits:
+            raise PlanError("Traits {!r} not available for {!r} fields "
+                "(field {!r}).".format(sorted(traits - available_traits),
+                    field_type, name))
+
+        analysis_scheme = field.get("analysis_scheme")
+        if analysis_scheme == LOCALE_SPECIFIC:
+            fields.extend(FieldSpec("{}_{}".format(name, locale), field_type,
+                    traits, scheme, name)
+                for locale, scheme in locales)
+        else:
+            fields.append(FieldSpec(name, field_type, traits,
+                analysis_scheme, name))
+
+    return tuple(fields)
+
+
+def build_plan(config):
+    """Builds the DomainPlan for config, the parsed domain configuration.
+
+    Stop words dictionaries are loaded relative to the current directory.
+    Raises PlanError if the configuration is invalid.
+    """
+    plan = DomainPlan(_build_schemes(config), _build_fields(config))
+
+    for kind, specs in (("analysis scheme", plan.schemes),
+            ("field", plan.fields)):
+        seen = set()
+        for spec in specs:
+            if spec.name in seen:
+                raise PlanError("More than one {} is named {!r}.".format(
+                    kind, spec.name))
+            seen.add(spec.name)
+
+    return plan
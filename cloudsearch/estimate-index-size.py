@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+
+"""Estimates how large a domain's index will be, before reindexing it.
+
+Adding a field or a locale to domain-info.yaml can make CloudSearch move the
+domain to a larger instance type or more partitions, which we otherwise only
+find out after a reindex of several hours. This reads the configuration the
+same way provision-domain.py does (expanding the locale_specific fields into
+one field per locale), runs a sample of documents through it and projects
+the size of every field's share of the index, and the total, for the whole
+corpus.
+
+The sample is JSON lines in the format upload-documents.py reads. The
+projection scales it up to --documents documents, so the sample should have
+the same mix of kinds and locales as the corpus (ex: every 20th document).
+
+CloudSearch doesn't say how it lays out its index, so the sizes come from a
+rough model of a Lucene index, which only applies the traits each field has
+enabled:
+
+- search: for text fields, a posting for every word that isn't a stop word
+  of the field's analysis scheme, plus the dictionary of distinct words.
+  For other fields, a posting for every value, plus the dictionary of
+  distinct values.
+- facet: an ordinal for every value, plus the dictionary of distinct values.
+- return and highlight: the value itself is stored (once, even with both).
+  highlight also stores the offsets of every word.
+- sort: the value is stored a second time, in a sortable form.
+
+The dictionaries are scaled up with the documents, which overestimates them
+since the vocabulary grows more slowly than the corpus. Compare the
+projection for the current configuration with the domain's actual size to
+see how far off the model is before trusting it for a new one.
+
+Finally, it picks the instance type and partition count CloudSearch would
+likely scale to (it moves to larger instance types before adding
+partitions), and if given prices for the instance types, what that costs.
+
+Example use:
+
+    $ ./estimate-index-size.py --documents 250000 sample.jsonl
+    $ ./estimate-index-size.py --documents 250000 \
+        --price search.m3.large=0.37 --config new.yaml sample.jsonl
+"""
+
+import collections
+import json
+import logging
+import math
+import optparse
+import os
+import re
+import sys
+import textwrap
+
+import domain_plan
+import stopwords
+
+# The rough size, in bytes, of each part of the index in our model.
+POSTING_BYTES = 4           # A word or value's entry for a document.
+ORDINAL_BYTES = 4           # A faceted value's entry for a document.
+OFFSET_BYTES = 8            # Where a word is, to highlight it.
+NUMBER_BYTES = 8            # An int, double or date, stored or sorted.
+NUMBER_SEARCH_BYTES = 16    # An int, double or date, searchable by range.
+LATLONG_BYTES = 16
+DOCUMENT_BYTES = 64         # Every document's id and bookkeeping.
+
+# The field types that hold numbers (dates are stored as numbers).
+NUMBER_TYPES = {"int", "double", "date", "int-array", "double-array",
+    "date-array"}
+TEXT_TYPES = {"text", "text-array"}
+
+# About how much index each instance type can hold, in GB, smallest first,
+# per http://docs.aws.amazon.com/cloudsearch/latest/developerguide/what-is-cloudsearch.html
+INSTANCE_TYPES = [
+    ("search.m1.small", 1),
+    ("search.m3.medium", 2),
+    ("search.m1.large", 4),
+    ("search.m3.large", 8),
+    ("search.m3.xlarge", 16),
+    ("search.m3.2xlarge", 32),
+]
+
+HOURS_PER_MONTH = 730
+
+# What CloudSearch counts as a word.
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def parse_arguments(raw_args=sys.argv[1:]):
+    """Parses any command line arguments."""
+    parser = optparse.OptionParser(
+        usage="usage: %prog [OPTIONS] SAMPLE",
+        description="Projects the size of a CloudSearch domain's index from "
+            "its configuration and a sample of its documents (JSON lines, "
+            "or - for stdin).")
+
+    parser.add_option("-v", "--verbose", action="store_true", default=False,
+        help="If specified, DEBUG messages will be printed.")
+
+    default_config = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "domain-info.yaml")
+    parser.add_option("--config", default=default_config,
+        help="The domain configuration. Defaults to %default.")
+
+    parser.add_option("-d", "--documents", type="int",
+        help="How many documents the whole corpus has. Defaults to the "
+            "number of documents in the sample.")
+
+    parser.add_option("--headroom", type="float", default=0.8,
+        help="The fraction of an instance's capacity the index may use "
+            "before we count on CloudSearch scaling up. Defaults to "
+            "%default.")
+
+    parser.add_option("--replicas", type="int", default=1,
+        help="The replication count of the domain. Defaults to %default.")
+
+    parser.add_option("--price", action="append", default=[],
+        metavar="TYPE=DOLLARS",
+        help="The hourly price of an instance type (ex: "
+            "search.m3.large=0.37), to estimate the monthly cost. Can be "
+            "given more than once.")
+
+    options, args = parser.parse_args(raw_args)
+
+    if len(args) != 1:
+        parser.error("You must specify exactly one sample of documents.")
+
+    if options.documents is not None and options.documents < 1:
+        parser.error("--documents must be at least 1.")
+
+    if not 0 < options.headroom <= 1:
+        parser.error("--headroom must be between 0 and 1.")
+
+    if options.replicas < 1:
+        parser.error("--replicas must be at least 1.")
+
+    instance_types = set(name for name, _ in INSTANCE_TYPES)
+    prices = {}
+    for price in options.price:
+        instance_type, _, dollars = price.partition("=")
+        if instance_type not in instance_types:
+            parser.error("Unknown instance type {!r}.".format(instance_type))
+        try:
+            prices[instance_type] = float(dollars)
+        except ValueError:
+            parser.error("Invalid price {!r}.".format(price))
+    options.price = prices
+
+    return (options, args[0])
+
+
+def scheme_stopwords(plan):
+    """Returns the stop words (a frozenset) of each analysis scheme of plan
+    that has any, by name."""
+    result = {}
+    for scheme in plan.schemes:
+        options = json.loads(scheme.argument)["AnalysisOptions"]
+        if "Stopwords" in options:
+            result[scheme.name] = frozenset(word.lower()
+                for word in json.loads(options["Stopwords"]))
+
+    return result
+
+
+def _as_text(value):
+    if isinstance(value, unicode):
+        return value
+    elif isinstance(value, str):
+        return value.decode("utf-8", "replace")
+    return unicode(json.dumps(value))
+
+
+class FieldSize(object):
+    """What the documents of a sample put in one field's part of the index.
+
+    Sizes that grow with every document are in `bytes`, by trait, and the
+    dictionaries of distinct words or values (which are only counted once)
+    are in `terms`, by trait.
+    """
+
+    def __init__(self, field, stop_words):
+        self.field = field
+        self.stop_words = stop_words or frozenset()
+        self.documents = 0
+        self.bytes = collections.Counter()
+        self.terms = collections.defaultdict(set)
+
+    def add(self, value):
+        """Adds the value a document has for the field."""
+        self.documents += 1
+        values = value if isinstance(value, list) else [value]
+        field_type = self.field.type
+        traits = self.field.traits
+
+        if field_type in TEXT_TYPES:
+            for text in values:
+                text = _as_text(text)
+                raw = len(text.encode("utf-8"))
+                words = WORD_RE.findall(text.lower())
+                if "search" in traits:
+                    kept = [word for word in words
+                        if word not in self.stop_words]
+                    self.bytes["search"] += len(kept) * POSTING_BYTES
+                    self.terms["search"].update(kept)
+                if traits & {"return", "highlight"}:
+                    self.bytes["return" if "return" in traits else
+                        "highlight"] += raw
+                if "highlight" in traits:
+                    self.bytes["highlight"] += len(words) * OFFSET_BYTES
+                if "sort" in traits:
+                    self.bytes["sort"] += raw
+        elif field_type in NUMBER_TYPES or field_type == "latlong":
+            size = LATLONG_BYTES if field_type == "latlong" else NUMBER_BYTES
+            if "search" in traits:
+                self.bytes["search"] += len(values) * NUMBER_SEARCH_BYTES
+            for trait in traits & {"facet", "return", "sort"}:
+                self.bytes[trait] += len(values) * size
+        else:
+            for value in values:
+                text = _as_text(value)
+                raw = len(text.encode("utf-8"))
+                if "search" in traits:
+                    self.bytes["search"] += POSTING_BYTES
+                    self.terms["search"].add(text)
+                if "facet" in traits:
+                    self.bytes["facet"] += ORDINAL_BYTES
+                    self.terms["facet"].add(text)
+                for trait in traits & {"return", "sort"}:
+                    self.bytes[trait] += raw
+
+    def projected(self, scale):
+        """Returns the projected bytes of each trait (a Counter), with the
+        sample scaled up scale times."""
+        projected = collections.Counter()
+        for trait, size in self.bytes.iteritems():
+            projected[trait] += size * scale
+        for trait, terms in self.terms.iteritems():
+            projected[trait] += scale * sum(
+                len(term.encode("utf-8")) for term in terms)
+        return projected
+
+
+def measure_sample(lines, plan):
+    """Runs the documents in lines (JSON strings) through plan.
+
+    Returns a tuple (documents, sizes) with the number of documents added by
+    the sample and the FieldSize of every field of the plan, by name.
+    """
+    locale_fields = domain_plan.LocaleFields(plan)
+    stop_words = scheme_stopwords(plan)
+    sizes = collections.OrderedDict((field.name,
+        FieldSize(field, stop_words.get(field.analysis_scheme)))
+        for field in plan.fields)
+
+    documents = 0
+    skipped = 0
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+
+        try:
+            document = json.loads(line)
+            if document.get("type", "add") != "add":
+                continue
+            fields = locale_fields.expand(document.get("fields") or {},
+                document.get("locale"))
+        except (ValueError, AttributeError) as e:
+            logging.debug("Skipping line %d: %s", line_number, e)
+            skipped += 1
+            continue
+
+        documents += 1
+        for name, value in fields.iteritems():
+            if value is not None:
+                sizes[name].add(value)
+
+    if skipped:
+        logging.warning("Skipped %d invalid documents of the sample.",
+            skipped)
+
+    return (documents, sizes)
+
+
+def choose_instances(index_bytes, headroom):
+    """Returns a tuple (instance type, partitions) CloudSearch would likely
+    use for an index of index_bytes, each instance using at most headroom
+    of its capacity."""
+    for instance_type, capacity in INSTANCE_TYPES:
+        if index_bytes <= capacity * headroom * 1024 ** 3:
+            return (instance_type, 1)
+
+    instance_type, capacity = INSTANCE_TYPES[-1]
+    return (instance_type, int(math.ceil(
+        index_bytes / (capacity * headroom * 1024 ** 3))))
+
+
+def _format_size(size):
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return "{:.1f} {}".format(size, unit)
+        size /= 1024.0
+    return "{:.2f} GB".format(size)
+
+
+def report(sample_documents, sizes, options):
+    """Prints the projection."""
+    total_documents = options.documents or sample_documents
+    scale = float(total_documents) / sample_documents
+
+    rows = []
+    by_trait = collections.Counter()
+    for name, size in sizes.iteritems():
+        projected = size.projected(scale)
+        by_trait.update(projected)
+        rows.append((sum(projected.values()), name, size))
+
+    document_bytes = DOCUMENT_BYTES * total_documents
+    total = sum(by_trait.values()) + document_bytes
+
+    print "Projected index of {:,} documents (from a sample of {:,}):".format(
+        total_documents, sample_documents)
+    print
+    print "  {:<28} {:<14} {:>7} {:>10} {:>10}".format("field", "type",
+        "in docs", "per doc", "projected")
+    for projected, name, size in sorted(rows, reverse=True):
+        if not size.documents:
+            continue
+        print "  {:<28} {:<14} {:>6.1f}% {:>10} {:>10}".format(name,
+            size.field.type, 100.0 * size.documents / sample_documents,
+            _format_size(projected / total_documents),
+            _format_size(projected))
+
+    unused = [name for _, name, size in rows if not size.documents]
+    if unused:
+        print
+        print textwrap.fill("Not in the sample: {}".format(
+            ", ".join(unused)), initial_indent="  ", subsequent_indent="    ")
+
+    print
+    for trait, size in sorted(by_trait.iteritems(), key=lambda item:
+            -item[1]):
+        print "  {:<10} {:>10}".format(trait, _format_size(size))
+    print "  {:<10} {:>10}".format("documents", _format_size(document_bytes))
+    print "  {:<10} {:>10}".format("total", _format_size(total))
+
+    instance_type, partitions = choose_instances(total, options.headroom)
+    instances = partitions * options.replicas
+    print
+    print "Likely {} partition(s) of {}, {} instance(s) with {} " \
+        "replica(s).".format(partitions, instance_type, instances,
+            options.replicas)
+
+    if options.price:
+        print
+        if instance_type in options.price:
+            print "About ${:,.0f} a month ({} x ${}/hour).".format(
+                instances * options.price[instance_type] * HOURS_PER_MONTH,
+                instances, options.price[instance_type])
+        else:
+            print "No --price given for {}.".format(instance_type)
+
+
+def main(options, sample_path):
+    try:
+        with open(options.config) as f:
+            config = stopwords.yaml_load(f)
+    except IOError:
+        logging.exception("Could not read from file %r.", options.config)
+        sys.exit(1)
+
+    sample_path = sample_path if sample_path == "-" else os.path.abspath(
+        sample_path)
+
+    # Stop words dictionaries are relative to the configuration file.
+    os.chdir(os.path.dirname(os.path.abspath(options.config)))
+    try:
+        plan = domain_plan.build_plan(config)
+    except domain_plan.PlanError as e:
+        logging.error("Invalid configuration in %r: %s", options.config, e)
+        sys.exit(1)
+
+    try:
+        if sample_path == "-":
+            sample_documents, sizes = measure_sample(sys.stdin, plan)
+        else:
+            with open(sample_path) as f:
+                sample_documents, sizes = measure_sample(f, plan)
+    except IOError:
+        logging.exception("Could not read from file %r.", sample_path)
+        sys.exit(1)
+
+    if not sample_documents:
+        logging.error("The sample has no documents.")
+        sys.exit(1)
+
+    report(sample_documents, sizes, options)
+
+
+if __name__ == "__main__":
+    options, sample_path = parse_arguments()
+
+    logging.basicConfig(level=logging.DEBUG if options.verbose else
+        logging.INFO, format="%(levelname)s - %(message)s")
+
+    main(options, sample_path)
@@ -0,0 +1,619 @@
+#!/usr/bin/env python
+
+"""A local stand-in for the CloudSearch configuration API, for testing.
+
+This fakes just enough of CloudSearch to run provision-domain.py against it
+without talking to AWS: define-index-field, define-analysis-scheme,
+describe-index-fields, describe-analysis-schemes, describe-domains and
+index-documents. Domains are created the first time they are used.
+
+Fields and analysis schemes go through the same states they do in
+CloudSearch: defining one makes it RequiresIndexDocuments, index-documents
+makes those Processing (or FailedToValidate, for fields whose analysis scheme
+doesn't exist), and they become Active --processing-seconds later.
+
+Every request can be slowed down (--latency) and a fraction of them can fail
+with a Throttling error (--throttle-rate), to see how provision-domain.py
+copes.
+
+It can be used in two ways:
+
+As the aws command line tool: symlink this file as `aws` in a directory and
+put that directory first in your $PATH. Since every command is a new
+process, the state is kept in a file (and the options are given as
+environment variables):
+
+    $ mkdir /tmp/fake-aws && ln -s $PWD/fake_cloudsearch.py /tmp/fake-aws/aws
+    $ export FAKE_CLOUDSEARCH_STATE=/tmp/fake-cloudsearch.json
+    $ export FAKE_CLOUDSEARCH_LATENCY=0.2 FAKE_CLOUDSEARCH_THROTTLE_RATE=0.1
+    $ PATH=/tmp/fake-aws:$PATH ./provision-domain.py --wait test domain-info.yaml
+
+Like the real tool, it prints text rather than JSON when
+AWS_DEFAULT_OUTPUT=text is set and the command has no --output.
+
+As an HTTP endpoint, speaking the same query protocol as the real thing, for
+the sdk backend (or the real aws tool):
+
+    $ ./fake_cloudsearch.py --port 8001 --latency 0.2 --throttle-rate 0.1 &
+    $ AWS_ACCESS_KEY_ID=x AWS_SECRET_ACCESS_KEY=x AWS_DEFAULT_REGION=us-east-1 \\
+        ./provision-domain.py --backend sdk \\
+        --endpoint-url http://localhost:8001 --wait test domain-info.yaml
+
+Timing provision-domain.py against it with various --jobs, latencies and
+throttle rates shows its throughput and how it behaves under throttling.
+
+The HTTP endpoint also takes batches of documents, like a domain's document
+endpoint does, for upload-documents.py (throttled with HTTP 429):
+
+    $ ./upload-documents.py http://localhost:8001 < documents.jsonl
+"""
+
+import BaseHTTPServer
+import SocketServer
+import contextlib
+import datetime
+import fcntl
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+import uuid
+from xml.sax import saxutils
+
+import domain_plan
+
+# The operations we fake.
+OPERATIONS = frozenset([
+    "DefineIndexField",
+    "DefineAnalysisScheme",
+    "DescribeIndexFields",
+    "DescribeAnalysisSchemes",
+    "DescribeDomains",
+    "IndexDocuments",
+])
+
+XML_NAMESPACE = "http://cloudsearch.amazonaws.com/doc/2013-01-01/"
+
+# Where the document service takes batches of documents, and how large they
+# can be.
+DOCUMENTS_BATCH_PATH = "/2013-01-01/documents/batch"
+MAX_BATCH_BYTES = 5 * 1024 * 1024
+
+
+class FakeError(Exception):
+    """An error to return to the client, like CloudSearch would."""
+    def __init__(self, code, message, status=400):
+        super(FakeError, self).__init__(message)
+        self.code = code
+        self.status = status
+
+
+def _now():
+    return datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _new_status(old_status=None):
+    now = _now()
+    return {
+        "CreationDate": old_status["CreationDate"] if old_status else now,
+        "UpdateDate": now,
+        "UpdateVersion": old_status["UpdateVersion"] + 1 if old_status else 1,
+        "State": "RequiresIndexDocuments",
+        "PendingDeletion": False,
+    }
+
+
+class FakeCloudSearch(object):
+    """The fake CloudSearch itself.
+
+    Its methods take the parameters of the API call of the same name (ex:
+    define_index_field takes DomainName and IndexField) and return its
+    response, or raise FakeError.
+
+    If state_path is given the state is kept in that file (locked while it's
+    used, so many processes can share it), otherwise it's kept in memory.
+    """
+    def __init__(self, state_path=None, latency=0, throttle_rate=0,
+            processing_seconds=5):
+        self.state_path = state_path
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.processing_seconds = processing_seconds
+        self._state = {"domains": {}}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _locked_state(self):
+        """Yields the state, saving it afterwards."""
+        with self._lock:
+            if not self.state_path:
+                yield self._state
+                return
+
+            with open(self.state_path + ".lock", "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    with open(self.state_path) as f:
+                        state = json.load(f)
+                except (IOError, ValueError):
+                    state = {"domains": {}}
+
+                yield state
+
+                fd, temp_path = tempfile.mkstemp(
+                    dir=os.path.dirname(os.path.abspath(self.state_path)))
+                with os.fdopen(fd, "w") as f:
+                    json.dump(state, f)
+                os.rename(temp_path, self.state_path)
+
+    def _domain(self, state, name):
+        """Returns the domain called name, creating it if needed."""
+        if not name:
+            raise FakeError("ValidationException", "DomainName is required.")
+
+        domain = state["domains"].setdefault(name, {
+            "fields": {},
+            "schemes": {},
+            "index_started": None,
+        })
+
+        # Move along whatever has been processing for long enough.
+        if (domain["index_started"] is not None and time.time() -
+                domain["index_started"] >= self.processing_seconds):
+            for entry in domain["fields"].values() + domain["schemes"].values():
+                if entry["Status"]["State"] == "Processing":
+                    entry["Status"]["State"] = "Active"
+            domain["index_started"] = None
+
+        return domain
+
+    def _simulate_load(self, throttle_status=400):
+        """Sleeps for about the latency, and maybe raises a Throttling
+        error (with throttle_status as its HTTP status)."""
+        if self.latency:
+            time.sleep(self.latency * random.uniform(0.5, 1.5))
+
+        if random.random() < self.throttle_rate:
+            raise FakeError("Throttling", "Rate exceeded",
+                status=throttle_status)
+
+    def call(self, operation, params):
+        """Calls operation (ex: "DefineIndexField") with params."""
+        self._simulate_load()
+
+        if operation not in OPERATIONS:
+            raise FakeError("InvalidAction",
+                "Unsupported operation {}.".format(operation))
+
+        method = getattr(self, _to_snake_case(operation))
+        with self._locked_state() as state:
+            try:
+                return method(state, **params)
+            except TypeError as e:
+                raise FakeError("ValidationException", str(e))
+
+    def define_index_field(self, state, DomainName=None, IndexField=None):
+        domain = self._domain(state, DomainName)
+        options = dict(IndexField or {})
+        name = options.get("IndexFieldName")
+        field_type = options.get("IndexFieldType")
+        if not name or field_type not in domain_plan.FIELD_TYPE_TO_OPTIONS_KEY:
+            raise FakeError("InvalidType",
+                "Invalid IndexField {!r}.".format(options))
+
+        old = domain["fields"].get(name)
+        entry = {
+            "Options": options,
+            "Status": _new_status(old and old["Status"]),
+        }
+        domain["fields"][name] = entry
+        return {"IndexField": entry}
+
+    def define_analysis_scheme(self, state, DomainName=None,
+            AnalysisScheme=None):
+        domain = self._domain(state, DomainName)
+        options = dict(AnalysisScheme or {})
+        name = options.get("AnalysisSchemeName")
+        if not name or not options.get("AnalysisSchemeLanguage"):
+            raise FakeError("ValidationException",
+                "Invalid AnalysisScheme {!r}.".format(options))
+
+        old = domain["schemes"].get(name)
+        entry = {
+            "Options": options,
+            "Status": _new_status(old and old["Status"]),
+        }
+        domain["schemes"][name] = entry
+        return {"AnalysisScheme": entry}
+
+    def describe_index_fields(self, state, DomainName=None, FieldNames=None,
+            Deployed=None):
+        domain = self._domain(state, DomainName)
+        return {"IndexFields": [entry for name, entry
+            in sorted(domain["fields"].iteritems())
+            if not FieldNames or name in FieldNames]}
+
+    def describe_analysis_schemes(self, state, DomainName=None,
+            AnalysisSchemeNames=None, Deployed=None):
+        domain = self._domain(state, DomainName)
+        return {"AnalysisSchemes": [entry for name, entry
+            in sorted(domain["schemes"].iteritems())
+            if not AnalysisSchemeNames or name in AnalysisSchemeNames]}
+
+    def describe_domains(self, state, DomainNames=None):
+        statuses = []
+        for name in DomainNames or sorted(state["domains"]):
+            domain = self._domain(state, name)
+            states = set(entry["Status"]["State"] for entry
+                in domain["fields"].values() + domain["schemes"].values())
+            statuses.append({
+                "DomainId": "123456789012/{}".format(name),
+                "DomainName": name,
+                "Created": True,
+                "Deleted": False,
+                "Processing": "Processing" in states,
+                "RequiresIndexDocuments": "RequiresIndexDocuments" in states,
+            })
+        return {"DomainStatusList": statuses}
+
+    def index_documents(self, state, DomainName=None):
+        domain = self._domain(state, DomainName)
+        for entry in domain["schemes"].values():
+            if entry["Status"]["State"] == "RequiresIndexDocuments":
+                entry["Status"]["State"] = "Processing"
+
+        for entry in domain["fields"].values():
+            if entry["Status"]["State"] == "RequiresIndexDocuments":
+                options_key = domain_plan.FIELD_TYPE_TO_OPTIONS_KEY[
+                    entry["Options"]["IndexFieldType"]]
+                type_options = entry["Options"].get(options_key, {})
+                scheme = type_options.get("AnalysisScheme")
+                # Like CloudSearch, we only notice a missing scheme now.
+                if (scheme and not scheme.startswith("_") and
+                        scheme not in domain["schemes"]):
+                    entry["Status"]["State"] = "FailedToValidate"
+                else:
+                    entry["Status"]["State"] = "Processing"
+
+        domain["index_started"] = time.time()
+        return {"FieldNames": sorted(domain["fields"])}
+
+    def upload_documents(self, body):
+        """Applies a batch of documents (the JSON body posted to a domain's
+        document endpoint) and returns the response.
+
+        The documents aren't searchable: we only remember a hash of each one
+        that was added, so tests can check what was uploaded.
+        """
+        # The document service throttles with HTTP 429 rather than 400.
+        self._simulate_load(throttle_status=429)
+
+        if len(body) > MAX_BATCH_BYTES:
+            raise FakeError("RequestEntityTooLarge",
+                "Request size exceeded {} bytes".format(MAX_BATCH_BYTES),
+                status=413)
+
+        try:
+            operations = json.loads(body)
+        except ValueError as e:
+            raise FakeError("ValidationException",
+                "Invalid JSON: {}".format(e))
+
+        if not isinstance(operations, list):
+            raise FakeError("ValidationException",
+                "The batch must be a JSON array.")
+
+        for operation in operations:
+            if (not isinstance(operation, dict) or not operation.get("id") or
+                    operation.get("type") not in ("add", "delete") or
+                    (operation["type"] == "add" and
+                        not isinstance(operation.get("fields"), dict))):
+                raise FakeError("ValidationException",
+                    "Invalid document {!r}.".format(operation)[:200])
+
+        with self._locked_state() as state:
+            documents = state.setdefault("documents", {})
+            for operation in operations:
+                if operation["type"] == "add":
+                    documents[operation["id"]] = hashlib.sha1(json.dumps(
+                        operation["fields"], sort_keys=True)).hexdigest()
+                else:
+                    documents.pop(operation["id"], None)
+
+        return {
+            "status": "success",
+            "adds": sum(1 for operation in operations
+                if operation["type"] == "add"),
+            "deletes": sum(1 for operation in operations
+                if operation["type"] == "delete"),
+        }
+
+
+def _to_snake_case(name):
+    """Turns "DefineIndexField" into "define_index_field"."""
+    return "".join("_" + c.lower() if c.isupper() else c
+        for c in name).lstrip("_")
+
+
+def _to_camel_case(name):
+    """Turns "define-index-field" or "facet" into "DefineIndexField" or
+    "Facet"."""
+    return "".join(word.capitalize() for word in name.split("-"))
+
+
+# The aws command line tool
+# -------------------------
+
+def parse_cli_arguments(arguments):
+    """Turns the arguments of an aws cloudsearch command (ex:
+    ["define-index-field", "--domain-name", "d", ...]) into the operation and
+    parameters of the API call, and the output format (--output, or
+    $AWS_DEFAULT_OUTPUT like the real tool, defaulting to json)."""
+    if not arguments:
+        raise FakeError("InvalidAction", "No operation given.")
+
+    operation, rest = _to_camel_case(arguments[0]), arguments[1:]
+
+    options = {}
+    key = None
+    for argument in rest:
+        if argument.startswith("--"):
+            key = argument[2:]
+            options[key] = []
+        elif key is None:
+            raise FakeError("ValidationException",
+                "Unexpected argument {!r}.".format(argument))
+        else:
+            options[key].append(argument)
+
+    output = (options.pop("output", None) or
+        [os.environ.get("AWS_DEFAULT_OUTPUT", "json")])[0]
+    options.pop("endpoint-url", None)
+    options.pop("region", None)
+
+    def one(key):
+        values = options.pop(key, [])
+        return values[0] if values else None
+
+    params = {}
+    if "domain-name" in options:
+        params["DomainName"] = one("domain-name")
+    if "domain-names" in options:
+        params["DomainNames"] = options.pop("domain-names")
+
+    if operation == "DefineIndexField":
+        field_type = one("type")
+        type_options = {}
+        if "analysis-scheme" in options:
+            type_options["AnalysisScheme"] = one("analysis-scheme")
+        for key in list(options):
+            if key.endswith("-enabled"):
+                type_options[_to_camel_case(key[:-len("-enabled")]) +
+                    "Enabled"] = one(key) == "true"
+        params["IndexField"] = {
+            "IndexFieldName": one("name"),
+            "IndexFieldType": field_type,
+            domain_plan.FIELD_TYPE_TO_OPTIONS_KEY.get(field_type, "Options"):
+                type_options,
+        }
+    elif operation == "DefineAnalysisScheme":
+        try:
+            params["AnalysisScheme"] = json.loads(one("analysis-scheme"))
+        except (TypeError, ValueError):
+            raise FakeError("ValidationException",
+                "--analysis-scheme must be JSON.")
+
+    if options:
+        raise FakeError("ValidationException",
+            "Unsupported options {}.".format(", ".join(sorted(options))))
+
+    return (operation, params, output)
+
+
+def to_text(value):
+    """Roughly what the aws tool prints with --output text: a line of
+    tab-separated scalars per object, nested objects on their own lines."""
+    if isinstance(value, list):
+        return "".join(to_text(i) for i in value)
+    if not isinstance(value, dict):
+        return "{}\n".format(value)
+    keys = sorted(value)
+    scalars = [str(value[key]) for key in keys
+        if not isinstance(value[key], (dict, list))]
+    return ("\t".join(scalars) + "\n" if scalars else "") + "".join(
+        to_text(value[key]) for key in keys
+        if isinstance(value[key], (dict, list)))
+
+
+def run_cli(argv):
+    """Acts like the aws command line tool. Returns the exit status."""
+    fake = FakeCloudSearch(
+        state_path=os.environ.get("FAKE_CLOUDSEARCH_STATE",
+            os.path.join(tempfile.gettempdir(), "fake-cloudsearch.json")),
+        latency=float(os.environ.get("FAKE_CLOUDSEARCH_LATENCY", 0)),
+        throttle_rate=float(os.environ.get("FAKE_CLOUDSEARCH_THROTTLE_RATE",
+            0)),
+        processing_seconds=float(os.environ.get(
+            "FAKE_CLOUDSEARCH_PROCESSING_SECONDS", 5)))
+
+    if argv[:1] != ["cloudsearch"]:
+        sys.stderr.write("Only `aws cloudsearch` commands are faked.\n")
+        return 2
+
+    operation = "?"
+    try:
+        operation, params, output = parse_cli_arguments(argv[1:])
+        response = fake.call(operation, params)
+    except FakeError as e:
+        # This is how the aws tool reports errors.
+        sys.stderr.write("\nAn error occurred ({}) when calling the {} "
+            "operation: {}\n".format(e.code, operation, e))
+        return 255
+
+    if output == "json":
+        print json.dumps(response, indent=4, sort_keys=True,
+            separators=(",", ": "))
+    else:
+        sys.stdout.write(to_text(response))
+    return 0
+
+
+# The HTTP endpoint
+# -----------------
+
+def parse_query_parameters(query):
+    """Turns the flattened parameters of the query protocol (ex:
+    {"IndexField.IndexFieldName": ["x"], "FieldNames.member.1": ["y"]}) into
+    nested ones (ex: {"IndexField": {"IndexFieldName": "x"}, "FieldNames":
+    ["y"]})."""
+    params = {}
+    for key, values in query.iteritems():
+        if key in ("Action", "Version"):
+            continue
+
+        parts = key.split(".")
+        node = params
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        value = values[0]
+        if parts[-1].endswith("Enabled"):
+            value = value == "true"
+        node[parts[-1]] = value
+
+    def fix_lists(node):
+        if not isinstance(node, dict):
+            return node
+        if set(node) == {"member"}:
+            return [fix_lists(value) for _, value
+                in sorted(node["member"].iteritems(), key=lambda i: int(i[0]))]
+        return dict((key, fix_lists(value))
+            for key, value in node.iteritems())
+
+    return fix_lists(params)
+
+
+def to_xml(value):
+    """Serializes a response the way the query protocol does."""
+    if isinstance(value, dict):
+        return "".join("<{0}>{1}</{0}>".format(key, to_xml(value[key]))
+            for key in sorted(value))
+    elif isinstance(value, list):
+        return "".join("<member>{}</member>".format(to_xml(i))
+            for i in value)
+    elif isinstance(value, bool):
+        return "true" if value else "false"
+    elif isinstance(value, unicode):
+        return saxutils.escape(value.encode("utf-8"))
+    return saxutils.escape(str(value))
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if urlparse.urlparse(self.path).path == DOCUMENTS_BATCH_PATH:
+            self.upload_documents(body)
+            return
+
+        query = urlparse.parse_qs(body)
+        query.update(urlparse.parse_qs(urlparse.urlparse(self.path).query))
+        operation = query.get("Action", ["?"])[0]
+        request_id = str(uuid.uuid4())
+
+        try:
+            response = self.server.fake.call(operation,
+                parse_query_parameters(query))
+        except FakeError as e:
+            status = e.status
+            xml = ("<ErrorResponse xmlns=\"{}\"><Error><Type>Sender</Type>"
+                "<Code>{}</Code><Message>{}</Message></Error>"
+                "<RequestId>{}</RequestId></ErrorResponse>").format(
+                    XML_NAMESPACE, e.code, saxutils.escape(str(e)),
+                    request_id)
+        else:
+            status = 200
+            xml = ("<{0}Response xmlns=\"{1}\"><{0}Result>{2}</{0}Result>"
+                "<ResponseMetadata><RequestId>{3}</RequestId>"
+                "</ResponseMetadata></{0}Response>").format(
+                    operation, XML_NAMESPACE, to_xml(response), request_id)
+
+        self.send_response(status)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(xml)))
+        self.send_header("x-amzn-RequestId", request_id)
+        self.end_headers()
+        self.wfile.write(xml)
+
+    def upload_documents(self, body):
+        try:
+            status = 200
+            response = self.server.fake.upload_documents(body)
+        except FakeError as e:
+            status = e.status
+            response = {"status": "error",
+                "errors": [{"message": "[*{}] {}".format(e.code, e)}]}
+
+        body = json.dumps(response)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format,
+                *args)
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def serve(port, fake, verbose=False):
+    server = Server(("localhost", port), RequestHandler)
+    server.fake = fake
+    server.verbose = verbose
+    print "Faking CloudSearch at http://localhost:{}/".format(
+        server.server_address[1])
+    sys.stdout.flush()
+    server.serve_forever()
+
+
+def main():
+    import optparse
+    parser = optparse.OptionParser(
+        usage="usage: %prog [OPTIONS]",
+        description="Serves a fake CloudSearch configuration API over HTTP. "
+            "(Run as `aws`, acts as the aws command line tool instead.)")
+    parser.add_option("--port", type="int", default=8001,
+        help="The port to listen on. Defaults to %default.")
+    parser.add_option("--state",
+        help="If specified, keep the state in this file (it can be shared "
+            "with the `aws` shim) instead of in memory.")
+    parser.add_option("--latency", type="float", default=0,
+        help="The average number of seconds every request takes. Defaults "
+            "to %default.")
+    parser.add_option("--throttle-rate", type="float", default=0,
+        help="The fraction of requests that fail with a Throttling error. "
+            "Defaults to %default.")
+    parser.add_option("--processing-seconds", type="float", default=5,
+        help="How long index-documents takes. Defaults to %default.")
+    parser.add_option("-v", "--verbose", action="store_true", default=False,
+        help="If specified, log every request.")
+    options, args = parser.parse_args()
+    if args:
+        parser.error("Unexpected arguments {!r}.".format(args))
+
+    serve(options.port, FakeCloudSearch(options.state, options.latency,
+        options.throttle_rate, options.processing_seconds), options.verbose)
+
+
+if __name__ == "__main__":
+    if os.path.basename(sys.argv[0]) == "aws":
+        sys.exit(run_cli(sys.argv[1:]))
+    main()
@@ -26,6 +26,22 @@ After you've created the YAML file, add some friendly comments to the top
 explaining where you got the Lucene file from, in addition to any necessary
 licensing information.
 
+Batch Mode
+----------
+
+To regenerate many dictionaries at once, pass the Lucene files (or
+directories containing them) as arguments instead:
+
+    $ ./lucene-stopwords-converter.py /tmp/snowball/*_stop.txt
+
+The files are converted in parallel, and each one is written to
+`dictionaries/<lang>-stopwords.yaml`, where the language is guessed from the
+file name (ex: `french_stop.txt` becomes `fr`). Use LANG=FILE to give the
+language yourself. The comments at the top of the existing dictionary are
+kept. A manifest with the number of words and SHA-1 of each dictionary, and
+whether it changed, is kept in `dictionaries/stopwords-manifest.json`: each
+run updates the entries of the dictionaries it converted.
+
 Warning
 -------
 
@@ -33,7 +49,13 @@ This script wasn't made to be all that friendly as its use will be infrequent,
 so be prepared to modify the code if anything goes awry.
 """
 
+import hashlib
+import json
+import multiprocessing
+import optparse
+import os
 import sys
+import tempfile
 
 # This is the column that the comments will be aligned to
 COMMENT_COLUMN = 28
@@ -41,11 +63,48 @@ COMMENT_COLUMN = 28
 # This string will be prepended to every word
 INDENT = 4 * " "
 
-# Starts off our YAML list
-print "["
+# Maps the language names used in Lucene's file names to the language codes
+# our dictionaries (and CloudSearch) use.
+LANGUAGE_CODES = {
+    "arabic": "ar",
+    "armenian": "hy",
+    "basque": "eu",
+    "bulgarian": "bg",
+    "catalan": "ca",
+    "czech": "cs",
+    "danish": "da",
+    "dutch": "nl",
+    "english": "en",
+    "finnish": "fi",
+    "french": "fr",
+    "galician": "gl",
+    "german": "de",
+    "greek": "el",
+    "hebrew": "he",
+    "hindi": "hi",
+    "hungarian": "hu",
+    "indonesian": "id",
+    "irish": "ga",
+    "italian": "it",
+    "latvian": "lv",
+    "norwegian": "no",
+    "persian": "fa",
+    "portuguese": "pt",
+    "romanian": "ro",
+    "russian": "ru",
+    "spanish": "es",
+    "swedish": "sv",
+    "thai": "th",
+    "turkish": "tr",
+}
 
-# Go through all of STDIN, line-by-line, until we hit EOF.
-for line in sys.stdin:
+
+def convert_line(line):
+    """Converts one line of a Lucene dictionary.
+
+    Returns a tuple (result, word) with the YAML line and the stop word on
+    it (which is empty if there isn't one).
+    """
     # Parse out the word and comment part of the line
     if "|" in line:
         word, comment = line[:line.index("|")], line[line.index("|"):]
@@ -73,7 +132,250 @@ for line in sys.stdin:
     else:
         result = ""
 
-    print result
+    return (result, word)
+
+
+def convert(lines, out):
+    """Converts the Lucene dictionary in lines, writing the YAML list to the
+    file-like object out as it goes. Returns the number of stop words."""
+    num_words = 0
+
+    # Starts off our YAML list
+    out.write("[\n")
+
+    for line in lines:
+        result, word = convert_line(line)
+        if word:
+            num_words += 1
+        out.write(result + "\n")
+
+    # End our YAML list
+    out.write("]\n")
+
+    return num_words
+
+
+def guess_language(path):
+    """Guesses the language code of a Lucene dictionary from its file name,
+    ex: "english_stop.txt" is "en". Returns None if we can't tell."""
+    name = os.path.basename(path).split(".")[0].split("_")[0].lower()
+    if name in LANGUAGE_CODES.values():
+        return name
+
+    return LANGUAGE_CODES.get(name)
+
+
+def read_header(path):
+    """Returns the comment lines at the top of the dictionary at path (which
+    is where we say where it came from), or "" if there isn't one yet."""
+    header = []
+    try:
+        with open(path) as f:
+            for line in f:
+                if line.startswith("["):
+                    break
+                header.append(line)
+    except IOError:
+        pass
+
+    return "".join(header)
+
+
+def file_sha1(path):
+    """Returns the SHA-1 of the file at path, or None if it doesn't exist."""
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except IOError:
+        return None
+
+
+class _HashingWriter(object):
+    """Writes to a file, keeping the SHA-1 of everything written."""
+    def __init__(self, f):
+        self.f = f
+        self.sha1 = hashlib.sha1()
+
+    def write(self, data):
+        self.sha1.update(data)
+        self.f.write(data)
+
+
+def convert_file(source_path, language, output_dir):
+    """Converts the Lucene dictionary at source_path into
+    output_dir/<language>-stopwords.yaml.
+
+    The new dictionary is written to a temporary file and then renamed into
+    place, so a failed conversion never leaves a partial dictionary behind.
+    If it turns out to be the same as the old one, the old one is left
+    untouched.
+
+    Returns the dictionary's entry in the manifest.
+    """
+    output_name = "{}-stopwords.yaml".format(language)
+    output_path = os.path.join(output_dir, output_name)
+    header = read_header(output_path)
+    old_sha1 = file_sha1(output_path)
+
+    fd, temp_path = tempfile.mkstemp(dir=output_dir, prefix=output_name,
+        suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f, open(source_path) as source:
+            out = _HashingWriter(f)
+            out.write(header)
+            num_words = convert(source, out)
+        sha1 = out.sha1.hexdigest()
+
+        if sha1 == old_sha1:
+            os.unlink(temp_path)
+        else:
+            os.chmod(temp_path, 0644)
+            os.rename(temp_path, output_path)
+    except:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+    return {
+        "dictionary": output_name,
+        "source": source_path,
+        "language": language,
+        "words": num_words,
+        "sha1": sha1,
+        "changed": sha1 != old_sha1,
+        "has_header": bool(header),
+    }
+
+
+def write_manifest(manifest, path, output_dir):
+    """Adds manifest, a list of dictionary entries, to the manifest at path.
+
+    The entries of the dictionaries we didn't convert this time are kept
+    (as unchanged), as long as the dictionary is still in output_dir. Like
+    the dictionaries, the manifest is written to a temporary file that is
+    then renamed into place, so it's never left half written.
+    """
+    try:
+        with open(path) as f:
+            entries = json.load(f)
+    except (IOError, ValueError):
+        entries = {}
+    if not isinstance(entries, dict):
+        entries = {}
+    entries = dict((name, dict(entry, changed=False))
+        for name, entry in entries.iteritems()
+        if isinstance(entry, dict) and
+            os.path.exists(os.path.join(output_dir, name)))
+    entries.update((entry["dictionary"], entry) for entry in manifest)
+
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix=os.path.basename(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(entries, f, indent=4, sort_keys=True,
+                separators=(",", ": "))
+            f.write("\n")
+        os.chmod(temp_path, 0644)
+        os.rename(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+
+def _convert_file(args):
+    # Pool.imap only passes a single argument.
+    return convert_file(*args)
+
+
+def find_sources(args, parser):
+    """Turns the FILE, DIRECTORY and LANG=FILE arguments into a list of
+    (path, language) pairs."""
+    sources = []
+    for arg in args:
+        if "=" in arg:
+            language, path = arg.split("=", 1)
+            sources.append((path, language))
+        elif os.path.isdir(arg):
+            for name in sorted(os.listdir(arg)):
+                if name.endswith(".txt"):
+                    path = os.path.join(arg, name)
+                    sources.append((path, guess_language(path)))
+        else:
+            sources.append((arg, guess_language(arg)))
+
+    for path, language in sources:
+        # Checked now, rather than failing in the middle of the pool.
+        if not os.path.isfile(path):
+            parser.error("No such file: {}.".format(path))
+        if not language:
+            parser.error("Can't tell the language of {}, give it as "
+                "LANG={}.".format(path, path))
+
+    languages = [language for _, language in sources]
+    duplicates = set(i for i in languages if languages.count(i) > 1)
+    if duplicates:
+        parser.error("More than one file for {}.".format(
+            ", ".join(sorted(duplicates))))
+
+    return sources
+
+
+def main():
+    parser = optparse.OptionParser(
+        usage="usage: %prog [OPTIONS] [[LANG=]FILE_OR_DIRECTORY...]",
+        description="Converts Lucene stop words dictionaries into YAML ones. "
+            "With no arguments, converts stdin to stdout.")
+
+    default_output_dir = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "dictionaries")
+    parser.add_option("-o", "--output-dir", default=default_output_dir,
+        help="Where batch mode writes the dictionaries. Defaults to "
+            "%default.")
+
+    parser.add_option("--manifest",
+        help="Where batch mode writes the manifest. Defaults to "
+            "stopwords-manifest.json in --output-dir.")
+
+    parser.add_option("-j", "--jobs", type="int",
+        default=multiprocessing.cpu_count(),
+        help="How many files to convert at the same time. Defaults to "
+            "%default.")
+
+    options, args = parser.parse_args()
+
+    if not args:
+        convert(sys.stdin, sys.stdout)
+        return
+
+    if options.jobs < 1:
+        parser.error("--jobs must be at least 1.")
+
+    sources = find_sources(args, parser)
+    if not os.path.isdir(options.output_dir):
+        parser.error("No such directory: {}.".format(options.output_dir))
+
+    pool = multiprocessing.Pool(min(options.jobs, len(sources)))
+    try:
+        manifest = pool.map(_convert_file, [(path, language,
+            options.output_dir) for path, language in sources])
+    finally:
+        pool.close()
+        pool.join()
+
+    for entry in manifest:
+        print "{} {} ({} words, from {})".format(
+            "Wrote" if entry["changed"] else "Unchanged",
+            entry["dictionary"], entry["words"], entry["source"])
+        if not entry["has_header"]:
+            print ("  Add some comments to the top of {} saying where it "
+                "came from.".format(entry["dictionary"]))
+
+    manifest_path = options.manifest or os.path.join(options.output_dir,
+        "stopwords-manifest.json")
+    write_manifest(manifest, manifest_path, options.output_dir)
+
 
-# End our YAML list
-print "]"
+if __name__ == "__main__":
+    main()
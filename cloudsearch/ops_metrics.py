@@ -0,0 +1 @@
+../shared/ops_metrics.py
\ No newline at end of file
@@ -16,8 +16,47 @@ In order to use this tool you'll need to have the aws command line
 tool installed. Get it at
 http://docs.aws.amazon.com/cli/latest/userguide/installing.html
 
+Alternatively, pass --backend=sdk to make the calls from within this process
+using boto3 (`pip install boto3`), which saves starting a new aws process
+(and connection) for every command.
+
 Example use: $ ./provision-domain.py khan-academy-dev domain-info.yaml
 
+Several domains can be provisioned with the same configuration at once, ex:
+
+    $ ./provision-domain.py --reindex-stagger=600 \
+        ../production-rpc/data/cloudsearch-publish-endpoint* domain-info.yaml
+
+Domains can be given by name, by endpoint URL, by a file containing an
+endpoint URL (like the ones in production-rpc/data), or listed in a
+--domains-file. They are provisioned concurrently and a report on all of them
+is logged at the end.
+
+To only touch the fields and analysis schemes that differ from what the
+domain currently has (and skip the reindex if nothing does), pass
+--only-changed.
+
+To wait until the domain has finished processing (all of its fields and
+analysis schemes are Active) before exiting, pass --wait. If the domain isn't
+ready within --wait-timeout seconds the script exits with status 3.
+
+Once a domain has been configured, the plan that was applied to it is saved
+in a local state cache (~/.cache/provision-domain/). With --skip-configured,
+running the script again with the same configuration skips the domain
+without asking CloudSearch anything. Entries expire after --state-ttl
+seconds, and are kept separately for each --endpoint-url, so rehearsing
+against fake_cloudsearch.py never makes a real domain look configured.
+To report whether a domain has drifted from the configuration without
+changing it, pass --check, which exits with status 2 if it has.
+
+To graph how long provisioning takes, pass --metrics-file (a file for the
+node-exporter textfile collector) and/or --metrics-log (a JSON lines log):
+every command, retry, --wait and domain is timed or counted.
+
+To try the script without touching a real domain, run it against
+fake_cloudsearch.py (see its docstring), a local stand-in for CloudSearch that
+can also be made slow or to throttle requests.
+
 After Running the Script
 ------------------------
 
@@ -28,23 +67,97 @@ https://console.aws.amazon.com/cloudsearch/
 
 import json
 import logging
+import multiprocessing.pool
 import optparse
 import os
 import pipes
+import random
+import re
 import subprocess
 import sys
-import yaml
+import threading
+import time
+
+import domain_plan
+import ops_metrics
+import state_cache
+import stopwords
 
 """A global that is flipped within main if we're in a dry run (not actually
 issuing commands to CloudSearch).
 """
 dry_run = False
 
+"""Globals that are set within main from the command line. jobs is the
+number of define commands that are run at the same time and max_retries is
+how many times a throttled command is retried before giving up.
+"""
+jobs = 1
+max_retries = 0
+
+"""The backend (a CliBackend or SdkBackend) that runs our CloudSearch
+commands. It is created within main.
+"""
+backend = None
+
+"""Set within main from --reindex-stagger: the minimum number of seconds
+between the reindexes of two domains. last_reindex is when the last one
+started, and is protected by reindex_lock.
+"""
+reindex_stagger = 0
+last_reindex = None
+reindex_lock = threading.Lock()
+
+"""Thread-local state. When we're provisioning more than one domain,
+log_context.domain is the domain that the current thread is working on, and
+is added to its log messages.
+"""
+log_context = threading.local()
+
+"""How long each command, reindex wait and domain took, and how many retries
+we did (see ops_metrics). It is written out at the end of the run if
+--metrics-file or --metrics-log is given.
+"""
+metrics = ops_metrics.Metrics("cloudsearch_provision")
+
+# Matches the errors the aws tool prints when CloudSearch throttles us, ex:
+# "An error occurred (Throttling) when calling the DefineIndexField operation:
+# Rate exceeded".
+THROTTLING_RE = re.compile(r"\((Throttling|ThrottlingException|"
+    r"RequestLimitExceeded)\)|Rate exceeded")
+
+# The same errors, as error codes returned by boto3.
+THROTTLING_CODES = {"Throttling", "ThrottlingException",
+    "RequestLimitExceeded"}
+
+# The exit status when --wait gives up before the domain is ready, so that
+# automation can tell a slow reindex from a failed one.
+WAIT_TIMEOUT_EXIT_CODE = 3
+
+# The exit status when --check finds that the domain doesn't match its
+# configuration.
+DRIFT_EXIT_CODE = 2
+
+# Matches a CloudSearch endpoint URL, ex:
+# http://doc-khan-academy-dev-2-5hz5ckwpoayj4gdjg24cpqzysq.us-east-1.cloudsearch.amazonaws.com
+# capturing the name of the domain (the 26 characters after it are its id).
+ENDPOINT_RE = re.compile(r"(?:doc|search)-(.+)-[a-z0-9]{26}\.")
+
+# How many seconds --wait sleeps between polls. The delay doubles while
+# nothing changes and goes back to the minimum whenever something does.
+WAIT_MIN_DELAY = 5
+WAIT_MAX_DELAY = 60
+
+
+# Analysis options that CloudSearch stores as JSON-encoded strings.
+JSON_ANALYSIS_OPTIONS = {"Stopwords", "StemmingDictionary", "Synonyms",
+    "JapaneseTokenizationDictionary"}
+
 
 def parse_arguments(raw_args=sys.argv[1:]):
     """Parses any command line arguments."""
     parser = optparse.OptionParser(
-        usage="usage: %prog [OPTIONS] DOMAIN_NAME DOMAIN_CONFIG_FILE",
+        usage="usage: %prog [OPTIONS] DOMAIN_NAME... DOMAIN_CONFIG_FILE",
         description="A tool for provisioning a Khan Academy CloudSearch "
             "domain.")
 
@@ -62,13 +175,327 @@ def parse_arguments(raw_args=sys.argv[1:]):
     parser.add_option("--no-reindex", action="store_true", default=False,
         help="If specified, will only update the config, without reindexing.")
 
+    parser.add_option("--wait", action="store_true", default=False,
+        help="If specified, wait until all of the domain's fields and "
+            "analysis schemes are Active (the reindex is done) before "
+            "exiting, logging their state changes as they happen.")
+
+    parser.add_option("--wait-timeout", type="int", default=3600,
+        help="How many seconds --wait waits before giving up and exiting "
+            "with status {}. Defaults to %default.".format(
+                WAIT_TIMEOUT_EXIT_CODE))
+
+    parser.add_option("--only-changed", action="store_true", default=False,
+        help="If specified, the domain's current configuration is fetched "
+            "first (even in a dry run) and only the fields and analysis "
+            "schemes that differ from it are defined. The reindex is skipped "
+            "if nothing changed.")
+
+    parser.add_option("--check", action="store_true", default=False,
+        help="If specified, don't change anything: report whether the "
+            "domain's fields and analysis schemes match the configuration "
+            "(and whether it needs a reindex), exiting with status {} if "
+            "they don't.".format(DRIFT_EXIT_CODE))
+
+    parser.add_option("--skip-configured", action="store_true",
+        default=False,
+        help="If specified, skip the domains that the state cache says were "
+            "configured with this configuration less than --state-ttl "
+            "seconds ago, instead of looking at (or configuring) them.")
+
+    parser.add_option("--state-cache-dir",
+        default=state_cache.DEFAULT_DIRECTORY,
+        help="Where to remember the configuration last applied to each "
+            "domain. Defaults to %default.")
+
+    parser.add_option("--state-ttl", type="int", default=24 * 60 * 60,
+        help="How many seconds --skip-configured trusts the state cache "
+            "for. Defaults to %default.")
+
+    parser.add_option("--backend", type="choice", choices=["cli", "sdk"],
+        default="cli",
+        help="How to talk to CloudSearch: \"cli\" runs the aws command line "
+            "tool for every command, \"sdk\" makes the calls from within "
+            "this process with boto3. Defaults to %default.")
+
+    parser.add_option("--endpoint-url",
+        help="If specified, talk to this CloudSearch configuration endpoint "
+            "instead of the default one (ex: a local stub for testing).")
+
+    parser.add_option("-j", "--jobs", type="int", default=8,
+        help="The number of define-index-field and define-analysis-scheme "
+            "commands to run at the same time. Defaults to %default.")
+
+    parser.add_option("--domains-file",
+        help="A file listing domains to provision (in addition to any given "
+            "as arguments), one per line, by name or endpoint URL. Lines "
+            "starting with # are ignored.")
+
+    parser.add_option("--parallel-domains", type="int", default=4,
+        help="How many domains to provision at the same time (each running "
+            "up to --jobs commands at once). Defaults to %default.")
+
+    parser.add_option("--reindex-stagger", type="int", default=0,
+        help="The minimum number of seconds between reindexing two domains, "
+            "so that replicas aren't all reindexed at the same moment. "
+            "Defaults to %default.")
+
+    parser.add_option("--max-retries", type="int", default=5,
+        help="How many times to retry a command that CloudSearch throttled, "
+            "backing off exponentially between attempts. Defaults to "
+            "%default.")
+
+    parser.add_option("--metrics-file",
+        help="If specified, write how long each command, --wait and domain "
+            "took, and how many commands were retried, to this file in the "
+            "format of the node-exporter textfile collector.")
+
+    parser.add_option("--metrics-log",
+        help="If specified, append the same metrics to this file as JSON "
+            "lines, one for each command and one for the whole run.")
+
     options, args = parser.parse_args(raw_args)
 
-    if len(args) != 2:
+    if options.jobs < 1 or options.parallel_domains < 1:
+        parser.error("--jobs and --parallel-domains must be at least 1.")
+
+    if options.wait and options.no_reindex:
+        parser.error("--wait can't be used with --no-reindex, the domain "
+            "won't be ready until it is reindexed.")
+
+    if options.wait_timeout < 1:
+        parser.error("--wait-timeout must be at least 1.")
+
+    if options.check and options.wait:
+        parser.error("--check doesn't change anything, so there is nothing "
+            "to --wait for.")
+
+    if not args:
+        parser.error("You must specify a file containing the domain "
+            "configuration.")
+
+    # main() changes the current directory.
+    if options.metrics_file:
+        options.metrics_file = os.path.abspath(options.metrics_file)
+    if options.metrics_log:
+        options.metrics_log = os.path.abspath(options.metrics_log)
+
+    domain_args = args[:-1]
+    if options.domains_file:
+        try:
+            with open(options.domains_file) as f:
+                domain_args += [line.strip() for line in f
+                    if line.strip() and not line.startswith("#")]
+        except IOError as e:
+            parser.error("Could not read --domains-file: {}".format(e))
+
+    if not domain_args:
         parser.error("You must specify the name of the domain and a file "
             "containing the domain configuration.")
 
-    return (options, args[0], args[1])
+    domains = []
+    for arg in domain_args:
+        domain = parse_domain_name(arg)
+        if domain not in domains:
+            domains.append(domain)
+
+    return (options, domains, args[-1])
+
+
+def parse_domain_name(arg):
+    """Returns the name of the domain given on the command line as arg: its
+    name, an endpoint URL, or a file containing an endpoint URL.
+
+        >>> parse_domain_name(
+        ...     "http://doc-khan-academy-dev-2-5hz5ckwpoayj4gdjg24cpqzysq.us-"
+        ...     "east-1.cloudsearch.amazonaws.com")
+        'khan-academy-dev-2'
+    """
+    if os.path.isfile(arg):
+        with open(arg) as f:
+            arg = f.read().strip()
+
+    match = ENDPOINT_RE.search(arg)
+    return match.group(1) if match else arg
+
+
+class CommandError(Exception):
+    """Raised when a CloudSearch command fails.
+
+    throttled is True if the command failed because CloudSearch throttled
+    us, in which case it is worth retrying.
+    """
+    def __init__(self, message, throttled=False):
+        super(CommandError, self).__init__(message)
+        self.throttled = throttled
+
+
+class CliBackend(object):
+    """Runs CloudSearch commands with the aws command line tool."""
+
+    def __init__(self, endpoint_url=None):
+        self.endpoint_url = endpoint_url
+
+    def run(self, command):
+        """Runs command, returning its (decoded JSON) output.
+
+        The output is always asked for as JSON, whatever the user's aws
+        configuration says. Output that still isn't JSON (here from a
+        stand-in for aws that ignores --output) is an error:
+
+            >>> CliBackend().run(["echo", "DOMAIN"])  # doctest: +ELLIPSIS
+            Traceback (most recent call last):
+                ...
+            CommandError: echo DOMAIN --output json did not output JSON: ...
+        """
+        if "--output" not in command:
+            command = command + ["--output", "json"]
+        if self.endpoint_url:
+            command = command + ["--endpoint-url", self.endpoint_url]
+
+        process = subprocess.Popen(command, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        output, error_output = process.communicate()
+        if process.returncode != 0:
+            raise CommandError("{} exited with status {}: {}".format(
+                command_list_to_str(command), process.returncode,
+                error_output.strip()),
+                throttled=bool(THROTTLING_RE.search(error_output)))
+
+        if not output.strip():
+            return {}
+        try:
+            return json.loads(output)
+        except ValueError:
+            raise CommandError("{} did not output JSON: {!r}".format(
+                command_list_to_str(command), output[:200]))
+
+
+class SdkBackend(object):
+    """Runs CloudSearch commands in-process with boto3.
+
+    Commands are given in the same form as for the aws tool (so they can
+    still be logged with command_list_to_str) and are translated into calls
+    on a single client, which reuses its credentials and HTTP connections for
+    every call.
+    """
+
+    def __init__(self, endpoint_url=None, max_pool_connections=10):
+        # boto3 is only needed for this backend.
+        try:
+            import boto3
+            import botocore.config
+            import botocore.exceptions
+        except ImportError:
+            logging.error("The sdk backend requires boto3, install it with "
+                "`pip install boto3`.")
+            sys.exit(1)
+
+        self._client_error = botocore.exceptions.ClientError
+        self._botocore_error = botocore.exceptions.BotoCoreError
+
+        # We retry throttled calls ourselves (see execute_command).
+        config = botocore.config.Config(
+            max_pool_connections=max_pool_connections,
+            retries={"max_attempts": 0})
+        self.client = boto3.session.Session().client("cloudsearch",
+            endpoint_url=endpoint_url, config=config)
+
+    @staticmethod
+    def _parse_options(arguments):
+        """Turns ["--name", "foo", ...] into {"name": "foo", ...}."""
+        if len(arguments) % 2 != 0:
+            raise CommandError("Malformed arguments {!r}.".format(arguments))
+
+        return dict((arguments[i][2:], arguments[i + 1])
+            for i in xrange(0, len(arguments), 2))
+
+    @staticmethod
+    def _make_index_field(options):
+        """Builds the IndexField parameter of DefineIndexField from the
+        options given to define-index-field."""
+        field_type = options.pop("type")
+        type_options = {}
+        for key, value in options.iteritems():
+            if key == "analysis-scheme":
+                type_options["AnalysisScheme"] = value
+            elif key.endswith("-enabled"):
+                trait = key[:-len("-enabled")]
+                type_options["{}Enabled".format(trait.capitalize())] = (
+                    value == "true")
+            else:
+                raise CommandError("Unsupported option --{}.".format(key))
+
+        return {
+            "IndexFieldType": field_type,
+            domain_plan.FIELD_TYPE_TO_OPTIONS_KEY[field_type]: type_options,
+        }
+
+    def run(self, command):
+        """Runs command, returning the response of the matching API call."""
+        if command[:2] != ["aws", "cloudsearch"] or len(command) < 3:
+            raise CommandError("Not a CloudSearch command: {}".format(
+                command_list_to_str(command)))
+
+        operation = command[2]
+        options = self._parse_options(command[3:])
+        options.pop("output", None)
+
+        params = {"DomainName": options.pop("domain-name")}
+        if operation == "define-index-field":
+            name = options.pop("name")
+            params["IndexField"] = self._make_index_field(options)
+            params["IndexField"]["IndexFieldName"] = name
+        elif operation == "define-analysis-scheme":
+            params["AnalysisScheme"] = json.loads(
+                options.pop("analysis-scheme"))
+        elif options:
+            raise CommandError("Unsupported options {!r} for {}.".format(
+                options.keys(), operation))
+
+        try:
+            response = getattr(self.client, operation.replace("-", "_"))(
+                **params)
+        except self._client_error as e:
+            code = e.response.get("Error", {}).get("Code")
+            raise CommandError(str(e), throttled=code in THROTTLING_CODES)
+        except self._botocore_error as e:
+            raise CommandError(str(e))
+
+        response.pop("ResponseMetadata", None)
+        return response
+
+
+def execute_command(command):
+    """Runs a CloudSearch command, retrying it if we're being throttled.
+
+    Returns the command's (decoded JSON) output. Raises CommandError if the
+    command fails.
+    """
+    pretty_command = command_list_to_str(command)
+    operation = command[2]
+
+    for attempt in xrange(max_retries + 1):
+        logging.info("Executing: %s", pretty_command)
+        try:
+            with metrics.timer("api_call", operation=operation):
+                output = backend.run(command)
+        except CommandError as e:
+            if not e.throttled or attempt == max_retries:
+                raise
+
+            metrics.count("retries", operation=operation)
+
+            # Exponential backoff with some jitter so that throttled
+            # workers don't all retry at the same moment.
+            delay = min(2 ** attempt, 30) * random.uniform(1, 1.5)
+            logging.warning("Throttled, retrying in %.1fs: %s", delay,
+                pretty_command)
+            time.sleep(delay)
+            continue
+
+        logging.debug("Output of %s: %r", pretty_command, output)
+        return output
 
 
 def maybe_execute_command(command, error_msg):
@@ -81,13 +508,55 @@ def maybe_execute_command(command, error_msg):
         logging.info("Would execute: %s", pretty_command)
         return
     else:
-        logging.info("Executing: %s", pretty_command)
         try:
-            ret_val = subprocess.check_call(command)
-        except subprocess.CalledProcessError:
+            return execute_command(command)
+        except CommandError:
             logging.exception(error_msg)
             sys.exit(1)
-        return ret_val
+
+
+def maybe_execute_commands(commands):
+    """Runs many CloudSearch commands concurrently (or not if its a dry run).
+
+    commands is a list of (command, error_msg) pairs, run by at most `jobs`
+    workers at a time. Unlike maybe_execute_command, a failing command does
+    not stop the others: its error is logged and the returned list, which
+    has a boolean for each command saying whether it succeeded, has False in
+    its place.
+    """
+    if dry_run:
+        for command, _ in commands:
+            logging.info("Would execute: %s",
+                command_list_to_str(command))
+        return [True] * len(commands)
+
+    domain = getattr(log_context, "domain", None)
+
+    def run(command_and_error_msg):
+        log_context.domain = domain
+        command, error_msg = command_and_error_msg
+        try:
+            execute_command(command)
+        except CommandError as e:
+            logging.error("%s %s", error_msg, e)
+            return False
+        return True
+
+    pool = multiprocessing.pool.ThreadPool(min(jobs, len(commands)) or 1)
+    try:
+        return pool.map(run, commands)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class DomainLogFilter(logging.Filter):
+    """Prefixes log messages with log_context.domain, if it's set."""
+    def filter(self, record):
+        domain = getattr(log_context, "domain", None)
+        if domain:
+            record.msg = "[{}] {}".format(domain, record.msg)
+        return True
 
 
 def setup_logging(verbose):
@@ -108,6 +577,8 @@ def setup_logging(verbose):
         format = COLOR_START + "%(levelname)s - %(message)s" + COLOR_END
 
     logging.basicConfig(level=log_level, format=format)
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(DomainLogFilter())
 
 
 def command_list_to_str(command):
@@ -122,148 +593,243 @@ def command_list_to_str(command):
     return " ".join(pipes.quote(i) for i in command)
 
 
-def get_disable_flags(field_type, traits):
-    """The configure tool enables all available traits by default.
+def fetch_current_state(domain):
+    """Fetches the domain's current index fields and analysis schemes.
 
-    This function takes a list of desired traits (ex: ["sort", "highlight"])
-    and a field_type (ex: "text") and returns a list of arguments to pass to
-    define-index-field to make it so (ex: ["--return-enabled", "false",
-    "--search-enabled", "false"]).
+    Returns a tuple (fields, schemes) of dicts mapping each field or scheme
+    name to the entry returned by describe-index-fields or
+    describe-analysis-schemes (a dict with "Options" and "Status" keys).
+    Pending changes are included, so a field that was defined but not yet
+    indexed is considered current.
 
-    An error is logged and `sys.exit` is called if a trait is given that is not
-    available for a given field type.
+    These commands only read from CloudSearch so they are run even when
+    we're in a dry run.
     """
+    def describe(operation, result_key, name_key):
+        command = ["aws", "cloudsearch", operation, "--domain-name", domain,
+            "--output", "json"]
+        try:
+            entries = execute_command(command)[result_key]
+        except CommandError:
+            logging.exception("Could not fetch the current configuration of "
+                "%r.", domain)
+            sys.exit(1)
 
-    # Most of the fields have the same available traits so we're going to group
-    # the fields into a few categories. Each category will be called a stem.
-    # The available traits are listed at
-    # http://docs.aws.amazon.com/cloudsearch/latest/developerguide/configuring-index-fields.html
-    # They can be verified by playing with the AWS console,
-    # selecting each field type and seeing which fields are enabled.
-    STEM_TO_FIELD = {
-        "plain": {"int", "double", "literal", "date", "latlong"},
-        "plain-array": {"int-array", "double-array", "literal-array",
-            "date-array"},
-        "text": {"text"},
-        "text-array": {"text-array"}
-    }
-
-    # This gives the available traits for each stem
-    STEM_FIELD_AVAILABLE_TRAITS = {
-        "plain": {"search", "facet", "return", "sort"},
-        "plain-array": {"search", "facet", "return"},
-        "text": {"search", "return", "sort", "highlight"},
-        "text-array": {"search", "return", "highlight"}
-    }
-
-    # Transform the field_type into its corresponding stem
-    for stem, field_set in STEM_TO_FIELD.iteritems():
-        if field_type in field_set:
-            # stem will have the correct value when we break
-            break
-    else:
-        logging.error("Unknown field type %r.", field_type)
-        sys.exit(1)
+        return dict((i["Options"][name_key], i) for i in entries)
 
-    # Figure out the available traits for field_type
-    defaults = STEM_FIELD_AVAILABLE_TRAITS[stem]
+    fields = describe("describe-index-fields", "IndexFields",
+        "IndexFieldName")
+    schemes = describe("describe-analysis-schemes", "AnalysisSchemes",
+        "AnalysisSchemeName")
 
-    # Make sure that no unavailable traits were specified
-    for i in traits:
-        if i not in defaults:
-            logging.error("Trait %r not available for %r fields.", i,
-                field_type)
-            sys.exit(1)
+    return (fields, schemes)
 
-    # We're going to disable every default trait that wasn't specified in
-    # traits.
-    disabled_traits = defaults - set(traits)
 
-    return sum([["--{}-enabled".format(i), "false"] 
-        for i in disabled_traits], [])
+def find_drift(plan, current_fields, current_schemes):
+    """Compares plan with the domain's current state (as returned by
+    fetch_current_state).
 
+    Returns a tuple (schemes, fields) with the names of the analysis schemes
+    and fields in plan that the domain doesn't have or has differently.
+    """
+    schemes = [scheme.name for scheme in plan.schemes
+        if scheme.name not in current_schemes or not scheme_is_current(
+            json.loads(scheme.argument), current_schemes[scheme.name])]
+    fields = [field.name for field in plan.fields
+        if field.name not in current_fields or not field_is_current(
+            field, current_fields[field.name])]
 
-def configure_fields(config, domain):
-    """Configures all of the fields. Called by main()."""
-    locales = config["locales"]
-    logging.debug("Loaded locale->scheme mappings: %r", locales)
+    return (schemes, fields)
 
-    fields = config["fields"]
-    logging.debug("Loaded fields: %r", [field["name"] for field in fields])
 
-    # A list of lists where each sublist contains all of the arguments that
-    # should be passed to define-index-field to configure that field, with
-    # the exception of the --domain flag.
-    field_arguments = []
+def is_cached_as_configured(plan, domain, options):
+    """Returns True if --skip-configured is given and the state cache says
+    that plan was applied to domain less than --state-ttl seconds ago."""
+    return options.skip_configured and state_cache.is_fresh(
+        state_cache.load(options.state_cache_dir, domain,
+            options.endpoint_url),
+        plan, options.state_ttl)
 
-    for field in fields:
-        new_arguments = ["--type", field["type"]]
 
-        # Configure the traits we want (if any traits can't be applied to this
-        # type of field we'll error).
-        new_arguments += get_disable_flags(field["type"], field["traits"])
+def check_domain(plan, domain, options):
+    """Reports whether domain matches plan, without changing it. Called by
+    main() for --check.
 
-        # Because of the special "locale_specific" scheme we need to do some
-        # fancy processing here.
-        analysis_scheme = field.get("analysis_scheme")
-        if analysis_scheme == "locale_specific":
-            for locale, scheme in locales.iteritems():
-                # Make a clone of the current arguments and add the locale
-                # specific name and analysis scheme.
-                cloned_arguments = list(new_arguments)
-                cloned_arguments += [
-                    "--analysis-scheme", scheme,
-                    "--name", "{}_{}".format(field["name"], locale)
-                ]
+    With --skip-configured, the domain is only described if the state cache
+    doesn't already say it matches. Returns True if it does.
+    """
+    if is_cached_as_configured(plan, domain, options):
+        logging.info("%r matches the configuration (according to the state "
+            "cache).", domain)
+        return True
+
+    current_fields, current_schemes = fetch_current_state(domain)
+    schemes, fields = find_drift(plan, current_fields, current_schemes)
+    reindex_needed = needs_reindex(current_fields.values() +
+        current_schemes.values())
+
+    if schemes or fields or reindex_needed:
+        logging.warning("%r does not match the configuration: analysis "
+            "schemes %r and fields %r differ%s.", domain, schemes, fields,
+            " and it needs a reindex" if reindex_needed else "")
+        state_cache.forget(options.state_cache_dir, domain,
+            options.endpoint_url)
+        return False
+
+    logging.info("%r matches the configuration.", domain)
+    state_cache.save(options.state_cache_dir, domain, plan,
+        options.endpoint_url)
+    return True
+
+
+def needs_reindex(current_entries):
+    """Returns True if any field or scheme is waiting on index-documents."""
+    return any(i["Status"]["State"] == "RequiresIndexDocuments"
+        for i in current_entries)
+
+
+def is_current(current_entry):
+    """Returns False if CloudSearch won't keep this entry as it is."""
+    status = current_entry["Status"]
+    return (not status.get("PendingDeletion") and
+        status["State"] != "FailedToValidate")
+
+
+def field_is_current(field, current_entry):
+    """Returns True if current_entry (from describe-index-fields) already
+    matches field, a domain_plan.FieldSpec."""
+    current_options = current_entry["Options"]
+    if current_options["IndexFieldType"] != field.type:
+        return False
+
+    type_options = current_options.get(
+        domain_plan.FIELD_TYPE_TO_OPTIONS_KEY[field.type], {})
+    for key, value in field.expected_options().iteritems():
+        # CloudSearch doesn't report options that don't apply to a field
+        # type (ex: SearchEnabled for text fields), which are always on.
+        default = True if key.endswith("Enabled") else None
+        if type_options.get(key, default) != value:
+            return False
+
+    return is_current(current_entry)
+
+
+def configure_fields(plan, domain, current_fields=None,
+        failed_schemes=()):
+    """Configures all of the fields in plan (a domain_plan.DomainPlan).
+    Called by main().
+
+    If current_fields (a dict as returned by fetch_current_state) is given,
+    fields that already match it are left alone. Fields that use one of
+    failed_schemes are not defined and count as failures.
+
+    Returns a tuple (num_defined, failed_fields) with the number of fields
+    that were (or would have been) defined and the names of the fields that
+    couldn't be.
+    """
+    logging.debug("Planned fields: %r", [field.name for field in plan.fields])
 
-                field_arguments.append(cloned_arguments)
-        else:
-            if analysis_scheme:
-                new_arguments += ["--analysis-scheme", analysis_scheme]
+    names = []
+    commands = []
+    failed_fields = []
+    for field in plan.fields:
+        if (current_fields is not None and field.name in current_fields and
+                field_is_current(field, current_fields[field.name])):
+            logging.debug("Field %r is unchanged.", field.name)
+            continue
 
-            new_arguments += ["--name", field["name"]]
+        if field.analysis_scheme in failed_schemes:
+            logging.error("Not configuring field %r because its analysis "
+                "scheme %r could not be configured.", field.name,
+                field.analysis_scheme)
+            failed_fields.append(field.name)
+            continue
 
-            field_arguments.append(new_arguments)
+        logging.info("Configuring field %r.", field.name)
 
-    for i in field_arguments:
-        # The name is always the last item in the sublist (hacky)
-        name = i[-1]
-        logging.info("Configuring field %r.", name)
+        command = ["aws", "cloudsearch", "define-index-field",
+            "--domain-name", domain] + field.define_arguments()
 
-        command = ["aws", "cloudsearch", "define-index-field", 
-            "--domain-name", domain] + i
+        names.append(field.name)
+        commands.append((command,
+            "Could not configure field {}.".format(field.name)))
+
+    results = maybe_execute_commands(commands)
+    failed_fields += [name for name, ok in zip(names, results) if not ok]
+
+    return (len(commands), failed_fields)
 
-        maybe_execute_command(command,
-            "Could not configure field {}.".format(name))
 
+def normalize_analysis_options(analysis_options):
+    """Decodes the options that CloudSearch stores as JSON strings so they
+    can be compared regardless of how they were serialized."""
+    normalized = dict(analysis_options)
+    for key in JSON_ANALYSIS_OPTIONS & set(normalized):
+        if isinstance(normalized[key], basestring):
+            normalized[key] = json.loads(normalized[key])
 
-def make_scheme_arg(scheme):
-    if 'Stopwords' in scheme['AnalysisOptions']:
-        stopwords_file = scheme['AnalysisOptions']['Stopwords']
-        with open(stopwords_file) as f:
-            raw = f.read()
-        stopwords_list = yaml.load(raw)
-        scheme['AnalysisOptions']['Stopwords'] = json.dumps(stopwords_list)
+    return normalized
 
-    return json.dumps(scheme)
 
+def scheme_is_current(scheme, current_entry):
+    """Returns True if current_entry (from describe-analysis-schemes) already
+    matches scheme, which must be the decoded argument of a
+    domain_plan.SchemeSpec."""
+    current_options = current_entry["Options"]
+    if (current_options.get("AnalysisSchemeLanguage") !=
+            scheme["AnalysisSchemeLanguage"]):
+        return False
 
-def configure_analysis_schemes(config, domain):
-    """Configures all of the analysis schemes. Called by main()."""
-    analysis_schemes = config["analysis_schemes"]
-    logging.debug("Loaded analysis schemes %r.", analysis_schemes)
+    desired = normalize_analysis_options(scheme["AnalysisOptions"])
+    current = normalize_analysis_options(
+        current_options.get("AnalysisOptions", {}))
+    for key, value in desired.iteritems():
+        if current.get(key) != value:
+            return False
 
-    for i in analysis_schemes:
-        logging.info("Configuring analysis scheme %r.", 
-            i["AnalysisSchemeName"])
+    return is_current(current_entry)
+
+
+def configure_analysis_schemes(plan, domain, current_schemes=None):
+    """Configures all of the analysis schemes in plan (a
+    domain_plan.DomainPlan). Called by main().
+
+    If current_schemes (a dict as returned by fetch_current_state) is given,
+    schemes that already match it are left alone.
+
+    Returns a tuple (num_defined, failed_schemes) with the number of schemes
+    that were (or would have been) defined and the names of the schemes that
+    couldn't be.
+    """
+    logging.debug("Planned analysis schemes: %r",
+        [scheme.name for scheme in plan.schemes])
+
+    names = []
+    commands = []
+    for scheme in plan.schemes:
+        name = scheme.name
+        scheme_arg = scheme.argument
+
+        if (current_schemes is not None and name in current_schemes and
+                scheme_is_current(json.loads(scheme_arg),
+                    current_schemes[name])):
+            logging.debug("Analysis scheme %r is unchanged.", name)
+            continue
+
+        logging.info("Configuring analysis scheme %r.", name)
 
         command = ["aws", "cloudsearch", "define-analysis-scheme",
             "--domain-name", domain,
-            "--analysis-scheme", make_scheme_arg(i)]
+            "--analysis-scheme", scheme_arg]
 
-        maybe_execute_command(command,
-            "Could not configure analysis scheme {}.".format(
-                i["AnalysisSchemeName"]))
+        names.append(name)
+        commands.append((command,
+            "Could not configure analysis scheme {}.".format(name)))
+
+    results = maybe_execute_commands(commands)
+    failed_schemes = [name for name, ok in zip(names, results) if not ok]
+
+    return (len(commands), failed_schemes)
 
 
 def reindex(domain, no_reindex):
@@ -274,15 +840,235 @@ def reindex(domain, no_reindex):
 
     command = ["aws", "cloudsearch", "index-documents", "--domain-name",
         domain]
-    logging.info("Running reindex.")
-    maybe_execute_command(command,
-            "Reindex failed.")
 
+    global last_reindex
+    with reindex_lock:
+        if reindex_stagger and last_reindex is not None:
+            delay = last_reindex + reindex_stagger - time.time()
+            if delay > 0:
+                logging.info("Waiting %ds to reindex (--reindex-stagger).",
+                    delay)
+                if not dry_run:
+                    time.sleep(delay)
+        last_reindex = time.time()
+
+        logging.info("Running reindex.")
+        maybe_execute_command(command,
+                "Reindex failed.")
+
+
+def wait_for_processing(domain, timeout):
+    """Waits until all of the domain's fields and analysis schemes are Active.
+
+    The domain is polled with a delay that backs off while nothing changes,
+    and every state change is logged with how long we've been waiting.
+
+    If CloudSearch failed to validate a field or scheme an error is logged
+    and `sys.exit` is called. If the domain still isn't ready after timeout
+    seconds, `sys.exit` is called with WAIT_TIMEOUT_EXIT_CODE.
+    """
+    if dry_run:
+        logging.info("Would wait for %r to finish processing.", domain)
+        return
 
-def main(options, domain, domain_config_path):
+    start = time.time()
+    delay = WAIT_MIN_DELAY
+    last_states = {}
+    while True:
+        fields, schemes = fetch_current_state(domain)
+        elapsed = time.time() - start
+
+        states = {}
+        for kind, entries in (("analysis scheme", schemes),
+                ("field", fields)):
+            for name, entry in entries.iteritems():
+                # These will go away once the domain is reindexed.
+                if not entry["Status"].get("PendingDeletion"):
+                    states[(kind, name)] = entry["Status"]["State"]
+
+        changed = False
+        for key, state in sorted(states.iteritems()):
+            if last_states.get(key) != state:
+                changed = True
+                logging.info("[%5ds] %s %r: %s", elapsed, key[0], key[1],
+                    state if key not in last_states else "{} -> {}".format(
+                        last_states[key], state))
+        last_states = states
+
+        failed = sorted(name for (kind, name), state in states.iteritems()
+            if state == "FailedToValidate")
+        if failed:
+            logging.error("CloudSearch could not validate %r, see the "
+                "console for details.", failed)
+            sys.exit(1)
+
+        not_ready = sorted(name for (kind, name), state in states.iteritems()
+            if state != "Active")
+        if not not_ready:
+            logging.info("%r finished processing after %ds.", domain,
+                elapsed)
+            return
+
+        if elapsed >= timeout:
+            logging.error("Gave up waiting for %r after %ds, still not "
+                "Active: %r.", domain, elapsed, not_ready)
+            sys.exit(WAIT_TIMEOUT_EXIT_CODE)
+
+        if changed:
+            delay = WAIT_MIN_DELAY
+        else:
+            delay = min(delay * 2, WAIT_MAX_DELAY)
+        time.sleep(min(delay, timeout - elapsed))
+
+
+def provision_domain(plan, domain, options):
+    """Configures (or with --check, checks) domain according to plan.
+
+    Returns a short description of what was done for the report. Like the
+    rest of this script, errors are logged and `sys.exit` is called.
+
+    The domain is only saved in the state cache once it's configured, so
+    if --wait fails (or times out) the next run tries it again:
+
+        >>> import fake_cloudsearch, shutil, tempfile
+        >>> fake = fake_cloudsearch.FakeCloudSearch()
+        >>> class FakeBackend(object):
+        ...     def run(self, command):
+        ...         operation, params, _ = (
+        ...             fake_cloudsearch.parse_cli_arguments(command[2:]))
+        ...         return fake.call(operation, params)
+        >>> provision_domain.__globals__["backend"] = FakeBackend()
+        >>> cache_dir = tempfile.mkdtemp()
+        >>> options, _, _ = parse_arguments(["--wait", "--state-cache-dir",
+        ...     cache_dir, "test", "domain-info.yaml"])
+        >>> # CloudSearch fails to validate a field whose scheme is missing.
+        >>> plan = domain_plan.DomainPlan((), (domain_plan.FieldSpec("title",
+        ...     "text", frozenset(["return"]), "missing", "title"),))
+        >>> provision_domain(plan, "test", options)
+        Traceback (most recent call last):
+            ...
+        SystemExit: 1
+        >>> print state_cache.load(cache_dir, "test")
+        None
+        >>> provision_domain.__globals__["backend"] = None
+        >>> shutil.rmtree(cache_dir)
+    """
+    if options.check:
+        if not check_domain(plan, domain, options):
+            sys.exit(DRIFT_EXIT_CODE)
+        return "matches the configuration"
+
+    if is_cached_as_configured(plan, domain, options):
+        logging.warning("%r was already configured with this configuration, "
+            "skipping it (--skip-configured).", domain)
+        return "skipped, already configured"
+
+    # Until we're done, we don't know what state the domain is in.
+    if not dry_run:
+        state_cache.forget(options.state_cache_dir, domain,
+            options.endpoint_url)
+
+    if options.only_changed:
+        current_fields, current_schemes = fetch_current_state(domain)
+    else:
+        current_fields, current_schemes = None, None
+
+    # The analysis schemes are all defined before any of the fields since
+    # fields can't reference schemes that don't exist yet.
+    num_schemes, failed_schemes = configure_analysis_schemes(plan, domain,
+        current_schemes)
+    num_fields, failed_fields = configure_fields(plan, domain,
+        current_fields, failed_schemes)
+
+    if failed_schemes or failed_fields:
+        logging.error("Could not configure analysis schemes %r and fields "
+            "%r, not reindexing.", failed_schemes, failed_fields)
+        sys.exit(1)
+
+    if options.only_changed and num_schemes + num_fields == 0 and (
+            not needs_reindex(current_fields.values() +
+                current_schemes.values())):
+        logging.info("Nothing changed, skipping the reindex.")
+        result = "nothing changed"
+    else:
+        if options.only_changed:
+            logging.info("%d analysis schemes and %d fields changed.",
+                num_schemes, num_fields)
+
+        reindex(domain, options.no_reindex)
+        result = "configured {} analysis schemes and {} fields{}".format(
+            num_schemes, num_fields,
+            ", not reindexed" if options.no_reindex else "")
+
+    if options.wait:
+        with metrics.timer("wait", domain=domain):
+            wait_for_processing(domain, options.wait_timeout)
+        result += ", ready"
+
+    # Only now do we know the domain is configured (wait_for_processing
+    # exits if it isn't). With --no-reindex the domain isn't done, so we'll
+    # want to get to it again next time.
+    if not dry_run and not options.no_reindex:
+        state_cache.save(options.state_cache_dir, domain, plan,
+            options.endpoint_url)
+
+    return result
+
+
+def provision_domains(plan, domains, options):
+    """Provisions all of domains concurrently, logging a report at the end.
+
+    Returns the exit status: 0 if everything went well, otherwise the status
+    of the worst failure (1 for errors, then WAIT_TIMEOUT_EXIT_CODE, then
+    DRIFT_EXIT_CODE).
+    """
+    def run(domain):
+        log_context.domain = domain
+        start = time.time()
+        try:
+            result = provision_domain(plan, domain, options)
+            status = 0
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+            result = {
+                DRIFT_EXIT_CODE: "does not match the configuration",
+                WAIT_TIMEOUT_EXIT_CODE: "timed out waiting for the reindex",
+            }.get(status, "FAILED")
+        except Exception:
+            logging.exception("Unexpected error.")
+            status = 1
+            result = "FAILED"
+        finally:
+            log_context.domain = None
+        elapsed = time.time() - start
+        metrics.observe("domain", elapsed, status == 0, domain=domain)
+        return (status, result, elapsed)
+
+    pool = multiprocessing.pool.ThreadPool(
+        min(options.parallel_domains, len(domains)))
+    try:
+        results = pool.map(run, domains)
+    finally:
+        pool.close()
+        pool.join()
+
+    logging.info("Report:")
+    width = max(len(domain) for domain in domains)
+    for domain, (status, result, elapsed) in zip(domains, results):
+        log = logging.info if status == 0 else logging.error
+        log("  %s  %s (%ds)", domain.ljust(width), result, elapsed)
+
+    statuses = set(status for status, _, _ in results) - {0}
+    for status in (WAIT_TIMEOUT_EXIT_CODE, DRIFT_EXIT_CODE):
+        if statuses == {status}:
+            return status
+    return 1 if statuses else 0
+
+
+def main(options, domains, domain_config_path):
     try:
         with open(domain_config_path, "r") as f:
-            config = yaml.load(f)
+            config = stopwords.yaml_load(f)
     except IOError:
         logging.exception("Could not read from file %r.", domain_config_path)
         sys.exit(1)
@@ -295,20 +1081,68 @@ def main(options, domain, domain_config_path):
     # directory that contains the config file.
     os.chdir(os.path.dirname(os.path.abspath(domain_config_path)))
 
-    global dry_run
+    try:
+        plan = domain_plan.build_plan(config)
+    except domain_plan.PlanError as e:
+        logging.error("Invalid configuration in %r: %s", domain_config_path,
+            e)
+        sys.exit(1)
+
+    global dry_run, jobs, max_retries, backend, reindex_stagger
     if options.dry_run:
         dry_run = True
+    jobs = options.jobs
+    max_retries = options.max_retries
+    reindex_stagger = options.reindex_stagger
+
+    if options.backend == "sdk":
+        backend = SdkBackend(options.endpoint_url,
+            max_pool_connections=options.jobs * min(options.parallel_domains,
+                len(domains)))
+    else:
+        backend = CliBackend(options.endpoint_url)
 
-    configure_analysis_schemes(config, domain)
-    configure_fields(config, domain)
-    reindex(domain, options.no_reindex)
+    if len(domains) == 1:
+        with metrics.timer("domain", domain=domains[0]):
+            provision_domain(plan, domains[0], options)
+    else:
+        status = provision_domains(plan, domains, options)
+        if status:
+            sys.exit(status)
+
+
+def write_metrics(options, status):
+    """Writes out the metrics of this run, if we were asked to."""
+    if options.dry_run:
+        return
+
+    metrics.set("exit_status", status)
+    metrics.set("last_run_timestamp_seconds", time.time())
+    try:
+        if options.metrics_file:
+            metrics.write_textfile(options.metrics_file)
+        if options.metrics_log:
+            metrics.write_json_lines(options.metrics_log)
+    except (IOError, OSError):
+        logging.exception("Could not write the metrics.")
 
 
 if __name__ == "__main__":
-    options, domain, domain_config_path = parse_arguments()
+    options, domains, domain_config_path = parse_arguments()
 
     setup_logging(options.verbose)
 
-    main(options, domain, domain_config_path)
+    metrics.describe("api_call", "How long each CloudSearch command took.")
+    metrics.describe("domain", "How long provisioning each domain took.")
+
+    status = 1
+    try:
+        main(options, domains, domain_config_path)
+        status = 0
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 1
+        raise
+    finally:
+        write_metrics(options, status)
 
     sys.exit(0)
@@ -0,0 +1,101 @@
+"""Remembers which DomainPlan was last applied to each CloudSearch domain.
+
+After provision-domain.py successfully configures a domain, it saves the
+plan it applied (and its digest) to DIRECTORY/<domain>.json. The next time
+it's asked to apply the same plan to that domain, it can then skip the
+domain without asking CloudSearch anything, as long as the entry is younger
+than a TTL (in case someone changed the domain from the console since).
+
+A domain reached through an --endpoint-url (such as fake_cloudsearch.py) is
+a different domain from the real one of the same name, so its entry is
+DIRECTORY/<domain>@<endpoint>.json instead.
+"""
+
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+
+DEFAULT_DIRECTORY = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "provision-domain")
+
+
+def _key(domain, endpoint_url):
+    """Returns the name of the cache entry of domain, as reached through
+    endpoint_url (None for the real CloudSearch).
+
+        >>> _key("test", "http://localhost:8001")
+        'test@localhost_8001'
+    """
+    if not endpoint_url:
+        return domain
+    endpoint = re.sub(r"^[a-z]+://", "", endpoint_url.rstrip("/"))
+    return "{}@{}".format(domain, re.sub(r"[^A-Za-z0-9.-]", "_", endpoint))
+
+
+def _path(directory, domain, endpoint_url):
+    return os.path.join(directory, "{}.json".format(
+        _key(domain, endpoint_url)))
+
+
+def load(directory, domain, endpoint_url=None):
+    """Returns the cache entry for domain, or None if there isn't one.
+
+    The entry is a dict with the "digest" of the last plan applied to the
+    domain, the "plan" itself and when it was "applied" (a unix time).
+    """
+    try:
+        with open(_path(directory, domain, endpoint_url)) as f:
+            entry = json.load(f)
+    except IOError:
+        return None
+    except ValueError:
+        logging.warning("Ignoring the corrupt state cache of %r.", domain)
+        return None
+
+    if not isinstance(entry, dict) or "digest" not in entry:
+        return None
+
+    return entry
+
+
+def save(directory, domain, plan, endpoint_url=None):
+    """Records that plan (a domain_plan.DomainPlan) was just applied to
+    domain. Failing to is logged, but is not an error."""
+    entry = {
+        "domain": domain,
+        "endpoint_url": endpoint_url,
+        "digest": plan.digest(),
+        "applied": time.time(),
+        "plan": plan.to_json(),
+    }
+
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, temp_path = tempfile.mkstemp(dir=directory,
+            prefix=_key(domain, endpoint_url), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f)
+        os.rename(temp_path, _path(directory, domain, endpoint_url))
+    except (IOError, OSError):
+        logging.warning("Could not save the state cache of %r.", domain,
+            exc_info=True)
+
+
+def forget(directory, domain, endpoint_url=None):
+    """Removes the cache entry for domain, if there is one."""
+    try:
+        os.unlink(_path(directory, domain, endpoint_url))
+    except OSError:
+        pass
+
+
+def is_fresh(entry, plan, ttl):
+    """Returns True if entry (from load) says that plan was applied less than
+    ttl seconds ago."""
+    return bool(entry and entry["digest"] == plan.digest() and
+        0 <= time.time() - entry.get("applied", 0) < ttl)
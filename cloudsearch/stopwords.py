@@ -0,0 +1,115 @@
+"""Loads the stop words dictionaries in dictionaries/, with a cache.
+
+Parsing YAML with PyYAML is slow (especially when its C extension isn't
+available), so the first time a dictionary is loaded its list of stop words
+is saved as JSON next to it, in DICTIONARY.cache.json. Later loads use the
+cache as long as the dictionary hasn't changed: if its size and mtime are
+the same as when the cache was written, or failing that, if the SHA-1 of its
+contents is. Otherwise the dictionary is parsed again and the cache
+rewritten.
+
+Dictionaries are also remembered in memory, so analysis schemes that share a
+dictionary only load it once.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import yaml
+
+# The C loader is much faster, but only exists if PyYAML was built against
+# libyaml.
+try:
+    _YamlLoader = yaml.CSafeLoader
+except AttributeError:
+    _YamlLoader = yaml.SafeLoader
+
+# Bump this to invalidate every cache file if their format changes.
+CACHE_VERSION = 1
+
+CACHE_SUFFIX = ".cache.json"
+
+_memo = {}
+_memo_lock = threading.Lock()
+
+
+def yaml_load(stream):
+    """Parses a YAML document (a string or file) with the safe loader."""
+    return yaml.load(stream, Loader=_YamlLoader)
+
+
+def _read_cache(cache_path):
+    """Returns the contents of the cache file, or None if it's unusable."""
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        return None
+
+    if not isinstance(cache, dict) or cache.get("version") != CACHE_VERSION:
+        return None
+
+    return cache
+
+
+def _write_cache(cache_path, cache):
+    """Atomically replaces the cache file. Failing to is not an error, we'll
+    just have to parse the dictionary again next time."""
+    directory = os.path.dirname(cache_path)
+    try:
+        fd, temp_path = tempfile.mkstemp(dir=directory,
+            prefix=os.path.basename(cache_path), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(cache, f)
+        os.rename(temp_path, cache_path)
+    except (IOError, OSError):
+        logging.debug("Could not write the stop words cache %r.", cache_path,
+            exc_info=True)
+
+
+def _load_uncached(path):
+    stat = os.stat(path)
+    cache_path = path + CACHE_SUFFIX
+    cache = _read_cache(cache_path)
+    if (cache and cache["size"] == stat.st_size and
+            cache["mtime"] == stat.st_mtime):
+        return cache["stopwords"]
+
+    with open(path) as f:
+        raw = f.read()
+    sha1 = hashlib.sha1(raw).hexdigest()
+
+    if cache and cache["sha1"] == sha1:
+        # Only the mtime changed (ex: the file was checked out again), so
+        # the cache is still good. Update it so we don't hash it next time.
+        logging.debug("Stop words cache %r is current.", cache_path)
+        stopwords = cache["stopwords"]
+    else:
+        logging.debug("Parsing stop words dictionary %r.", path)
+        stopwords = yaml_load(raw)
+
+    _write_cache(cache_path, {
+        "version": CACHE_VERSION,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "sha1": sha1,
+        "stopwords": stopwords,
+    })
+    return stopwords
+
+
+def load(path):
+    """Returns the list of stop words in the dictionary at path.
+
+    The list is shared by everyone who loads the same dictionary, so it must
+    not be modified.
+    """
+    key = os.path.abspath(path)
+    with _memo_lock:
+        if key not in _memo:
+            _memo[key] = _load_uncached(key)
+
+        return _memo[key]
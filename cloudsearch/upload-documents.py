@@ -0,0 +1,513 @@
+#!/usr/bin/env python
+
+"""Uploads documents to CloudSearch domains, skipping the unchanged ones.
+
+Documents are read as JSON lines, one per line, in CloudSearch's own batch
+format plus the document's locale:
+
+    {"type": "add", "id": "video:123", "locale": "fr",
+     "fields": {"title": "...", "content": ["..."], "hash": "..."}}
+    {"type": "delete", "id": "video:456"}
+
+Fields that domain-info.yaml marks as locale_specific are renamed for the
+document's locale the same way provision-domain.py names them (ex: "title"
+becomes "title_fr"), so the documents don't need to know about them. Locales
+are normalized like in domain-info.yaml: lowercased, with anything that isn't
+a letter or digit turned into an underscore.
+
+Every document's `hash` field (or if it has none, a hash of its fields) is
+remembered for each endpoint, in ~/.cache/upload-documents/. Documents whose
+hash hasn't changed since they were last uploaded to an endpoint are skipped,
+as are deletes of documents already deleted from it. Pass --refresh to upload
+everything anyway.
+
+The rest are packed into batches as close to CloudSearch's 5 MB limit as
+they fit, which are uploaded to every endpoint at the same time, --jobs at a
+time. Reading stops while --jobs batches are waiting to be uploaded, so the
+documents are never all in memory. Batches that fail because the endpoint is
+throttling us or unavailable are retried with exponential backoff.
+
+Instructions
+------------
+
+Endpoints are given by URL or by a file containing one (like the ones in
+production-rpc/data). The endpoint's access policy must allow this machine to
+post documents to it.
+
+Example use:
+
+    $ ./upload-documents.py \
+        ../production-rpc/data/cloudsearch-publish-endpoint* < documents.jsonl
+
+To try it without touching a real domain, run it against fake_cloudsearch.py:
+
+    $ ./fake_cloudsearch.py --port 8001 &
+    $ ./upload-documents.py http://localhost:8001 < documents.jsonl
+"""
+
+import collections
+import hashlib
+import json
+import logging
+import multiprocessing.pool
+import optparse
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+import urlparse
+
+import domain_plan
+import stopwords
+
+# CloudSearch rejects batches larger than 5 MB and documents larger than 1 MB.
+MAX_BATCH_BYTES = 5 * 1024 * 1024
+MAX_DOCUMENT_BYTES = 1024 * 1024
+
+# The path of the document service's batch API on an endpoint.
+BATCH_PATH = "/2013-01-01/documents/batch"
+
+# HTTP statuses that mean the endpoint is throttling us or is temporarily
+# unavailable, so the batch is worth retrying.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+DEFAULT_INDEX_DIRECTORY = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "upload-documents")
+
+
+class DocumentError(ValueError):
+    """Raised when a document can't be uploaded."""
+    pass
+
+
+def parse_arguments(raw_args=sys.argv[1:]):
+    """Parses any command line arguments."""
+    parser = optparse.OptionParser(
+        usage="usage: %prog [OPTIONS] ENDPOINT...",
+        description="Uploads the documents read (as JSON lines) from stdin "
+            "to CloudSearch, skipping those that haven't changed.")
+
+    parser.add_option("-v", "--verbose", action="store_true", default=False,
+        help="If specified, DEBUG messages will be printed.")
+
+    parser.add_option("-n", "--dry-run", action="store_true", default=False,
+        help="If specified, batch the documents but don't upload them.")
+
+    parser.add_option("-i", "--input",
+        help="Read the documents from this file instead of stdin.")
+
+    default_config = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "domain-info.yaml")
+    parser.add_option("--config", default=default_config,
+        help="The domain configuration, for the locale specific fields. "
+            "Defaults to %default.")
+
+    parser.add_option("--index-dir", default=DEFAULT_INDEX_DIRECTORY,
+        help="Where to remember the hash of every document uploaded to each "
+            "endpoint. Defaults to %default.")
+
+    parser.add_option("--refresh", action="store_true", default=False,
+        help="If specified, upload every document, even those whose hash "
+            "hasn't changed.")
+
+    parser.add_option("-j", "--jobs", type="int", default=4,
+        help="The number of batches to upload at the same time, across all "
+            "endpoints. Defaults to %default.")
+
+    parser.add_option("--max-retries", type="int", default=5,
+        help="How many times to retry a batch that failed because the "
+            "endpoint was throttling us or unavailable. Defaults to "
+            "%default.")
+
+    parser.add_option("--timeout", type="int", default=120,
+        help="How many seconds to wait for an endpoint to answer. Defaults "
+            "to %default.")
+
+    options, args = parser.parse_args(raw_args)
+
+    if not args:
+        parser.error("You must specify at least one endpoint.")
+
+    if options.jobs < 1:
+        parser.error("--jobs must be at least 1.")
+
+    endpoints = []
+    for arg in args:
+        endpoint = read_endpoint(arg)
+        if not urlparse.urlparse(endpoint).netloc:
+            parser.error("Invalid endpoint {!r}.".format(arg))
+        if endpoint not in endpoints:
+            endpoints.append(endpoint)
+
+    return (options, endpoints)
+
+
+def read_endpoint(arg):
+    """Returns the endpoint URL given on the command line as arg: the URL
+    itself or a file containing it."""
+    if os.path.isfile(arg):
+        with open(arg) as f:
+            arg = f.read().strip()
+
+    if "://" not in arg:
+        arg = "http://" + arg
+
+    return arg.rstrip("/")
+
+
+def prepare_document(line, locale_fields):
+    """Turns a line of input into what we upload.
+
+    Returns a tuple (id, operation, hash) where operation is the document
+    operation as JSON and hash is the document's hash (None for deletes).
+    Raises DocumentError if the document is invalid.
+    """
+    try:
+        document = json.loads(line)
+    except ValueError as e:
+        raise DocumentError("Invalid JSON: {}".format(e))
+
+    if not isinstance(document, dict) or not document.get("id") or (
+            not isinstance(document["id"], basestring)):
+        raise DocumentError("Documents must be objects with a string id.")
+
+    if document.get("type") == "delete":
+        return (document["id"], json.dumps({"type": "delete",
+            "id": document["id"]}), None)
+    elif document.get("type") != "add":
+        raise DocumentError("Unknown type {!r} for {!r}.".format(
+            document.get("type"), document["id"]))
+
+    fields = document.get("fields") or {}
+    locale = document.get("locale")
+    if not isinstance(fields, dict):
+        raise DocumentError("The fields of {!r} must be an object.".format(
+            document["id"]))
+    if locale is not None and not isinstance(locale, basestring):
+        raise DocumentError("The locale of {!r} must be a string.".format(
+            document["id"]))
+
+    try:
+        fields = locale_fields.expand(fields, locale)
+    except domain_plan.FieldError as e:
+        raise DocumentError("{} ({!r})".format(e, document["id"]))
+
+    document_hash = fields.get("hash") or hashlib.sha1(
+        json.dumps(fields, sort_keys=True)).hexdigest()
+
+    operation = json.dumps({"type": "add", "id": document["id"],
+        "fields": fields})
+    if len(operation) > MAX_DOCUMENT_BYTES:
+        raise DocumentError("{!r} is larger than {} bytes.".format(
+            document["id"], MAX_DOCUMENT_BYTES))
+
+    return (document["id"], operation, document_hash)
+
+
+class HashIndex(object):
+    """The hashes of the documents uploaded to an endpoint, by id.
+
+    It's loaded from and saved to a JSON file, and can be updated by many
+    threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.hashes = json.load(f)
+        except IOError:
+            self.hashes = {}
+        except ValueError:
+            logging.warning("Ignoring the corrupt hash index %r.", path)
+            self.hashes = {}
+
+    def is_current(self, document_id, document_hash):
+        """Whether the document was last uploaded with this hash, or for
+        deletes (whose hash is None), whether it was last deleted."""
+        return (document_id in self.hashes and
+            self.hashes[document_id] == document_hash)
+
+    def update(self, batch):
+        """Records that batch (a Batch) was uploaded."""
+        with self.lock:
+            for document_id, document_hash in batch.adds:
+                self.hashes[document_id] = document_hash
+            for document_id in batch.deletes:
+                self.hashes[document_id] = None
+
+    def save(self):
+        """Atomically replaces the file. Failing to is logged, but is not an
+        error: we'll just upload some documents again next time."""
+        directory = os.path.dirname(self.path)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(fd, "w") as f, self.lock:
+                json.dump(self.hashes, f)
+            os.rename(temp_path, self.path)
+        except (IOError, OSError):
+            logging.warning("Could not save the hash index %r.", self.path,
+                exc_info=True)
+
+
+# A batch of documents to upload. body is the JSON array of operations, adds
+# is a list of (id, hash) pairs and deletes a list of ids.
+Batch = collections.namedtuple("Batch", ["body", "adds", "deletes"])
+
+
+class Batcher(object):
+    """Packs document operations into Batches of at most max_bytes."""
+
+    def __init__(self, max_bytes=MAX_BATCH_BYTES):
+        self.max_bytes = max_bytes
+        self._reset()
+
+    def _reset(self):
+        self.operations = []
+        self.size = 2   # The brackets around the array.
+        self.adds = []
+        self.deletes = []
+
+    def add(self, operation, document_id, document_hash):
+        """Adds an operation (from prepare_document) to the batch.
+
+        Returns the previous batch if this one didn't fit in it, otherwise
+        None.
+        """
+        full = None
+        if (self.operations and
+                self.size + len(operation) + 1 > self.max_bytes):
+            full = self.flush()
+
+        self.operations.append(operation)
+        self.size += len(operation) + (1 if len(self.operations) > 1 else 0)
+        if document_hash is None:
+            self.deletes.append(document_id)
+        else:
+            self.adds.append((document_id, document_hash))
+        return full
+
+    def flush(self):
+        """Returns the current batch (or None if it's empty) and starts a new
+        one."""
+        if not self.operations:
+            return None
+
+        batch = Batch("[" + ",".join(self.operations) + "]", self.adds,
+            self.deletes)
+        self._reset()
+        return batch
+
+
+class Endpoint(object):
+    """An endpoint we're uploading to, with its Batcher, HashIndex and
+    counts of what happened to its documents."""
+
+    def __init__(self, url, index_dir):
+        self.url = url
+        name = re.sub(r"[^A-Za-z0-9.-]+", "_", url.split("://", 1)[-1])
+        self.index = HashIndex(os.path.join(index_dir, name + ".json"))
+        self.batcher = Batcher()
+        self.counts = collections.Counter()
+        self.counts_lock = threading.Lock()
+
+    def count(self, key, n=1):
+        with self.counts_lock:
+            self.counts[key] += n
+
+
+def post_batch(url, body, timeout):
+    """Posts a batch to the endpoint at url, returning its decoded response.
+
+    Raises urllib2.URLError (or its subclass HTTPError) if it fails.
+    """
+    request = urllib2.Request(url + BATCH_PATH, body,
+        {"Content-Type": "application/json"})
+    return json.load(urllib2.urlopen(request, timeout=timeout))
+
+
+def upload_batch(endpoint, batch, options):
+    """Uploads batch to endpoint, retrying if it's throttled or unavailable.
+    Returns True if it succeeded."""
+    for attempt in xrange(options.max_retries + 1):
+        try:
+            response = post_batch(endpoint.url, batch.body, options.timeout)
+        except urllib2.HTTPError as e:
+            retry = e.code in RETRY_STATUSES
+            error = "HTTP {}: {}".format(e.code, e.read()[:1000])
+        except (urllib2.URLError, IOError) as e:
+            retry = True
+            error = str(e)
+        except ValueError as e:
+            retry = False
+            error = "Invalid response: {}".format(e)
+        else:
+            if response.get("status") == "success":
+                return True
+            retry = False
+            error = json.dumps(response.get("errors"))[:1000]
+
+        if not retry or attempt == options.max_retries:
+            logging.error("Could not upload a batch of %d documents to %s: "
+                "%s", len(batch.adds) + len(batch.deletes), endpoint.url,
+                error)
+            return False
+
+        # Exponential backoff with some jitter so that the workers don't
+        # all retry at the same moment.
+        delay = min(2 ** attempt, 30) * random.uniform(1, 1.5)
+        logging.warning("Retrying a batch to %s in %.1fs: %s", endpoint.url,
+            delay, error)
+        endpoint.count("retries")
+        time.sleep(delay)
+
+
+def upload_documents(lines, endpoints, locale_fields, options):
+    """Uploads the documents in lines (JSON strings) to all of endpoints.
+
+    Returns the number of documents and batches that failed.
+    """
+    pool = multiprocessing.pool.ThreadPool(options.jobs)
+    # Limits how many batches can be waiting for a worker: once they are all
+    # taken, we stop reading documents until one is uploaded.
+    slots = threading.BoundedSemaphore(options.jobs * 2)
+    failures = collections.Counter()
+    failures_lock = threading.Lock()
+
+    def upload(endpoint, batch):
+        try:
+            num_documents = len(batch.adds) + len(batch.deletes)
+            if upload_batch(endpoint, batch, options):
+                endpoint.index.update(batch)
+                endpoint.count("added", len(batch.adds))
+                endpoint.count("deleted", len(batch.deletes))
+                endpoint.count("batches")
+                endpoint.count("bytes", len(batch.body))
+            else:
+                endpoint.count("failed", num_documents)
+                with failures_lock:
+                    failures["documents"] += num_documents
+                    failures["batches"] += 1
+        except Exception:
+            logging.exception("Unexpected error uploading to %s.",
+                endpoint.url)
+            with failures_lock:
+                failures["batches"] += 1
+        finally:
+            slots.release()
+
+    def submit(endpoint, batch):
+        if batch is None:
+            return
+
+        if options.dry_run:
+            logging.info("Would upload %d documents (%d bytes) to %s.",
+                len(batch.adds) + len(batch.deletes), len(batch.body),
+                endpoint.url)
+            endpoint.count("added", len(batch.adds))
+            endpoint.count("deleted", len(batch.deletes))
+            endpoint.count("batches")
+            endpoint.count("bytes", len(batch.body))
+            return
+
+        slots.acquire()
+        pool.apply_async(upload, (endpoint, batch))
+
+    try:
+        for line_number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+
+            try:
+                document_id, operation, document_hash = prepare_document(
+                    line, locale_fields)
+            except DocumentError as e:
+                logging.error("Skipping line %d: %s", line_number, e)
+                with failures_lock:
+                    failures["documents"] += 1
+                continue
+
+            for endpoint in endpoints:
+                if not options.refresh and endpoint.index.is_current(
+                        document_id, document_hash):
+                    endpoint.count("unchanged")
+                    continue
+
+                submit(endpoint, endpoint.batcher.add(operation, document_id,
+                    document_hash))
+
+        for endpoint in endpoints:
+            submit(endpoint, endpoint.batcher.flush())
+    finally:
+        pool.close()
+        pool.join()
+        if not options.dry_run:
+            for endpoint in endpoints:
+                endpoint.index.save()
+
+    return failures
+
+
+def main(options, endpoints):
+    try:
+        with open(options.config) as f:
+            config = stopwords.yaml_load(f)
+    except IOError:
+        logging.exception("Could not read from file %r.", options.config)
+        sys.exit(1)
+
+    # Stop words dictionaries are relative to the configuration file.
+    config_dir = os.path.dirname(os.path.abspath(options.config))
+    input_path = options.input and os.path.abspath(options.input)
+    index_dir = os.path.abspath(options.index_dir)
+    cwd = os.getcwd()
+    os.chdir(config_dir)
+    try:
+        plan = domain_plan.build_plan(config)
+    except domain_plan.PlanError as e:
+        logging.error("Invalid configuration in %r: %s", options.config, e)
+        sys.exit(1)
+    finally:
+        os.chdir(cwd)
+
+    locale_fields = domain_plan.LocaleFields(plan)
+    targets = [Endpoint(url, index_dir) for url in endpoints]
+
+    start = time.time()
+    if input_path:
+        with open(input_path) as f:
+            failures = upload_documents(f, targets, locale_fields, options)
+    else:
+        failures = upload_documents(sys.stdin, targets, locale_fields,
+            options)
+
+    logging.info("Report (%ds):", time.time() - start)
+    for endpoint in targets:
+        counts = endpoint.counts
+        logging.info("  %s: %d added, %d deleted, %d unchanged, %d failed "
+            "(%d batches, %.1f MB, %d retries)", endpoint.url,
+            counts["added"], counts["deleted"], counts["unchanged"],
+            counts["failed"], counts["batches"],
+            counts["bytes"] / (1024.0 * 1024), counts["retries"])
+
+    if failures:
+        logging.error("%d documents and %d batches failed.",
+            failures["documents"], failures["batches"])
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    options, endpoints = parse_arguments()
+
+    logging.basicConfig(level=logging.DEBUG if options.verbose else
+        logging.INFO, format="%(levelname)s - %(message)s")
+
+    main(options, endpoints)
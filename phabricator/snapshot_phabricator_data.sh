@@ -4,28 +4,18 @@
 #
 # This assumes that the volume holding toby's data has a tag named
 # 'Name' with value 'phabricator data ...'  And that this volume is an
-# XFS volume.
+# XFS volume.  Since we use --freezedir, ec2-create-rolling-snapshot.py
+# complains if there is not exactly one such volume.
 
 set -e       # die if any command fails
 
-VOLUME=`ec2-describe-volumes \
-        -K ~/aws/pk-backup-role-account.pem \
-        -C ~/aws/cert-backup-role-account.pem \
-        | grep -e 'TAG.*phabricator data' \
-        | cut -f3`
-if [ `echo "$VOLUME" | wc -l` -ne 1 ]; then
-  echo "Cannot find a unique volume tagged with the name 'phabricator data'."
-  exit 1
-fi
-
 PATH="$PATH":/usr/bin       # for ec2-*.
 
 "$HOME/aws-config/phabricator/ec2-create-rolling-snapshot.py" \
     -m 16 \
     -d 'backup of phabricator data' \
-    -v "$VOLUME" \
+    --volume-tag 'Name=*phabricator data*' \
     --freezedir=/opt \
+    --metrics-log "$HOME/logs/aws-snapshot-metrics.jsonl" \
     -K ~/aws/pk-backup-role-account.pem \
     -C ~/aws/cert-backup-role-account.pem
-
-
@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+
+"""Report on the snapshots in ec2-create-rolling-snapshot.py's catalog.
+
+With --catalog, the snapshot tool keeps a local SQLite catalog of the
+snapshots it creates and deletes, synced with ec2 (see
+rolling_snapshot/catalog.py).  This answers questions about them
+without talking to ec2, e.g. the oldest and newest restorable point of
+every volume:
+    ec2-snapshot-catalog.py
+or every snapshot of a volume:
+    ec2-snapshot-catalog.py -d 'daily backup' -v vol-123456
+
+To relist everything from ec2, run the snapshot tool with
+--catalog-resync.
+"""
+
+import rolling_snapshot.catalog
+
+
+if __name__ == '__main__':
+    rolling_snapshot.catalog.main()
@@ -0,0 +1,496 @@
+#!/usr/bin/env python
+
+"""Watch a machine for OOM kills and filling disks, and mail root.
+
+This replaces the oom-detector and check-diskspace cron jobs.  It runs
+all the time (see etc/init/host-health-agent.conf), and does very
+little work per check:
+
+OOMs: kern.log is tailed, reading only what was appended since the last
+check.  Where we are in it (its inode and byte offset) is saved in
+--state-file, so restarting the agent neither misses OOMs nor reports
+old ones again.  When kern.log is rotated we finish reading the old
+file (from the handle we still have open, or from kern.log.1 after a
+restart) before starting on the new one.  An OOM is reported once its
+'Killed process' line shows up, with the kernel's messages about it.
+
+Disks: every --interval seconds we statvfs every mounted /dev
+filesystem, which costs no forks.  We alert when one is more than
+--threshold-pct full, like check-diskspace did, but also when at the
+rate it has been growing over the last --growth-window seconds it will
+be full within --fill-hours: that gives us time to act before it's at
+90%, and doesn't pester us about a disk that's at 91% but isn't
+growing.
+
+Every alert has a key (e.g. disk-full:/mnt), and an alert isn't sent
+again for --realert-hours after it was last sent, even across restarts.
+OOMs of the same command are deduplicated the same way, but for
+--oom-realert-minutes.  Alerts are mailed to --mailto through sendmail
+(root goes wherever /etc/aliases says), and printed.
+
+With --metrics-file, the agent's own metrics (disk usage and growth,
+OOMs, alerts sent and suppressed, bytes of kern.log read) are written
+there for the node-exporter textfile collector after every disk check.
+"""
+
+import argparse
+import collections
+import errno
+import io
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import ops_metrics
+
+
+# The lines that start and end the kernel's report of an OOM kill.
+OOM_START = 'invoked oom-killer'
+OOM_END = 'Killed process'
+
+# We never keep more than this many lines of one OOM report.
+MAX_OOM_LINES = 200
+
+
+class LogTailer(object):
+    """Read what is appended to a log file, surviving its rotation.
+
+    position() is (inode, offset) of the next byte to read; pass it back
+    to the constructor to pick up where we left off.
+    """
+    def __init__(self, path, inode=None, offset=None, metrics=None):
+        self.path = path
+        self.metrics = metrics
+        self._file = None
+        self._inode = inode
+        self._offset = offset
+        self._partial = ''
+
+    def position(self):
+        return (self._inode, self._offset)
+
+    def _count(self, name, n=1):
+        if self.metrics:
+            self.metrics.count(name, n)
+
+    def _open(self, path, offset):
+        # Not open(): once a stdio FILE has hit EOF, glibc keeps
+        # returning EOF, even after the file has grown.
+        try:
+            f = io.open(path, 'rb')
+        except IOError as why:
+            if why.errno != errno.ENOENT:
+                raise
+            return False
+        st = os.fstat(f.fileno())
+        if offset is None:
+            # The first time, we only care about what's new.
+            offset = st.st_size
+        elif offset > st.st_size:
+            # It was truncated (copytruncate): start over.
+            offset = 0
+        f.seek(offset)
+        self._file = f
+        self._inode = st.st_ino
+        self._offset = offset
+        return True
+
+    def _find_rotated(self):
+        """Return the path of the file we were reading, if it has been
+        rotated to path.1 since, else None."""
+        rotated = self.path + '.1'
+        try:
+            if os.stat(rotated).st_ino == self._inode:
+                return rotated
+        except OSError:
+            pass
+        return None
+
+    def _read(self):
+        """Return the complete lines appended to the open file."""
+        data = self._file.read()
+        self._offset += len(data)
+        self._count('log_bytes_read', len(data))
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        return lines
+
+    def _finish(self):
+        """Return the rest of the open file, which won't grow anymore,
+        and close it."""
+        lines = self._read()
+        if self._partial:
+            lines.append(self._partial)
+            self._partial = ''
+        self._file.close()
+        self._file = None
+        self._count('log_rotations')
+        return lines
+
+    def read_lines(self):
+        """Return the lines appended since the last call.
+
+            >>> import shutil, tempfile
+            >>> tmpdir = tempfile.mkdtemp()
+            >>> path = os.path.join(tmpdir, 'kern.log')
+            >>> def append(path, data):
+            ...     with open(path, 'a') as f:
+            ...         f.write(data)
+            >>> append(path, 'old\\n')
+            >>> tailer = LogTailer(path)
+            >>> tailer.read_lines()
+            []
+            >>> append(path, 'one\\ntw')
+            >>> tailer.read_lines()
+            ['one']
+            >>> append(path, 'o\\n')
+            >>> tailer.read_lines()
+            ['two']
+            >>> os.rename(path, path + '.1')
+            >>> append(path + '.1', 'three\\n')
+            >>> append(path, 'four\\n')
+            >>> tailer.read_lines()
+            ['three', 'four']
+            >>> shutil.rmtree(tmpdir)
+        """
+        lines = []
+        if self._file is None:
+            # Starting up: find where we left off.
+            offset = None
+            if self._inode is not None:
+                rotated = self._find_rotated()
+                if rotated:
+                    self._open(rotated, self._offset)
+                    lines.extend(self._finish())
+                    offset = 0
+                else:
+                    try:
+                        same = os.stat(self.path).st_ino == self._inode
+                    except OSError:
+                        same = False
+                    # If it's another file, we lost track of the old one.
+                    offset = self._offset if same else 0
+            if not self._open(self.path, offset):
+                return lines
+
+        lines.extend(self._read())
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            # Rotated, but not recreated yet: keep reading the old one.
+            return lines
+        if st.st_ino != self._inode:
+            lines.extend(self._finish())
+            if self._open(self.path, 0):
+                lines.extend(self._read())
+        elif st.st_size < self._offset:
+            # Truncated in place (copytruncate).
+            self._file.seek(0)
+            self._offset = 0
+            self._partial = ''
+            lines.extend(self._read())
+        return lines
+
+
+class OomDetector(object):
+    """Pick the OOM kills out of kern.log lines."""
+    def __init__(self):
+        self._report = None
+
+    def feed(self, lines):
+        """Return a list of the OOM reports (lists of lines) that the
+        lines complete."""
+        reports = []
+        for line in lines:
+            if OOM_START in line:
+                self._report = [line]
+            elif self._report is not None:
+                if len(self._report) < MAX_OOM_LINES:
+                    self._report.append(line)
+                if OOM_END in line:
+                    reports.append(self._report)
+                    self._report = None
+        return reports
+
+
+def killed_process(report):
+    """Return the name of the process an OOM report says was killed."""
+    # e.g. 'Killed process 1234 (mysqld) total-vm:...'
+    last = report[-1]
+    if '(' in last and ')' in last:
+        return last[last.index('(') + 1:last.index(')')]
+    return 'unknown'
+
+
+def mounted_filesystems():
+    """Return the mount points of the mounted /dev filesystems."""
+    mounts = []
+    with open('/proc/mounts') as f:
+        for line in f:
+            (device, mount_point) = line.split()[:2]
+            # /proc/mounts escapes spaces and such as octal.
+            mount_point = mount_point.decode('string_escape')
+            if device.startswith('/dev/') and mount_point not in mounts:
+                mounts.append(mount_point)
+    return mounts
+
+
+def disk_usage(mount_point):
+    """Return (bytes used, bytes available) the way df counts them."""
+    st = os.statvfs(mount_point)
+    used = (st.f_blocks - st.f_bfree) * st.f_frsize
+    return (used, st.f_bavail * st.f_frsize)
+
+
+class DiskWatcher(object):
+    """Track how full each filesystem is, and how fast it's filling."""
+    def __init__(self, threshold_pct, fill_hours, growth_window,
+                 metrics=None):
+        self.threshold_pct = threshold_pct
+        self.fill_hours = fill_hours
+        self.growth_window = growth_window
+        self.metrics = metrics
+        self._samples = {}      # mount point -> deque of (time, used)
+
+    def check(self, now=None):
+        """Return a list of (key, message) alerts."""
+        if now is None:
+            now = time.time()
+        alerts = []
+        for mount_point in mounted_filesystems():
+            try:
+                (used, available) = disk_usage(mount_point)
+            except OSError:
+                continue
+            if not used + available:
+                continue
+            pct = 100.0 * used / (used + available)
+            samples = self._samples.setdefault(mount_point,
+                                               collections.deque())
+            samples.append((now, used))
+            while samples and samples[0][0] < now - self.growth_window:
+                samples.popleft()
+            # Only trust the rate once we've watched for a while.
+            (then, used_then) = samples[0]
+            rate = None
+            if now - then >= self.growth_window / 2.0:
+                rate = (used - used_then) / (now - then)
+
+            if self.metrics:
+                self.metrics.set('disk_used_ratio', pct / 100,
+                                 mount=mount_point)
+                self.metrics.set('disk_available_bytes', available,
+                                 mount=mount_point)
+                if rate is not None:
+                    self.metrics.set('disk_growth_bytes_per_second', rate,
+                                     mount=mount_point)
+
+            if pct >= self.threshold_pct:
+                alerts.append(('disk-full:%s' % mount_point,
+                               '%s is %d%% full!' % (mount_point, pct)))
+            elif rate > 0 and available / rate < self.fill_hours * 3600:
+                alerts.append((
+                    'disk-growth:%s' % mount_point,
+                    '%s is %d%% full, and growing by %.1f MiB/hour: it will'
+                    ' be full in %.1f hours!'
+                    % (mount_point, pct, rate * 3600 / 2 ** 20,
+                       available / rate / 3600)))
+        return alerts
+
+
+def load_state(path):
+    try:
+        with open(path) as f:
+            state = json.load(f)
+        if isinstance(state, dict):
+            return state
+    except (IOError, ValueError):
+        pass
+    return {}
+
+
+def save_state(path, state):
+    """Replace the state file atomically."""
+    directory = os.path.dirname(path) or '.'
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    (fd, tmpfile) = tempfile.mkstemp(dir=directory,
+                                     prefix='.' + os.path.basename(path))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmpfile, path)
+
+
+def send_mail(mailto, subject, body):
+    message = 'To: %s\nSubject: %s\n\n%s\n' % (mailto, subject, body)
+    try:
+        p = subprocess.Popen(['/usr/sbin/sendmail', '-t'],
+                             stdin=subprocess.PIPE)
+        p.communicate(message)
+        if p.returncode == 0:
+            return
+    except OSError as why:
+        print 'Could not run sendmail: %s' % why
+    print 'Could not mail "%s" to %s' % (subject, mailto)
+
+
+class Alerter(object):
+    """Send alerts, but not the same one too often."""
+    def __init__(self, mailto, last_sent, metrics=None):
+        """last_sent maps alert keys to when they were last sent; it is
+        updated as we send them, for saving in the state file."""
+        self.mailto = mailto
+        self.last_sent = last_sent
+        self.metrics = metrics
+
+    def send(self, alerts, realert_seconds, now=None):
+        """Send those of alerts (a list of (key, message)) that weren't
+        sent within realert_seconds, all in one mail."""
+        if now is None:
+            now = time.time()
+        hostname = socket.gethostname()
+        to_send = []
+        for (key, message) in alerts:
+            kind = key.split(':', 1)[0]
+            if now - self.last_sent.get(key, 0) < realert_seconds:
+                if self.metrics:
+                    self.metrics.count('alerts_suppressed', kind=kind)
+                continue
+            self.last_sent[key] = now
+            to_send.append(message)
+            if self.metrics:
+                self.metrics.count('alerts', kind=kind)
+            print '[%s] %s: %s' % (time.strftime('%F %T'), hostname,
+                                   message.splitlines()[0])
+        if to_send and self.mailto:
+            send_mail(self.mailto, '%s: %s' % (
+                hostname, to_send[0].splitlines()[0]),
+                '\n\n'.join(to_send))
+
+    def forget_older_than(self, seconds, now=None):
+        """Drop the keys we don't need to remember anymore."""
+        if now is None:
+            now = time.time()
+        for (key, sent) in self.last_sent.items():
+            if now - sent > seconds:
+                del self.last_sent[key]
+
+
+def _terminate(signum, frame):
+    # So that we save our state on the way out.
+    sys.exit(0)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Watch for OOM kills and filling disks, and mail root.')
+    parser.add_argument('--kern-log', default='/var/log/kern.log',
+                        help='The kernel log to tail.  Default is'
+                             ' %(default)s')
+    parser.add_argument('--state-file',
+                        default='/var/lib/host-health-agent/state.json',
+                        help=('Where to remember our place in the kernel'
+                              ' log and which alerts we sent.  Default is'
+                              ' %(default)s'))
+    parser.add_argument('--mailto', default='root',
+                        help=('Who to mail alerts to, or "" to only print'
+                              ' them.  Default is %(default)s'))
+    parser.add_argument('--log-interval', type=float, default=10,
+                        help=('How often to check the kernel log, in'
+                              ' seconds.  Default is %(default)s'))
+    parser.add_argument('--interval', type=float, default=60,
+                        help=('How often to check the disks, in seconds.'
+                              '  Default is %(default)s'))
+    parser.add_argument('--threshold-pct', type=float, default=90,
+                        help=('Alert when a disk is fuller than this'
+                              ' percent.  Default is %(default)s'))
+    parser.add_argument('--fill-hours', type=float, default=24,
+                        help=('Alert when a disk will be full within this'
+                              ' many hours at the rate it is growing.'
+                              '  Default is %(default)s'))
+    parser.add_argument('--growth-window', type=float, default=3600,
+                        help=('How many seconds of history to compute the'
+                              ' growth rate over.  Default is %(default)s'))
+    parser.add_argument('--realert-hours', type=float, default=24,
+                        help=('How long to wait before sending the same'
+                              ' disk alert again.  Default is %(default)s'))
+    parser.add_argument('--oom-realert-minutes', type=float, default=10,
+                        help=('How long to wait before sending another'
+                              ' alert about OOMs killing the same command.'
+                              '  Default is %(default)s'))
+    parser.add_argument('--metrics-file',
+                        help=('If specified, write our metrics to this'
+                              ' file, in the format of the node-exporter'
+                              ' textfile collector.'))
+    parser.add_argument('--once', action='store_true',
+                        help='Check once, then exit.')
+    args = parser.parse_args()
+    if args.log_interval <= 0 or args.interval <= 0:
+        parser.error('--log-interval and --interval must be positive')
+
+    metrics = ops_metrics.Metrics('host_health')
+    metrics.describe('disk_used_ratio', 'How full each disk is, like df.')
+    metrics.describe('disk_growth_bytes_per_second',
+                     'How fast each disk has been filling up.')
+    metrics.describe('ooms', 'OOM kills seen in kern.log.')
+
+    state = load_state(args.state_file)
+    tailer = LogTailer(args.kern_log, state.get('inode'),
+                       state.get('offset'), metrics)
+    detector = OomDetector()
+    disks = DiskWatcher(args.threshold_pct, args.fill_hours,
+                        args.growth_window, metrics)
+    alerter = Alerter(args.mailto, state.get('alerts', {}), metrics)
+
+    signal.signal(signal.SIGTERM, _terminate)
+    saved_state = None
+    next_disk_check = 0
+    try:
+        while True:
+            now = time.time()
+            oom_alerts = []
+            for report in detector.feed(tailer.read_lines()):
+                command = killed_process(report)
+                metrics.count('ooms', command=command)
+                oom_alerts.append(('oom:%s' % command,
+                                   'OOM killed %s:\n%s'
+                                   % (command, '\n'.join(report))))
+            alerter.send(oom_alerts, args.oom_realert_minutes * 60, now)
+
+            if now >= next_disk_check:
+                alerter.send(disks.check(now), args.realert_hours * 3600,
+                             now)
+                next_disk_check = now + args.interval
+                alerter.forget_older_than(
+                    max(args.realert_hours * 3600,
+                        args.oom_realert_minutes * 60), now)
+                metrics.set('last_check_timestamp_seconds', now)
+                if args.metrics_file:
+                    metrics.write_textfile(args.metrics_file)
+
+            (inode, offset) = tailer.position()
+            new_state = {'inode': inode, 'offset': offset,
+                         'alerts': alerter.last_sent}
+            if new_state != saved_state:
+                save_state(args.state_file, new_state)
+                # A copy, since alerter.last_sent changes in place.
+                saved_state = json.loads(json.dumps(new_state))
+
+            if args.once:
+                break
+            time.sleep(args.log_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        (inode, offset) = tailer.position()
+        save_state(args.state_file, {'inode': inode, 'offset': offset,
+                                     'alerts': alerter.last_sent})
+
+
+if __name__ == '__main__':
+    main()
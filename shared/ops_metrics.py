@@ -0,0 +1,231 @@
+"""Timing and counting for our ops scripts, exported for graphing.
+
+A Metrics collects timers (how long each phase took), counters (e.g. of
+retries) and gauges while a script runs.  At the end the script writes
+them out as JSON lines appended to a log (one line for every timed
+event, then one line for the run), and/or as a file for the
+node-exporter textfile collector, so that Prometheus can graph them and
+alert on regressions.
+
+    metrics = ops_metrics.Metrics('ec2_snapshot')
+    with metrics.timer('freeze', volume=volume):
+        ...
+    metrics.count('retries', operation='delete_snapshot')
+    ec2 = ops_metrics.Instrumented(ec2, metrics)   # times every call
+    ...
+    metrics.write_json_lines(os.path.expanduser('~/logs/snapshot.jsonl'))
+    metrics.write_textfile('/var/lib/node-exporter/ec2_snapshot.prom')
+
+In the textfile every metric name is prefixed with the job, so timer
+'freeze' becomes ec2_snapshot_freeze_seconds.  Timers are exported as
+summaries (_sum and _count, plus a _max gauge), and a timer whose block
+raised also counts towards <name>_errors_total.  Counters get a _total
+suffix, and gauges are exported as they are.
+
+A Metrics can be shared by many threads.
+
+To use this from a machine's directory, symlink it next to the script
+that needs it (see shared/README).
+"""
+
+import contextlib
+import json
+import os
+import tempfile
+import threading
+import time
+import types
+
+
+def _escape_label_value(value):
+    return (unicode(value).encode('utf-8').replace('\\', '\\\\')
+            .replace('"', '\\"').replace('\n', '\\n'))
+
+
+def _format_labels(labels):
+    """Format a sorted tuple of (name, value) pairs the Prometheus way."""
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape_label_value(value))
+                             for (name, value) in labels)
+
+
+class Metrics(object):
+    """Timers, counters and gauges for one run of a script (the job)."""
+    def __init__(self, job):
+        self.job = job
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+        # All of these are keyed by (name, sorted tuple of labels).
+        self._timers = {}         # [count, total seconds, max seconds]
+        self._counters = {}
+        self._gauges = {}
+        self._help = {}
+        # What write_json_lines() writes, other than the summary.
+        self._events = []
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted((k, v) for (k, v) in labels.iteritems()
+                                   if v is not None)))
+
+    def describe(self, name, help_text):
+        """Set the HELP text of a metric in the textfile."""
+        self._help[name] = help_text
+
+    def observe(self, name, seconds, ok=True, **labels):
+        """Record that something took seconds.  ok is False if it failed."""
+        key = self._key(name, labels)
+        with self._lock:
+            stats = self._timers.setdefault(key, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            if not ok:
+                error_key = (name + '_errors', key[1])
+                self._counters[error_key] = (
+                    self._counters.get(error_key, 0) + 1)
+            self._events.append({'time': round(time.time(), 3),
+                                 'job': self.job, 'timer': name,
+                                 'seconds': round(seconds, 6), 'ok': ok,
+                                 'labels': dict(key[1])})
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Time the with-block.  It counts as failed if it raises."""
+        start = time.time()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self.observe(name, time.time() - start, ok, **labels)
+
+    def timed_iter(self, name, iterable, **labels):
+        """Yield from iterable, timing how long it takes to exhaust.
+
+        The time the caller spends between items counts too.
+        """
+        with self.timer(name, **labels):
+            for item in iterable:
+                yield item
+
+    def count(self, name, n=1, **labels):
+        """Add n to a counter."""
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + n
+
+    def set(self, name, value, **labels):
+        """Set a gauge."""
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def write_json_lines(self, path):
+        """Append every timed event, and then a summary of the run, to path.
+
+        Each line is a JSON object with at least 'time' and 'job'.  The
+        summary line has 'run_seconds' and the 'counters' and 'gauges'.
+        """
+        with self._lock:
+            lines = [json.dumps(event, sort_keys=True)
+                     for event in self._events]
+            summary = {'time': round(time.time(), 3), 'job': self.job,
+                       'run_seconds': round(time.time() - self.start_time, 3),
+                       'counters': [dict(labels, name=name, value=value)
+                                    for ((name, labels), value)
+                                    in sorted(self._counters.iteritems())],
+                       'gauges': [dict(labels, name=name, value=value)
+                                  for ((name, labels), value)
+                                  in sorted(self._gauges.iteritems())]}
+            lines.append(json.dumps(summary, sort_keys=True))
+        with open(path, 'a') as f:
+            f.write(''.join(line + '\n' for line in lines))
+
+    def _textfile_lines(self):
+        # full name -> (type, our name, [(suffix, labels, value)])
+        families = {}
+
+        def add(full_name, metric_type, name, suffix, labels, value):
+            families.setdefault(full_name, (metric_type, name, []))[2].append(
+                (suffix, labels, value))
+
+        with self._lock:
+            for ((name, labels), (count, total, longest)) in (
+                    self._timers.iteritems()):
+                full_name = '%s_%s_seconds' % (self.job, name)
+                add(full_name, 'summary', name, '_sum', labels, total)
+                add(full_name, 'summary', name, '_count', labels, count)
+                add(full_name + '_max', 'gauge', name, '', labels, longest)
+            for ((name, labels), value) in self._counters.iteritems():
+                add('%s_%s_total' % (self.job, name), 'counter', name, '',
+                    labels, value)
+            for ((name, labels), value) in self._gauges.iteritems():
+                add('%s_%s' % (self.job, name), 'gauge', name, '', labels,
+                    value)
+
+        lines = []
+        for full_name in sorted(families):
+            (metric_type, name, samples) = families[full_name]
+            if name in self._help:
+                lines.append('# HELP %s %s' % (full_name, self._help[name]))
+            lines.append('# TYPE %s %s' % (full_name, metric_type))
+            for (suffix, labels, value) in sorted(
+                    samples, key=lambda sample: (sample[1], sample[0])):
+                lines.append('%s%s%s %s' % (full_name, suffix,
+                                            _format_labels(labels),
+                                            repr(float(value))))
+        return lines
+
+    def write_textfile(self, path):
+        """Write everything to path, for the node-exporter textfile
+        collector.  The file is replaced atomically."""
+        lines = self._textfile_lines()
+        (fd, tmpfile) = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                         prefix='.' + os.path.basename(path))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(''.join(line + '\n' for line in lines))
+            # node-exporter usually runs as some other user.
+            os.chmod(tmpfile, 0644)
+            os.rename(tmpfile, path)
+        except:
+            os.unlink(tmpfile)
+            raise
+
+
+class Instrumented(object):
+    """Wrap an object, timing every call of its public methods.
+
+    Each call is recorded with the timer name (api_call by default),
+    with the method's name as its 'operation' label, plus labels.  If a
+    method returns a generator, the time to exhaust it is recorded
+    instead, so lazily-paginated listings are timed properly.
+    """
+    def __init__(self, wrapped, metrics, name='api_call', **labels):
+        self._wrapped = wrapped
+        self._metrics = metrics
+        self._name = name
+        self._labels = labels
+
+    def __getattr__(self, attr):
+        value = getattr(self._wrapped, attr)
+        if attr.startswith('_') or not callable(value):
+            return value
+
+        labels = dict(self._labels, operation=attr)
+
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                result = value(*args, **kwargs)
+            except:
+                self._metrics.observe(self._name, time.time() - start,
+                                      False, **labels)
+                raise
+            if isinstance(result, types.GeneratorType):
+                return self._metrics.timed_iter(self._name, result, **labels)
+            self._metrics.observe(self._name, time.time() - start, **labels)
+            return result
+        return timed
@@ -0,0 +1,18 @@
+"""Rolling snapshots of ec2 EBS volumes.
+
+This is the library behind ec2-create-rolling-snapshot.py (see it for
+what the tool does), simulate-rolling-snapshots.py and
+ec2-snapshot-catalog.py:
+
+    backends:    talking to ec2, with the ec2-* binaries or with boto3.
+    retention:   retention policies, and which snapshots they keep.
+    snapshots:   creating new snapshots and deleting old ones.
+    catalog:     a local SQLite catalog of our snapshots, synced with ec2.
+    replication: copying snapshots to other regions.
+    cli:         the command line interface of the snapshot tool.
+    simulator:   an in-memory ec2, to simulate and benchmark retention.
+
+Nothing is imported here, so that the tool only pays for what it uses:
+boto3 is only imported by the sdk backend, sqlite3 only with --catalog
+and replication only with --copy-to-region.
+"""
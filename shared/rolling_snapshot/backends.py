@@ -0,0 +1,342 @@
+"""Talking to ec2: listing, creating and deleting snapshots.
+
+There are two backends with the same interface: CliBackend runs the
+ec2-* binaries, and SdkBackend uses boto3 in-process (which is only
+imported if it's used).  Only SdkBackend can copy snapshots to other
+regions.
+"""
+
+import collections
+import datetime
+import subprocess
+
+
+# ec2 error codes that mean a request is worth retrying.
+TRANSIENT_ERROR_CODES = ('RequestLimitExceeded', 'Throttling',
+                         'InternalError', 'Unavailable',
+                         'ServiceUnavailable')
+
+# ec2 error codes that mean a snapshot can't be deleted, but that it's
+# not our problem: it's already gone, or an AMI is using it.
+UNDELETABLE_ERROR_CODES = ('InvalidSnapshot.NotFound',
+                           'InvalidSnapshot.InUse')
+
+
+# The tags copy_snapshot() puts on copies, to say what they are a copy of.
+# The copies keep the description of their source, so that they are part
+# of the same snapshot series.
+SOURCE_VOLUME_TAG = 'rolling-snapshot:source-volume'
+SOURCE_SNAPSHOT_TAG = 'rolling-snapshot:source-snapshot'
+SOURCE_START_TIME_TAG = 'rolling-snapshot:source-start-time'
+_TAG_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+class TransientError(Exception):
+    """An ec2 request failed, but is worth retrying."""
+    pass
+
+
+class UndeletableSnapshotError(Exception):
+    """A snapshot can't be deleted, and we should leave it be.
+
+    gone is True if that's because it doesn't exist (anymore).
+    """
+    def __init__(self, message, gone=False):
+        super(UndeletableSnapshotError, self).__init__(message)
+        self.gone = gone
+
+
+def _raise_ec2_error(code, message):
+    """Raise the right exception for an ec2 error code."""
+    if code in TRANSIENT_ERROR_CODES:
+        raise TransientError(message)
+    if code in UNDELETABLE_ERROR_CODES:
+        raise UndeletableSnapshotError(
+            message, gone=code == 'InvalidSnapshot.NotFound')
+    raise RuntimeError(message)
+
+
+class Snapshot(collections.namedtuple(
+        'Snapshot', ('id', 'volume', 'start_time', 'state', 'size'))):
+    """An existing snapshot.  start_time is a datetime in UTC, and size
+    is the size of its volume in GiB, or None if we don't know it."""
+    __slots__ = ()
+
+    def __new__(cls, id, volume, start_time, state, size=None):
+        return super(Snapshot, cls).__new__(cls, id, volume, start_time,
+                                            state, size)
+
+    def __str__(self):
+        return '%s (%s)' % (self.id,
+                            self.start_time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+
+class CliBackend(object):
+    """Talks to ec2 by running the ec2-* binaries."""
+    def __init__(self, ec2_arglist):
+        """ec2_arglist is passed directly to every ec2-* command."""
+        self.ec2_arglist = ec2_arglist
+
+    def prepare(self, volume):
+        """Nothing to do: every ec2-* command starts from scratch."""
+        pass
+
+    def describe_volumes_by_tag(self, tag, value):
+        """Return the ids of the volumes whose tag matches value.
+
+        value may contain the wildcards * and ?.
+        """
+        output = subprocess.check_output(
+            ['ec2-describe-volumes', '--hide-tags',
+             '--filter', 'tag:%s=%s' % (tag, value)]
+            + self.ec2_arglist)
+        return [line.split('\t')[1] for line in output.splitlines()
+                if line.startswith('VOLUME\t')]
+
+    def describe_snapshots(self, volumes, description):
+        """Yield a Snapshot for each of our snapshots of volumes.
+
+        The filtering is done by ec2, and the output is parsed as it
+        arrives rather than all at once.
+        """
+        volume_filters = []
+        for volume in volumes:
+            volume_filters.extend(['--filter', 'volume-id=%s' % volume])
+        command = (['ec2-describe-snapshots', '--hide-tags', '-o', 'self']
+                   + volume_filters
+                   + ['--filter', 'description=%s' % description]
+                   + self.ec2_arglist)
+        p = subprocess.Popen(command, stdout=subprocess.PIPE)
+        for line in iter(p.stdout.readline, ''):
+            (snapshot, snapshot_description) = self._parse_snapshot(line)
+            # The filters treat * and ? as wildcards, so we double-check.
+            if (snapshot.volume in volumes and
+                    snapshot_description == description):
+                yield snapshot
+        if p.wait() != 0:
+            raise subprocess.CalledProcessError(p.returncode, command)
+
+    @staticmethod
+    def _parse_snapshot(line):
+        """Return (Snapshot, description) for a line of
+        ec2-describe-snapshots output."""
+        (unused_type, snapshot_id, volume_id, status, date,
+         unused_pct, unused_owner_id, volume_size,
+         snapshot_description) = line.rstrip('\n').split('\t')
+        # date is in format 'YYYY-MM-DDTHH:MM:SS+0000'
+        return (Snapshot(snapshot_id, volume_id,
+                         datetime.datetime.strptime(date[:19],
+                                                    '%Y-%m-%dT%H:%M:%S'),
+                         status,
+                         int(volume_size) if volume_size.isdigit() else None),
+                snapshot_description)
+
+    def describe_snapshot(self, snapshot_id):
+        """Return the Snapshot with id snapshot_id, as it is now."""
+        output = subprocess.check_output(['ec2-describe-snapshots',
+                                          '--hide-tags']
+                                         + self.ec2_arglist + [snapshot_id])
+        for line in output.splitlines():
+            if line.startswith('SNAPSHOT\t%s\t' % snapshot_id):
+                return self._parse_snapshot(line)[0]
+        raise RuntimeError('Unexpected output from ec2-describe-snapshots:'
+                           ' "%s"' % output)
+
+    def incremental_size(self, base_snapshot_id, snapshot_id):
+        """Only the sdk backend can tell; see SdkBackend."""
+        return None
+
+    def create_snapshot(self, volume, description):
+        """Return (snapshot-id, state) of the newly created snapshot."""
+        output = subprocess.check_output(['ec2-create-snapshot',
+                                          '-d', description]
+                                         + self.ec2_arglist + [volume])
+        # Output is, e.g.
+        # SNAPSHOT\tsnap-e1cc35a1\tvol-06f30e77\tpending\t\
+        #    2013-02-05T00:08:06+0000759597320137\t100\ttest snapshot
+        fields = output.split('\t')
+        if len(fields) < 4:
+            raise RuntimeError('Unexpected output from ec2-create-snapshot:'
+                               ' "%s"' % output)
+        return (fields[1], fields[3])
+
+    def delete_snapshot(self, snapshot_id):
+        p = subprocess.Popen(['ec2-delete-snapshot']
+                             + self.ec2_arglist + [snapshot_id],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (output, error_output) = p.communicate()
+        if p.returncode != 0:
+            # Errors are, e.g.
+            # Client.InvalidSnapshot.NotFound: The snapshot 'snap-1' does...
+            message = ('ec2-delete-snapshot %s failed: "%s"'
+                       % (snapshot_id, error_output.strip()))
+            for code in TRANSIENT_ERROR_CODES + UNDELETABLE_ERROR_CODES:
+                if '.%s:' % code in error_output:
+                    _raise_ec2_error(code, message)
+            raise RuntimeError(message)
+        # Output is, e.g.
+        # SNAPSHOT\tsnap-e1cc35a1
+        if output != 'SNAPSHOT\t%s\n' % snapshot_id:
+            raise RuntimeError('Unexpected output from ec2-delete-snapshot:'
+                               ' "%s"' % output)
+
+
+class SdkBackend(object):
+    """Talks to ec2 in-process, using boto3.
+
+    All requests share one client, and hence one set of credentials and
+    one pool of HTTP connections.  Credentials come from the usual boto3
+    places (environment, ~/.aws, or the instance's IAM role).
+    """
+    def __init__(self, region=None, endpoint_url=None):
+        # Imported here so the cli backend doesn't need boto3 installed.
+        import boto3
+        import botocore.exceptions
+        self._client_error = botocore.exceptions.ClientError
+        self._session = boto3.session.Session(region_name=region)
+        self.client = self._session.client('ec2', endpoint_url=endpoint_url)
+        self.region = self.client.meta.region_name
+        self._ebs_client = None
+
+    def in_region(self, region):
+        """Return a SdkBackend for region, with the same credentials."""
+        return SdkBackend(region=region)
+
+    def prepare(self, volume):
+        """Resolve credentials and open a connection before we need them."""
+        self.client.describe_snapshots(
+            Filters=[{'Name': 'volume-id', 'Values': [volume]}],
+            MaxResults=5)
+
+    def describe_volumes_by_tag(self, tag, value):
+        """Return the ids of the volumes whose tag matches value.
+
+        value may contain the wildcards * and ?.
+        """
+        response = self.client.describe_volumes(Filters=[
+            {'Name': 'tag:%s' % tag, 'Values': [value]},
+        ])
+        return [volume['VolumeId'] for volume in response['Volumes']]
+
+    @staticmethod
+    def _to_snapshot(snapshot):
+        return Snapshot(snapshot['SnapshotId'], snapshot['VolumeId'],
+                        datetime.datetime(*snapshot['StartTime']
+                                          .utctimetuple()[:6]),
+                        snapshot['State'], snapshot.get('VolumeSize'))
+
+    def describe_snapshots(self, volumes, description):
+        """Yield a Snapshot for each of our snapshots of volumes.
+
+        The filtering is done by ec2, and results are fetched a page at
+        a time as they are consumed.
+        """
+        pages = self.client.get_paginator('describe_snapshots').paginate(
+            OwnerIds=['self'],
+            Filters=[
+                {'Name': 'volume-id', 'Values': list(volumes)},
+                {'Name': 'description', 'Values': [description]},
+            ],
+            PaginationConfig={'PageSize': 1000})
+        for page in pages:
+            for snapshot in page['Snapshots']:
+                # The filters treat * and ? as wildcards, so we
+                # double-check.
+                if (snapshot['VolumeId'] in volumes and
+                        snapshot['Description'] == description):
+                    yield self._to_snapshot(snapshot)
+
+    def describe_snapshot(self, snapshot_id):
+        """Return the Snapshot with id snapshot_id, as it is now."""
+        response = self.client.describe_snapshots(SnapshotIds=[snapshot_id])
+        return self._to_snapshot(response['Snapshots'][0])
+
+    def incremental_size(self, base_snapshot_id, snapshot_id):
+        """Return how many bytes snapshot_id changed since base_snapshot_id.
+
+        This uses the EBS direct API, which the role may not be allowed
+        to use; if so we return None.
+        """
+        if self._ebs_client is None:
+            self._ebs_client = self._session.client('ebs')
+        num_bytes = 0
+        kwargs = {'FirstSnapshotId': base_snapshot_id,
+                  'SecondSnapshotId': snapshot_id,
+                  'MaxResults': 10000}
+        try:
+            while True:
+                response = self._ebs_client.list_changed_blocks(**kwargs)
+                num_bytes += (len(response.get('ChangedBlocks', []))
+                              * response.get('BlockSize', 0))
+                if not response.get('NextToken'):
+                    return num_bytes
+                kwargs['NextToken'] = response['NextToken']
+        except self._client_error as why:
+            print 'Could not get the size of %s: %s' % (snapshot_id, why)
+            return None
+
+    def create_snapshot(self, volume, description):
+        """Return (snapshot-id, state) of the newly created snapshot."""
+        response = self.client.create_snapshot(VolumeId=volume,
+                                               Description=description)
+        return (response['SnapshotId'], response['State'])
+
+    def copy_snapshot(self, source_region, snapshot, description):
+        """Start copying snapshot, a Snapshot in source_region, to our
+        region, and return the id of the copy.
+
+        The copy is tagged with where it came from, for
+        describe_copies().
+        """
+        response = self.client.copy_snapshot(
+            SourceRegion=source_region, SourceSnapshotId=snapshot.id,
+            Description=description,
+            TagSpecifications=[{'ResourceType': 'snapshot', 'Tags': [
+                {'Key': SOURCE_VOLUME_TAG, 'Value': snapshot.volume},
+                {'Key': SOURCE_SNAPSHOT_TAG, 'Value': snapshot.id},
+                {'Key': SOURCE_START_TIME_TAG,
+                 'Value': snapshot.start_time.strftime(_TAG_TIME_FORMAT)},
+            ]}])
+        return response['SnapshotId']
+
+    def describe_copies(self, volumes, description):
+        """Yield (Snapshot, source snapshot-id) for each copy that
+        copy_snapshot() made of the snapshots of volumes matching
+        description.
+
+        The Snapshot's volume and start_time are those of the source
+        snapshot, so that retention treats the copies like the
+        originals.
+        """
+        pages = self.client.get_paginator('describe_snapshots').paginate(
+            OwnerIds=['self'],
+            Filters=[
+                {'Name': 'tag:%s' % SOURCE_VOLUME_TAG,
+                 'Values': list(volumes)},
+                {'Name': 'description', 'Values': [description]},
+            ],
+            PaginationConfig={'PageSize': 1000})
+        for page in pages:
+            for snapshot in page['Snapshots']:
+                tags = dict((tag['Key'], tag['Value'])
+                            for tag in snapshot.get('Tags', []))
+                if (tags.get(SOURCE_VOLUME_TAG) not in volumes or
+                        snapshot['Description'] != description or
+                        SOURCE_SNAPSHOT_TAG not in tags):
+                    continue
+                try:
+                    start_time = datetime.datetime.strptime(
+                        tags.get(SOURCE_START_TIME_TAG), _TAG_TIME_FORMAT)
+                except (TypeError, ValueError):
+                    start_time = self._to_snapshot(snapshot).start_time
+                yield (Snapshot(snapshot['SnapshotId'],
+                                tags[SOURCE_VOLUME_TAG], start_time,
+                                snapshot['State'],
+                                snapshot.get('VolumeSize')),
+                       tags[SOURCE_SNAPSHOT_TAG])
+
+    def delete_snapshot(self, snapshot_id):
+        try:
+            self.client.delete_snapshot(SnapshotId=snapshot_id)
+        except self._client_error as e:
+            _raise_ec2_error(e.response.get('Error', {}).get('Code'), str(e))
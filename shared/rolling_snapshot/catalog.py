@@ -0,0 +1,245 @@
+"""A local catalog of our snapshots, so we don't list them all every run.
+
+Most of the snapshots a run of the tool sees are ones earlier runs
+created, and will later delete, themselves.  So rather than asking ec2
+for the whole history every time, the catalog (an SQLite file) records
+every snapshot we create and forgets every snapshot we delete, and a run
+only has to sync what may have changed behind our back:
+
+- pending snapshots are looked up again, one by one, since they are
+  the only ones whose state can still change;
+- each (volume, description) series is fully relisted from ec2 when it
+  isn't in the catalog yet, when its last full listing is older than
+  max_age (to pick up snapshots someone created or deleted by hand), or
+  when a resync is asked for.
+
+The catalog then answers retention decisions and reports (such as the
+oldest restorable point of each volume) without talking to ec2.  It is
+only a cache: deleting the file just means the next run relists
+everything.
+
+A Catalog can be shared by many threads.
+"""
+
+import datetime
+import os
+import threading
+import time
+
+from rolling_snapshot.backends import Snapshot
+
+
+DEFAULT_PATH = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'ec2-rolling-snapshot', 'catalog.sqlite')
+
+# How old (in seconds) a series' last full listing can get before we
+# list it again.
+DEFAULT_MAX_AGE = 7 * 24 * 3600
+
+# Bump this, and add to _SCHEMA, when the schema changes.
+SCHEMA_VERSION = 1
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS snapshots (
+    id TEXT PRIMARY KEY,
+    volume TEXT NOT NULL,
+    description TEXT NOT NULL,
+    start_time TEXT NOT NULL,
+    state TEXT NOT NULL,
+    size INTEGER,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS snapshots_by_volume
+    ON snapshots (volume, description, start_time);
+CREATE INDEX IF NOT EXISTS snapshots_by_time ON snapshots (start_time);
+CREATE TABLE IF NOT EXISTS syncs (
+    volume TEXT NOT NULL,
+    description TEXT NOT NULL,
+    synced REAL NOT NULL,
+    PRIMARY KEY (volume, description)
+);
+'''
+
+_INSERT_SNAPSHOT = ('INSERT OR REPLACE INTO snapshots'
+                    ' VALUES (?, ?, ?, ?, ?, ?, ?)')
+
+# start_time is stored in this format, which sorts chronologically.
+_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def _to_snapshot(row):
+    (snapshot_id, volume, start_time, state, size) = row
+    return Snapshot(snapshot_id, volume,
+                    datetime.datetime.strptime(start_time, _TIME_FORMAT),
+                    state, size)
+
+
+class Catalog(object):
+    """The snapshots in the SQLite file at path."""
+    def __init__(self, path=DEFAULT_PATH, max_age=DEFAULT_MAX_AGE):
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        # Only imported when a catalog is used: importing this module just
+        # for DEFAULT_PATH (as the snapshot tool does) shouldn't load it.
+        import sqlite3
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.executescript(_SCHEMA)
+            self._db.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def snapshots(self, volumes, description):
+        """Return a list of the Snapshots of volumes matching description,
+        oldest first."""
+        return [_to_snapshot(row) for row in self._query(
+            'SELECT id, volume, start_time, state, size FROM snapshots'
+            ' WHERE description = ? AND volume IN (%s)'
+            ' ORDER BY start_time, id' % ','.join('?' * len(volumes)),
+            [description] + list(volumes))]
+
+    def record(self, snapshot, description):
+        """Add (or update) snapshot, a Snapshot in series description."""
+        with self._lock, self._db:
+            self._db.execute(
+                _INSERT_SNAPSHOT,
+                (snapshot.id, snapshot.volume, description,
+                 snapshot.start_time.strftime(_TIME_FORMAT), snapshot.state,
+                 snapshot.size, time.time()))
+
+    def forget(self, snapshot_id):
+        """Remove a snapshot, e.g. because we deleted it."""
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM snapshots WHERE id = ?',
+                             (snapshot_id,))
+
+    def stale_volumes(self, volumes, description, now=None):
+        """Return those of volumes whose series needs a full listing."""
+        if now is None:
+            now = time.time()
+        synced = dict(self._query(
+            'SELECT volume, synced FROM syncs WHERE description = ?',
+            (description,)))
+        return [volume for volume in volumes
+                if not 0 <= now - synced.get(volume, -1) < self.max_age]
+
+    def _replace_series(self, volumes, description, snapshots):
+        """Replace everything we know of the series of volumes with
+        snapshots, an iterable of Snapshots listed from ec2."""
+        # List them before locking, so we don't block other threads
+        # while talking to ec2.
+        snapshots = list(snapshots)
+        now = time.time()
+        placeholders = ','.join('?' * len(volumes))
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM snapshots WHERE description = ?'
+                             ' AND volume IN (%s)' % placeholders,
+                             [description] + list(volumes))
+            self._db.executemany(
+                _INSERT_SNAPSHOT,
+                ((s.id, s.volume, description,
+                  s.start_time.strftime(_TIME_FORMAT), s.state, s.size, now)
+                 for s in snapshots))
+            self._db.executemany(
+                'INSERT OR REPLACE INTO syncs VALUES (?, ?, ?)',
+                ((volume, description, now) for volume in volumes))
+
+    def sync(self, volumes, description, ec2, full=False):
+        """Bring the series of volumes matching description up to date.
+
+        Series that are stale (see stale_volumes()), or all of them if
+        full is True, are listed from ec2 again, all in one listing.
+        The pending snapshots of the others are looked up one by one;
+        if one can't be, its series is relisted too.
+        """
+        stale = list(volumes) if full else self.stale_volumes(volumes,
+                                                              description)
+        fresh = [volume for volume in volumes if volume not in stale]
+        refreshed = 0
+        for snapshot in self.snapshots(fresh, description):
+            if snapshot.state != 'pending':
+                continue
+            try:
+                self.record(ec2.describe_snapshot(snapshot.id), description)
+                refreshed += 1
+            except Exception as why:
+                print 'Could not refresh %s, relisting %s: %s' % (
+                    snapshot, snapshot.volume, why)
+                if snapshot.volume not in stale:
+                    stale.append(snapshot.volume)
+
+        if stale:
+            self._replace_series(stale, description,
+                                 ec2.describe_snapshots(frozenset(stale),
+                                                        description))
+        print ('Catalog: relisted %d series, refreshed %d pending snapshots'
+               % (len(stale), refreshed))
+
+    def restore_points(self):
+        """Return, for every series, a tuple (volume, description,
+        number of snapshots, oldest completed start time, newest completed
+        start time, number of pending snapshots).
+
+        The start times are datetimes, or None if the series has no
+        completed snapshot.
+        """
+        rows = self._query(
+            "SELECT volume, description, COUNT(*),"
+            " MIN(CASE WHEN state = 'completed' THEN start_time END),"
+            " MAX(CASE WHEN state = 'completed' THEN start_time END),"
+            " SUM(state = 'pending')"
+            " FROM snapshots GROUP BY volume, description"
+            " ORDER BY volume, description")
+        return [(volume, description, count) +
+                tuple(t and datetime.datetime.strptime(t, _TIME_FORMAT)
+                      for t in (oldest, newest)) + (pending,)
+                for (volume, description, count, oldest, newest, pending)
+                in rows]
+
+
+def main(argv=None):
+    """Print a report of what the catalog knows, without talking to ec2."""
+    import argparse
+    parser = argparse.ArgumentParser(
+        description=('Report on the snapshots in the catalog of'
+                     ' ec2-create-rolling-snapshot.py --catalog.'))
+    parser.add_argument('--catalog', default=DEFAULT_PATH,
+                        help='The catalog file.  Default is %(default)s')
+    parser.add_argument('--volume', '-v', action='append', default=[],
+                        help=('List every snapshot of this volume instead.'
+                              '  Can be given more than once.'))
+    parser.add_argument('--description', '-d',
+                        help='With --volume, the series to list.')
+    args = parser.parse_args(argv)
+    if args.volume and not args.description:
+        parser.error('--volume needs --description')
+    if not os.path.exists(args.catalog):
+        parser.error('No catalog at %s' % args.catalog)
+
+    catalog = Catalog(args.catalog)
+    if args.volume:
+        for snapshot in catalog.snapshots(args.volume, args.description):
+            print '%s\t%s\t%s\t%s\t%s' % (
+                snapshot.volume, snapshot.id,
+                snapshot.start_time.strftime(_TIME_FORMAT), snapshot.state,
+                '' if snapshot.size is None else '%dGiB' % snapshot.size)
+        return
+
+    print 'volume\tdescription\tsnapshots\toldest\tnewest\tpending'
+    for (volume, description, count, oldest, newest, pending) in (
+            catalog.restore_points()):
+        print '%s\t%s\t%d\t%s\t%s\t%d' % (
+            volume, description, count,
+            oldest.strftime(_TIME_FORMAT) if oldest else '-',
+            newest.strftime(_TIME_FORMAT) if newest else '-', pending)
@@ -0,0 +1,255 @@
+"""The command line interface of ec2-create-rolling-snapshot.py."""
+
+import argparse
+import sys
+
+from rolling_snapshot.backends import CliBackend, SdkBackend
+from rolling_snapshot.catalog import DEFAULT_PATH as DEFAULT_CATALOG_PATH
+from rolling_snapshot.retention import default_retention, parse_retention
+from rolling_snapshot.snapshots import VolumeSpec, snapshot_volumes
+
+
+def parse_volume_spec(spec, retention, num_weekly, num_monthly):
+    """Parse VOLUME[:MAX_SNAPSHOTS[:WEEKLY[:MONTHLY]]] into a VolumeSpec.
+
+    If spec has MAX_SNAPSHOTS, the volume gets the default_retention()
+    for it, taking WEEKLY and MONTHLY from num_weekly and num_monthly if
+    they're not in spec.  Otherwise the volume gets retention.
+    """
+    parts = spec.split(':')
+    if len(parts) > 4:
+        raise ValueError('Too many fields in volume spec "%s"' % spec)
+    if len(parts) == 1:
+        return VolumeSpec(spec, retention)
+    defaults = [num_weekly, num_monthly]
+    numbers = [int(part) for part in parts[1:]] + defaults[len(parts) - 2:]
+    return VolumeSpec(parts[0], default_retention(*numbers))
+
+
+def main(argv=None):
+    """Run the tool with the arguments argv (sys.argv[1:] by default)."""
+    parser = argparse.ArgumentParser(
+        description='Create new snapshots and delete too-old snapshots.')
+    parser.add_argument('--description', '-d', required=True,
+                        help=('Identify related snapshots (related == share'
+                              ' a description).  Passed to ec2.'))
+    parser.add_argument('--dry_run', '-n', action='store_true',
+                        help='Say what we would do without doing it')
+    parser.add_argument('--volume', '-v', action='append', default=[],
+                        help=('volume-id of an EBS volume to snapshot.  Can'
+                              ' be given more than once.  Can be of the form'
+                              ' VOLUME:MAX_SNAPSHOTS[:WEEKLY[:MONTHLY]] to'
+                              ' override --max_snapshots and friends for'
+                              ' this volume.'))
+    parser.add_argument('--volume-tag',
+                        help=('Also snapshot all the EBS volumes with this'
+                              ' tag, given as KEY=VALUE.  VALUE may contain'
+                              ' the wildcards * and ?.'))
+    parser.add_argument('--max_snapshots', '-m', type=int,
+                        help=('The number of snapshots to keep.  You must'
+                              ' give this or --retention.'))
+    parser.add_argument('--max-weekly-snapshots', type=int,
+                        help=('How many weekly snapshots to take.  Must be'
+                              ' less than --max_snapshots.  Default is'
+                              ' max_snapshots / 4'))
+    parser.add_argument('--max-monthly-snapshots', type=int,
+                        help=('How many monthly snapshots to take.  Must be'
+                              ' less than --max_snapshots.  Default is'
+                              ' max_snapshots / 4'))
+    parser.add_argument('--retention',
+                        help=('Which snapshots to keep, instead of'
+                              ' --max_snapshots and friends: a comma-'
+                              'separated list of hourly=N, daily=N,'
+                              ' weekly=N, monthly=N, yearly=N (keep the'
+                              ' first snapshot of each of the last N'
+                              ' periods), newest=N (keep the newest N'
+                              ' snapshots) and within=N[hdw] (keep all'
+                              ' snapshots less than N hours/days/weeks'
+                              ' old).'))
+    parser.add_argument('--jobs', '-j', type=int, default=4,
+                        help=('How many volumes to snapshot at the same'
+                              ' time.  Default is %(default)s'))
+    parser.add_argument('--delete-jobs', type=int, default=4,
+                        help=('How many old snapshots to delete at the same'
+                              ' time, per volume.  Default is %(default)s'))
+    parser.add_argument('--delete-rate', type=float, default=5,
+                        help=('The most snapshots to delete per second.'
+                              '  Default is %(default)s'))
+    parser.add_argument('--freezedir',
+                        help=('If specified, call /sbin/fsfreeze on this'
+                              ' volume while snapshotting it.  You must'
+                              ' be able to sudo to root to use this.  Only'
+                              ' works when snapshotting a single volume.'))
+    parser.add_argument('--freeze-timeout', type=int, default=60,
+                        help=('Never keep --freezedir frozen for longer than'
+                              ' this many seconds.  Default is %(default)s'))
+    parser.add_argument('--metrics-file',
+                        help=('If specified, write how long each step took'
+                              ' (including how long --freezedir was frozen),'
+                              ' and how many retries and deletes we did, to'
+                              ' this file, in the format of the'
+                              ' node-exporter textfile collector.'))
+    parser.add_argument('--metrics-log',
+                        help=('If specified, append the same metrics to this'
+                              ' file as JSON lines, one for each step and'
+                              ' one for the whole run.'))
+    parser.add_argument('--wait-for-completion', action='store_true',
+                        help=('Wait for the new snapshot to complete before'
+                              ' deleting old ones, and never delete the'
+                              ' newest completed snapshot kept by each'
+                              ' retention rule.  Reports how long the'
+                              ' snapshot took and, with --backend=sdk, how'
+                              ' much it changed.'))
+    parser.add_argument('--completion-timeout', type=int, default=6 * 3600,
+                        help=('With --wait-for-completion, give up (and'
+                              ' delete nothing) if the snapshot is still'
+                              ' pending after this many seconds.  Default'
+                              ' is %(default)s'))
+    parser.add_argument('--catalog', nargs='?', const=DEFAULT_CATALOG_PATH,
+                        help=('Keep a catalog of our snapshots in this'
+                              ' SQLite file (default %s), and only'
+                              ' list the snapshots from ec2 that may have'
+                              ' changed since the last run.  A dry run'
+                              ' lists everything from ec2 and leaves the'
+                              ' catalog alone.' % DEFAULT_CATALOG_PATH))
+    parser.add_argument('--catalog-resync', action='store_true',
+                        help=('With --catalog, list all the snapshots from'
+                              ' ec2 again.'))
+    parser.add_argument('--catalog-max-age', type=float, default=7,
+                        help=('With --catalog, list all the snapshots of a'
+                              ' volume from ec2 again if they were last'
+                              ' listed this many days ago, to notice'
+                              ' snapshots created or deleted by hand.'
+                              '  Default is %(default)s'))
+    parser.add_argument('--copy-to-region', action='append', default=[],
+                        help=('After snapshotting, copy the completed'
+                              ' snapshots the retention policy keeps to this'
+                              ' region, and apply the same policy to the'
+                              ' copies there.  Can be given more than once.'
+                              '  Needs --backend=sdk.'))
+    parser.add_argument('--copy-jobs', type=int, default=5,
+                        help=('The most copies to have in flight to each'
+                              ' region.  Default is %(default)s'))
+    parser.add_argument('--copy-timeout', type=int, default=6 * 3600,
+                        help=('With --copy-to-region, stop waiting for'
+                              ' copies after this many seconds; the next'
+                              ' run picks up those still pending or not'
+                              ' started.  0 only starts copies.  Default is'
+                              ' %(default)s'))
+    parser.add_argument('--backend', choices=('cli', 'sdk'), default='cli',
+                        help=('How to talk to ec2: "cli" runs the ec2-*'
+                              ' binaries, "sdk" uses boto3 in-process.'
+                              '  Default is %(default)s'))
+    # max_daily_snapshots is always max_snapshots - weekly - monthly.
+    ec2_args = ('-K', '-C', '-U', '--region')
+    for ec2_arg in ec2_args:
+        parser.add_argument(ec2_arg, help='Passed directly to ec2 commands')
+
+    args = parser.parse_args(argv)
+    if not args.volume and not args.volume_tag:
+        parser.error('Must specify --volume or --volume-tag')
+    if args.volume_tag and '=' not in args.volume_tag:
+        parser.error('--volume-tag must look like KEY=VALUE')
+    if args.jobs < 1 or args.delete_jobs < 1:
+        parser.error('--jobs and --delete-jobs must be at least 1')
+    if args.delete_rate <= 0:
+        parser.error('--delete-rate must be positive')
+    if args.catalog_max_age < 0:
+        parser.error('--catalog-max-age must not be negative')
+    if args.catalog_resync and not args.catalog:
+        parser.error('--catalog-resync only works with --catalog')
+    if args.copy_to_region and args.backend != 'sdk':
+        parser.error('--copy-to-region only works with --backend=sdk')
+    if args.copy_jobs < 1 or args.copy_timeout < 0:
+        parser.error('--copy-jobs must be at least 1, and --copy-timeout'
+                     ' must not be negative')
+    if (args.max_snapshots is None) == (args.retention is None):
+        parser.error('Must specify exactly one of --max_snapshots and'
+                     ' --retention')
+    if args.retention and (args.max_weekly_snapshots is not None or
+                           args.max_monthly_snapshots is not None):
+        parser.error('--max-weekly-snapshots and --max-monthly-snapshots'
+                     ' only work with --max_snapshots')
+
+    if args.backend == 'sdk':
+        if args.K is not None or args.C is not None:
+            parser.error('-K and -C only work with --backend=cli; the sdk'
+                         ' backend gets its credentials from boto3.')
+        ec2 = SdkBackend(region=args.region, endpoint_url=args.U)
+    else:
+        ec2_arglist = []
+        for a in ec2_args:
+            a_varname = a.lstrip('-').replace('-', '_')
+            if getattr(args, a_varname, None) is not None:
+                ec2_arglist.append(a)                      # e.g. '--region'
+                ec2_arglist.append(getattr(args, a_varname))   # 'us-east1'
+        ec2 = CliBackend(ec2_arglist)
+
+    try:
+        if args.retention:
+            retention = parse_retention(args.retention)
+        else:
+            retention = default_retention(args.max_snapshots,
+                                          args.max_weekly_snapshots,
+                                          args.max_monthly_snapshots)
+        volume_specs = [parse_volume_spec(v, retention,
+                                          args.max_weekly_snapshots,
+                                          args.max_monthly_snapshots)
+                        for v in args.volume]
+    except ValueError as why:
+        parser.error(str(why))
+    if args.volume_tag:
+        (tag, value) = args.volume_tag.split('=', 1)
+        tagged_volumes = ec2.describe_volumes_by_tag(tag, value)
+        if not tagged_volumes:
+            parser.error('No volumes are tagged with %s' % args.volume_tag)
+        listed_volumes = set(spec.volume for spec in volume_specs)
+        volume_specs.extend(VolumeSpec(v, retention) for v in tagged_volumes
+                            if v not in listed_volumes)
+    if args.freezedir and len(volume_specs) != 1:
+        parser.error('--freezedir only works with a single volume, not %s'
+                     % ' '.join(spec.volume for spec in volume_specs))
+
+    metrics = None
+    if args.metrics_file or args.metrics_log:
+        import ops_metrics
+        metrics = ops_metrics.Metrics('ec2_snapshot')
+        metrics.describe('freeze', 'How long fsfreeze was held while'
+                         ' snapshotting.')
+        metrics.describe('api_call', 'How long each ec2 call took.')
+
+    catalog = None
+    if args.catalog and args.dry_run:
+        # Syncing would write to it, and without syncing it may be stale.
+        print '[DRY RUN] Not using the catalog, listing snapshots from ec2'
+    elif args.catalog:
+        from rolling_snapshot.catalog import Catalog
+        catalog = Catalog(args.catalog, args.catalog_max_age * 24 * 3600)
+
+    try:
+        failed = snapshot_volumes(volume_specs, args.description,
+                                  args.freezedir, ec2, args.dry_run,
+                                  args.jobs, args.freeze_timeout, metrics,
+                                  args.delete_jobs, args.delete_rate,
+                                  completion_timeout=(
+                                      args.completion_timeout
+                                      if args.wait_for_completion
+                                      else None),
+                                  catalog=catalog,
+                                  catalog_resync=args.catalog_resync)
+        if args.copy_to_region:
+            from rolling_snapshot.replication import replicate
+            regions = [region for region in args.copy_to_region
+                       if region != ec2.region]
+            failed += replicate(volume_specs, args.description, ec2,
+                                regions, args.dry_run, args.copy_jobs,
+                                args.copy_timeout, metrics, args.delete_jobs,
+                                args.delete_rate, catalog=catalog)
+    finally:
+        # Even if we crashed, how long things took until then is useful.
+        if metrics and not args.dry_run:
+            if args.metrics_file:
+                metrics.write_textfile(args.metrics_file)
+            if args.metrics_log:
+                metrics.write_json_lines(args.metrics_log)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,250 @@
+"""Copying snapshots to other regions, for disaster recovery.
+
+After the snapshot tool has snapshotted and pruned its volumes, each
+target region gets a copy of every completed snapshot that the
+retention policy keeps in the source region, and then the same policy
+is applied to the copies in the target region, independently.
+
+Copies are started as ec2 accepts them, but at most `jobs` at a time
+per region: ec2 limits how many copies can be in flight to a region.
+The regions are handled at the same time.  Everything we need to know
+about a copy is in its tags (see backends.SdkBackend.copy_snapshot()),
+so an interrupted run leaves nothing to clean up: the next run sees
+the copies still pending, waits for those, and only starts the ones
+that were never started.
+"""
+
+import datetime
+import time
+import traceback
+
+from rolling_snapshot.retention import as_datetime, classify_snapshots
+from rolling_snapshot.snapshots import (COMPLETION_MAX_DELAY,
+                                        COMPLETION_MIN_DELAY,
+                                        SnapshotDeleter, TokenBucket,
+                                        _thread_pool, all_snapshots,
+                                        delete_old_snapshots,
+                                        snapshots_by_volume)
+
+
+def copies_to_make(snapshots, copied, retention, today):
+    """Return the Snapshots of one volume that need copying, newest first.
+
+    snapshots is the volume's Snapshots in the source region, and copied
+    the set of the ids of those that were already copied (or are being
+    copied).  Only the completed snapshots that retention keeps at today
+    are worth copying.
+    """
+    completed = [s for s in snapshots if s.state == 'completed']
+    (keep, _) = classify_snapshots(completed, retention, as_datetime(today))
+    return sorted((snapshot for (snapshot, _) in keep
+                   if snapshot.id not in copied),
+                  key=lambda snapshot: snapshot.start_time, reverse=True)
+
+
+class RegionReplicator(object):
+    """Copies the snapshots of some volumes to one target region."""
+    def __init__(self, source_region, target, description, volume_specs,
+                 dry_run, jobs=5, timeout=6 * 3600, metrics=None,
+                 delete_jobs=4, delete_rate=5):
+        """Arguments:
+            source_region: the region the snapshots are in.
+            target: an SdkBackend for the region to copy them to.
+            description: the description of the snapshot series.
+            volume_specs: a list of VolumeSpecs: the volumes whose
+              snapshots to copy, and the retention policy for them.
+            dry_run: if True, just say what we'd do.
+            jobs: the most copies to have in flight to the region.
+            timeout: how many seconds to wait for copies to complete.
+              Those still pending after that are left for the next run
+              to wait for.  0 means just start copies, don't wait.
+            metrics: if not None, an ops_metrics.Metrics to count copies
+              in.
+            delete_jobs, delete_rate: like for snapshot_volumes(), for
+              pruning copies.
+        """
+        self.source_region = source_region
+        self.target = target
+        self.region = target.region
+        self.description = description
+        self.volume_specs = volume_specs
+        self.dry_run = dry_run
+        self.jobs = jobs
+        self.timeout = timeout
+        self.metrics = metrics
+        self.deleter = SnapshotDeleter(target, dry_run, delete_jobs,
+                                       TokenBucket(delete_rate),
+                                       metrics=metrics)
+
+    def _count(self, name):
+        if self.metrics and not self.dry_run:
+            self.metrics.count(name, region=self.region)
+
+    def _start_copy(self, snapshot):
+        """Start copying snapshot, and return the id of the copy (None on
+        a dry run)."""
+        if self.dry_run:
+            print '[DRY RUN] Copying %s of %s to %s' % (
+                snapshot, snapshot.volume, self.region)
+            return None
+        copy_id = self.target.copy_snapshot(self.source_region, snapshot,
+                                            self.description)
+        print 'Copying %s of %s to %s as %s' % (snapshot, snapshot.volume,
+                                                self.region, copy_id)
+        self._count('copies_started')
+        return copy_id
+
+    def replicate(self, snapshots_by_volume, today):
+        """Copy what's missing, wait for the copies, then prune.
+
+        snapshots_by_volume maps each volume to a list of its Snapshots
+        in the source region.  Returns the number of copies that
+        failed.
+        """
+        volumes = [spec.volume for spec in self.volume_specs]
+        copies = list(self.target.describe_copies(frozenset(volumes),
+                                                  self.description))
+        copied = set(source_id for (_, source_id) in copies)
+        todo = []
+        for spec in self.volume_specs:
+            todo.extend(copies_to_make(snapshots_by_volume[spec.volume],
+                                       copied, spec.retention, today))
+        # Newest first across volumes too, so every volume gets its
+        # latest restore point before we backfill older ones.
+        todo.sort(key=lambda snapshot: snapshot.start_time, reverse=True)
+        in_flight = [copy.id for (copy, _) in copies
+                     if copy.state == 'pending']
+        if in_flight:
+            print ('Resuming %d pending copies to %s'
+                   % (len(in_flight), self.region))
+
+        failed = self._copy_all(todo, in_flight)
+        # Failed copies are deleted, so that the next run tries again.
+        for (copy, _) in copies:
+            if copy.state not in ('pending', 'completed'):
+                print 'Copy %s in %s is "%s"' % (copy, self.region,
+                                                 copy.state)
+                failed.append(copy.id)
+        for copy_id in failed:
+            if not self.dry_run:
+                self.target.delete_snapshot(copy_id)
+        self._prune(volumes, today, set(failed))
+        return len(failed)
+
+    def _copy_all(self, todo, in_flight):
+        """Start the copies of the Snapshots in todo, at most self.jobs
+        in flight, counting the copy ids already in_flight.  Return the
+        ids of the copies that failed."""
+        failed = []
+        start = time.time()
+        delay = COMPLETION_MIN_DELAY
+        while True:
+            while todo and (self.dry_run or len(in_flight) < self.jobs):
+                copy_id = self._start_copy(todo.pop(0))
+                if copy_id:
+                    in_flight.append(copy_id)
+            if self.dry_run or not in_flight:
+                break
+            elapsed = time.time() - start
+            if elapsed >= self.timeout:
+                print ('%d copies to %s still pending and %d not started'
+                       ' after %d seconds; the next run will pick them up'
+                       % (len(in_flight), self.region, len(todo), elapsed))
+                break
+
+            time.sleep(min(delay, self.timeout - elapsed))
+            delay = min(delay * 2, COMPLETION_MAX_DELAY)
+            for copy_id in list(in_flight):
+                state = self.target.describe_snapshot(copy_id).state
+                if state == 'pending':
+                    continue
+                in_flight.remove(copy_id)
+                # A copy finishing frees a slot, so look again soon.
+                delay = COMPLETION_MIN_DELAY
+                if state == 'completed':
+                    print 'Copy %s to %s completed' % (copy_id, self.region)
+                    self._count('copies_completed')
+                else:
+                    print 'Copy %s to %s is "%s"' % (copy_id, self.region,
+                                                     state)
+                    self._count('copies_failed')
+                    failed.append(copy_id)
+        return failed
+
+    def _prune(self, volumes, today, ignored_ids):
+        """Apply each volume's retention policy to its copies."""
+        by_volume = dict((volume, []) for volume in volumes)
+        for (copy, _) in self.target.describe_copies(frozenset(volumes),
+                                                     self.description):
+            if copy.id not in ignored_ids:
+                by_volume[copy.volume].append(copy)
+        for spec in self.volume_specs:
+            summary = delete_old_snapshots(
+                by_volume[spec.volume], spec.retention, today, self.target,
+                self.dry_run, self.deleter,
+                '%s in %s' % (spec.volume, self.region),
+                protect_completed=True)
+            if summary.failed:
+                raise RuntimeError('Could not delete %s in %s' % (
+                    ', '.join(str(s) for s in summary.failed), self.region))
+
+
+def replicate(volume_specs, description, ec2, regions, dry_run, jobs=5,
+              timeout=6 * 3600, metrics=None, delete_jobs=4, delete_rate=5,
+              today=None, catalog=None):
+    """Copy the snapshots of volume_specs from ec2's region to each of
+    regions, at the same time, and prune the copies.
+
+    ec2 must be a SdkBackend.  The snapshots to copy are listed from it,
+    or from catalog (a catalog.Catalog) if given.  today is as for
+    snapshot_volumes().  See RegionReplicator for the other arguments.
+
+    Returns the list of regions that we failed to replicate to.  The
+    reason for each failure has already been printed.
+    """
+    if today is None:
+        today = datetime.datetime.utcnow()
+    volumes = [spec.volume for spec in volume_specs]
+    # Listed once for all the regions.
+    snapshots = snapshots_by_volume(
+        all_snapshots(volumes, description, ec2, catalog),
+        volumes)
+
+    def replicate_one(region):
+        start = time.time()
+        try:
+            target = ec2.in_region(region)
+            if metrics:
+                import ops_metrics
+                target = ops_metrics.Instrumented(target, metrics,
+                                                  region=region)
+            replicator = RegionReplicator(
+                ec2.region, target, description, volume_specs, dry_run,
+                jobs, timeout, metrics, delete_jobs, delete_rate)
+            num_failed = replicator.replicate(snapshots, today)
+            error = ('%d copies failed' % num_failed) if num_failed else None
+        except Exception:
+            error = traceback.format_exc()
+        if metrics:
+            metrics.observe('replication', time.time() - start, not error,
+                            region=region)
+        return error
+
+    if len(regions) == 1:
+        errors = map(replicate_one, regions)
+    else:
+        pool = _thread_pool(len(regions))
+        try:
+            errors = pool.map(replicate_one, regions)
+        finally:
+            pool.close()
+            pool.join()
+
+    failed = []
+    for (region, error) in zip(regions, errors):
+        if error:
+            print 'FAILED copying to %s:\n%s' % (region, error)
+            failed.append(region)
+        else:
+            print 'OK copying to %s' % region
+    return failed
@@ -0,0 +1,191 @@
+"""Retention policies: which snapshots to keep, and which to delete.
+
+This is pure computation on Snapshots, so it's cheap to import and to
+test (see simulator.py).
+"""
+
+import collections
+import datetime
+
+
+# The kinds of rules in a retention policy.  A period rule, like
+# daily=7, keeps the first snapshot taken in each of the last 7 days
+# (counting today).  Days start at midnight UTC, weeks on Sunday, months
+# on the 1st and years on January 1st, so when we snapshot once a day,
+# weekly snapshots are the Sunday ones and monthly snapshots are the
+# 1st-of-month ones.  newest=N keeps the N most recent snapshots, and
+# within=D keeps every snapshot less than D old.
+PERIOD_KINDS = ('hourly', 'daily', 'weekly', 'monthly', 'yearly')
+RETENTION_KINDS = PERIOD_KINDS + ('newest', 'within')
+
+# One rule of a retention policy.  count is a timedelta for 'within',
+# and a number for everything else.
+RetentionRule = collections.namedtuple('RetentionRule', ('kind', 'count'))
+
+_WITHIN_UNITS = {'h': datetime.timedelta(hours=1),
+                 'd': datetime.timedelta(days=1),
+                 'w': datetime.timedelta(weeks=1)}
+
+
+def parse_retention(spec):
+    """Parse e.g. 'daily=7,weekly=4,within=36h' into RetentionRules.
+
+    within takes a number of hours (h), days (d, the default) or weeks
+    (w); everything else takes a number of snapshots.
+    """
+    retention = []
+    for part in spec.split(','):
+        (kind, _, value) = part.strip().partition('=')
+        if kind not in RETENTION_KINDS:
+            raise ValueError('Unknown retention rule "%s": must be one of %s'
+                             % (part, ', '.join(RETENTION_KINDS)))
+        if kind in (rule.kind for rule in retention):
+            raise ValueError('Retention rule "%s" given twice' % kind)
+        unit = None
+        if kind == 'within' and value[-1:] in _WITHIN_UNITS:
+            (value, unit) = (value[:-1], value[-1])
+        if not value.isdigit() or int(value) < 1:
+            raise ValueError('Retention rule "%s" needs a positive number'
+                             % part)
+        if kind == 'within':
+            retention.append(RetentionRule(
+                kind, int(value) * _WITHIN_UNITS[unit or 'd']))
+        else:
+            retention.append(RetentionRule(kind, int(value)))
+    return retention
+
+
+def default_retention(max_snapshots, num_weekly=None, num_monthly=None):
+    """The retention policy to keep at most max_snapshots snapshots.
+
+    We keep num_weekly weekly snapshots and num_monthly monthly
+    snapshots (each max_snapshots / 4 if None), and make the rest
+    daily snapshots.
+    """
+    if num_weekly is None:
+        num_weekly = max_snapshots / 4
+    if num_monthly is None:
+        num_monthly = max_snapshots / 4
+    num_daily = max_snapshots - num_weekly - num_monthly
+    if num_daily < 1:
+        raise ValueError('Must keep at least one daily snapshot!'
+                         '  (daily=%s, weekly=%s, monthly=%s)'
+                         % (num_daily, num_weekly, num_monthly))
+    return [RetentionRule(kind, count)
+            for (kind, count) in (('daily', num_daily),
+                                  ('weekly', num_weekly),
+                                  ('monthly', num_monthly))
+            if count > 0]
+
+
+def _format_within(duration):
+    """Format a 'within' timedelta the way parse_retention() takes it."""
+    hours = (duration.days * 24) + (duration.seconds / 3600)
+    if hours % 24 == 0:
+        return '%dd' % (hours / 24)
+    return '%dh' % hours
+
+
+def as_datetime(today):
+    """today as a datetime: midnight, if it's just a date."""
+    if isinstance(today, datetime.datetime):
+        return today
+    return datetime.datetime.combine(today, datetime.time())
+
+
+def _period_number(kind, when):
+    """Number the kind-periods, so when's period is one more than the last.
+
+    e.g. for 'daily', days since the start of the calendar.
+    """
+    if kind == 'hourly':
+        return when.toordinal() * 24 + when.hour
+    elif kind == 'daily':
+        return when.toordinal()
+    elif kind == 'weekly':
+        # Day 7 of the calendar is a Sunday, so weeks start on Sundays.
+        return when.toordinal() / 7
+    elif kind == 'monthly':
+        return when.year * 12 + when.month - 1
+    elif kind == 'yearly':
+        return when.year
+    raise ValueError('Not a period: %s' % kind)
+
+
+def classify_snapshots(snapshots, retention, now, protect_completed=False):
+    """Decide which snapshots to keep, and which to delete, and why.
+
+    This takes one pass over the snapshots, in order of start_time, so
+    it's fast even for years of snapshots.
+
+    Arguments:
+       snapshots: an iterable of Snapshots.
+       retention: the retention policy, a list of RetentionRules.
+       now: the time to apply the policy at, as a datetime in UTC.
+       protect_completed: if True, also keep the newest completed
+         snapshot each rule covers, and the newest completed snapshot
+         overall, in case the snapshots the rules pick failed (or are
+         still pending).
+
+    Returns:
+       (keep, delete): lists of (Snapshot, reason) pairs, oldest first,
+       where reason is a string saying why we keep or delete it.
+    """
+    snapshots = sorted(snapshots, key=lambda snapshot: snapshot.start_time)
+    now_periods = dict((kind, _period_number(kind, now))
+                       for kind in PERIOD_KINDS)
+    # The (kind, period_number)s we've already kept a snapshot for.
+    kept_periods = set()
+    # The newest completed snapshot each rule covers, by kind.
+    newest_completed = {}
+    keep = []
+    delete = []
+    for (i, snapshot) in enumerate(snapshots):
+        if snapshot.start_time > now:
+            # Clock skew, or someone else's snapshot.  Leave it be.
+            keep.append((snapshot, 'newer than now'))
+            continue
+
+        reasons = []
+        in_some_period = False
+        for rule in retention:
+            if rule.kind == 'newest':
+                covered = len(snapshots) - i <= rule.count
+                if covered:
+                    reasons.append('newest=%d' % rule.count)
+            elif rule.kind == 'within':
+                covered = now - snapshot.start_time < rule.count
+                if covered:
+                    reasons.append('within=%s' % _format_within(rule.count))
+            else:
+                period = _period_number(rule.kind, snapshot.start_time)
+                periods_ago = now_periods[rule.kind] - period
+                covered = periods_ago < rule.count
+                if covered:
+                    in_some_period = True
+                    if (rule.kind, period) not in kept_periods:
+                        kept_periods.add((rule.kind, period))
+                        reasons.append('%s #%d' % (rule.kind,
+                                                   periods_ago + 1))
+            if covered and snapshot.state == 'completed':
+                newest_completed[rule.kind] = snapshot
+        if snapshot.state == 'completed':
+            newest_completed[None] = snapshot
+        if reasons:
+            keep.append((snapshot, ', '.join(reasons)))
+        elif in_some_period:
+            delete.append((snapshot, 'an earlier snapshot is kept instead'))
+        else:
+            delete.append((snapshot, 'too old'))
+
+    if protect_completed:
+        protected = {}
+        for (kind, snapshot) in newest_completed.iteritems():
+            protected.setdefault(snapshot, []).append(
+                'newest completed %s' % (kind or 'snapshot'))
+        for (snapshot, reason) in delete[:]:
+            if snapshot in protected:
+                delete.remove((snapshot, reason))
+                keep.append((snapshot, ', '.join(sorted(protected[snapshot]))))
+        keep.sort(key=lambda pair: pair[0].start_time)
+    return (keep, delete)
@@ -0,0 +1,222 @@
+"""An in-memory fake of ec2, for trying out retention policies offline.
+
+This is what simulate-rolling-snapshots.py runs; see it for details.
+"""
+
+import argparse
+import collections
+import datetime
+import itertools
+import sys
+import threading
+import time
+
+from rolling_snapshot.backends import Snapshot
+from rolling_snapshot.retention import (classify_snapshots,
+                                        default_retention, parse_retention)
+from rolling_snapshot.snapshots import (SnapshotDeleter, all_snapshots,
+                                        snapshot_volume,
+                                        snapshots_by_volume)
+
+
+class FakeEc2Backend(object):
+    """An in-memory ec2, with the same interface as the backends.
+
+    Snapshots are created at self.now, and complete immediately.  We
+    count how many times each ec2 API is called, in self.calls.
+    """
+    def __init__(self, now):
+        self.now = now
+        self.snapshots = {}        # snapshot id -> Snapshot
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()     # deletes happen in many threads
+        self._ids = itertools.count()
+
+    def add_snapshot(self, volume, start_time):
+        """Add a snapshot without counting it as an API call."""
+        snapshot_id = 'snap-%08x' % next(self._ids)
+        self.snapshots[snapshot_id] = Snapshot(
+            snapshot_id, volume, start_time, 'completed')
+        return snapshot_id
+
+    def prepare(self, volume):
+        pass
+
+    def describe_volumes_by_tag(self, tag, value):
+        self.calls['DescribeVolumes'] += 1
+        return []
+
+    def describe_snapshots(self, volumes, description):
+        # ec2 returns up to 1000 snapshots per call.
+        self.calls['DescribeSnapshots'] += max(1, len(self.snapshots) / 1000)
+        for snapshot in self.snapshots.values():
+            if snapshot.volume in volumes:
+                yield snapshot
+
+    def create_snapshot(self, volume, description):
+        self.calls['CreateSnapshot'] += 1
+        return (self.add_snapshot(volume, self.now), 'completed')
+
+    def describe_snapshot(self, snapshot_id):
+        self.calls['DescribeSnapshots'] += 1
+        return self.snapshots[snapshot_id]
+
+    def incremental_size(self, base_snapshot_id, snapshot_id):
+        return None
+
+    def delete_snapshot(self, snapshot_id):
+        with self.lock:
+            self.calls['DeleteSnapshot'] += 1
+            del self.snapshots[snapshot_id]
+
+
+class _Quiet(object):
+    """Throw away what the snapshot tool prints, while in a with."""
+    def write(self, s):
+        pass
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = self
+
+    def __exit__(self, *exc_info):
+        sys.stdout = self.stdout
+
+
+def simulate(retention, days, runs_per_day, start):
+    """Run the snapshot tool runs_per_day times a day for days days.
+
+    Returns (ec2, counts): the FakeEc2Backend at the end, and the
+    number of snapshots that existed after each run.
+    """
+    ec2 = FakeEc2Backend(start)
+    # We delete serially: thread pools are slow to start and stop, and
+    # we'd spend all our time doing that.
+    deleter = SnapshotDeleter(ec2, False, jobs=1)
+    interval = datetime.timedelta(days=1) / runs_per_day
+    counts = []
+    for run in xrange(days * runs_per_day):
+        ec2.now = start + run * interval
+        snapshots = all_snapshots(['vol-simulated'], 'simulated', ec2)
+        with _Quiet():
+            snapshot_volume('vol-simulated', snapshots, 'simulated',
+                            retention, None, ec2, False, deleter=deleter,
+                            today=ec2.now)
+        counts.append(len(ec2.snapshots))
+    return (ec2, counts)
+
+
+def report_simulation(retention, days, runs_per_day, start):
+    (ec2, counts) = simulate(retention, days, runs_per_day, start)
+    times = sorted(s.start_time for s in ec2.snapshots.values())
+    gaps = [later - earlier for (earlier, later) in zip(times, times[1:])]
+
+    print 'After %d days of %d run(s) a day:' % (days, runs_per_day)
+    print '  Snapshots: %d (at most %d; over the last 30 days, %d-%d)' % (
+        counts[-1], max(counts), min(counts[-30 * runs_per_day:]),
+        max(counts[-30 * runs_per_day:]))
+    print '  Oldest snapshot: %s old' % (ec2.now - times[0])
+    if gaps:
+        print '  Biggest gap between snapshots: %s' % max(gaps)
+    # How close can we get to restoring the volume as it was N days ago?
+    print '  Restoring to N days ago gets you a snapshot from:'
+    for lookback in (1, 7, 30, 90, 365, 3 * 365):
+        wanted = ec2.now - datetime.timedelta(lookback)
+        older = [t for t in times if t <= wanted]
+        if older:
+            print '    %4d days ago: %s earlier' % (lookback,
+                                                    wanted - older[-1])
+        else:
+            print '    %4d days ago: (nothing that old)' % lookback
+    print '  ec2 API calls a day:'
+    for (api, calls) in sorted(ec2.calls.iteritems()):
+        print '    %s: %.2f' % (api, calls / float(days))
+
+
+def benchmark(retention, num_snapshots, delete_jobs, start):
+    """Time listing, classifying and deleting num_snapshots snapshots.
+
+    The snapshots are taken hourly, going back from start.
+    """
+    ec2 = FakeEc2Backend(start)
+    for i in xrange(num_snapshots):
+        ec2.add_snapshot('vol-benchmark',
+                         start - datetime.timedelta(hours=i + 1))
+
+    t = time.time()
+    snapshots = snapshots_by_volume(
+        all_snapshots(['vol-benchmark'], 'benchmark', ec2),
+        ['vol-benchmark'])['vol-benchmark']
+    list_time = time.time() - t
+
+    t = time.time()
+    (keep, delete) = classify_snapshots(snapshots, retention, start)
+    classify_time = time.time() - t
+
+    deleter = SnapshotDeleter(ec2, False, delete_jobs)
+    t = time.time()
+    with _Quiet():
+        summary = deleter.delete_all((s for (s, _) in delete),
+                                     'vol-benchmark')
+    delete_time = time.time() - t
+    if summary.failed or len(ec2.snapshots) != len(keep):
+        raise RuntimeError('Deleted the wrong snapshots!')
+
+    print '%9d snapshots: list %7.2fs  classify %7.2fs  delete %7.2fs' % (
+        num_snapshots, list_time, classify_time, delete_time)
+
+
+def main(argv=None):
+    """Run the simulator with the arguments argv (sys.argv[1:] by
+    default)."""
+    parser = argparse.ArgumentParser(
+        description=('Simulate or benchmark ec2-create-rolling-snapshot.py'
+                     ' retention policies, without talking to ec2.'))
+    parser.add_argument('--max_snapshots', '-m', type=int,
+                        help=('Simulate ec2-create-rolling-snapshot.py'
+                              ' with this --max_snapshots'))
+    parser.add_argument('--max-weekly-snapshots', type=int,
+                        help='As for ec2-create-rolling-snapshot.py')
+    parser.add_argument('--max-monthly-snapshots', type=int,
+                        help='As for ec2-create-rolling-snapshot.py')
+    parser.add_argument('--retention',
+                        help=('Simulate ec2-create-rolling-snapshot.py'
+                              ' with this --retention'))
+    parser.add_argument('--days', type=int, default=2 * 365,
+                        help=('How many days to simulate.  Default is'
+                              ' %(default)s'))
+    parser.add_argument('--runs-per-day', type=int, default=1,
+                        help=('How often the snapshot tool runs.  Default'
+                              ' is %(default)s'))
+    parser.add_argument('--benchmark', metavar='N[,N...]',
+                        help=('Instead of simulating, time the retention'
+                              ' code on this many snapshots, e.g.'
+                              ' 10000,100000,1000000'))
+    parser.add_argument('--delete-jobs', type=int, default=4,
+                        help=('As for ec2-create-rolling-snapshot.py.'
+                              '  Default is %(default)s'))
+
+    args = parser.parse_args(argv)
+    if (args.max_snapshots is None) == (args.retention is None):
+        parser.error('Must specify exactly one of --max_snapshots and'
+                     ' --retention')
+    if args.days < 1 or args.runs_per_day < 1:
+        parser.error('--days and --runs-per-day must be at least 1')
+    try:
+        if args.retention:
+            retention = parse_retention(args.retention)
+        else:
+            retention = default_retention(
+                args.max_snapshots, args.max_weekly_snapshots,
+                args.max_monthly_snapshots)
+        sizes = [int(n) for n in (args.benchmark or '').split(',') if n]
+    except ValueError as why:
+        parser.error(str(why))
+
+    # A fixed time, so runs are repeatable.  It's 3am on a Wednesday.
+    start = datetime.datetime(2014, 1, 1, 3, 0)
+    if sizes:
+        for num_snapshots in sizes:
+            benchmark(retention, num_snapshots, args.delete_jobs, start)
+    else:
+        report_simulation(retention, args.days, args.runs_per_day, start)
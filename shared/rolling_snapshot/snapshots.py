@@ -0,0 +1,552 @@
+"""Snapshotting volumes: creating new snapshots and pruning old ones."""
+
+import collections
+import contextlib
+import datetime
+import itertools
+import random
+import subprocess
+import threading
+import time
+import traceback
+
+from rolling_snapshot.backends import (Snapshot, TransientError,
+                                       UndeletableSnapshotError)
+from rolling_snapshot.retention import as_datetime, classify_snapshots
+
+
+# How many seconds --wait-for-completion sleeps between checking on a new
+# snapshot.  The delay doubles every time, up to the maximum.
+COMPLETION_MIN_DELAY = 15
+COMPLETION_MAX_DELAY = 300
+
+# A volume to snapshot, and the retention policy for its snapshots: a
+# list of RetentionRules.
+VolumeSpec = collections.namedtuple('VolumeSpec', ('volume', 'retention'))
+
+
+def _thread_pool(size):
+    """Return a ThreadPool of size threads.
+
+    multiprocessing takes a while to import, so we only import it when
+    we need a pool; a dry run of a single volume never does.
+    """
+    import multiprocessing.pool
+    return multiprocessing.pool.ThreadPool(size)
+
+
+def all_snapshots(volumes, description, ec2, catalog=None):
+    """Yield a Snapshot for all snapshots of volumes matching description.
+
+    The snapshots of all the volumes are listed at once, lazily.  If
+    catalog (a catalog.Catalog) is given they come from it instead of
+    from ec2, so it should have been synced first.
+    """
+    if catalog:
+        snapshots = catalog.snapshots(volumes, description)
+    else:
+        snapshots = ec2.describe_snapshots(frozenset(volumes), description)
+    for snapshot in snapshots:
+        yield snapshot
+
+
+def snapshots_by_volume(snapshots, volumes):
+    """Map each of volumes to a list of its Snapshots."""
+    retval = dict((volume, []) for volume in volumes)
+    for snapshot in snapshots:
+        retval[snapshot.volume].append(snapshot)
+    return retval
+
+
+@contextlib.contextmanager
+def frozen(freezedir, timeout):
+    """Hold fsfreeze on freezedir, for at most timeout seconds.
+
+    The disk is thawed when the with-block exits.  If it doesn't exit
+    within timeout seconds, or if this process dies while the disk is
+    frozen, a watchdog process thaws the disk anyway.
+    """
+    # The watchdog is started before freezing so that starting it
+    # doesn't count against the freeze.  Once it reads 'go' it waits
+    # for 'done'; if it gets EOF (we died) or times out, it thaws.
+    watchdog = subprocess.Popen(
+        ['sudo', '/bin/bash', '-c',
+         'read go || exit 0; read -t %d done || /sbin/fsfreeze -u "$0"'
+         % timeout,
+         freezedir],
+        stdin=subprocess.PIPE)
+    try:
+        subprocess.check_call(['sudo', '/sbin/fsfreeze', '-f', freezedir])
+    except:
+        watchdog.stdin.close()
+        watchdog.wait()
+        raise
+
+    freeze_start = time.time()
+    try:
+        watchdog.stdin.write('go\n')
+        watchdog.stdin.flush()
+        yield
+    finally:
+        thawed = (subprocess.call(['sudo', '/sbin/fsfreeze', '-u',
+                                   freezedir]) == 0)
+        try:
+            if thawed:
+                watchdog.stdin.write('done\n')
+            # If we couldn't thaw the disk, closing stdin without saying
+            # 'done' makes the watchdog try too.
+            watchdog.stdin.close()
+        except IOError:       # the watchdog has already exited
+            pass
+        watchdog.wait()
+        # If we took too long the watchdog will already have thawed it.
+        if not thawed and time.time() - freeze_start < timeout:
+            raise RuntimeError('Could not thaw %s' % freezedir)
+
+
+def create_snapshot(volume, description, freezedir, ec2, dry_run,
+                    freeze_timeout=60, metrics=None):
+    """Return the snapshot-id of the new snapshot (None on a dry run).
+
+    If metrics (an ops_metrics.Metrics) is given, we record how long
+    freezedir was frozen in it.
+    """
+    if dry_run:
+        print '[DRY RUN] Created snap-TBD for %s' % volume
+        return None
+
+    # Do everything slow before freezing, so the freeze only has to
+    # cover the create-snapshot call itself.
+    ec2.prepare(volume)
+    # At the very least, sync to try to make the disk consistent.  This
+    # also makes the fsfreeze faster, since it has less to flush.
+    subprocess.call(['/bin/sync'])    # best-effort
+
+    if freezedir:
+        freeze_start = time.time()
+        with frozen(freezedir, freeze_timeout):
+            (snapshot_id, state) = ec2.create_snapshot(volume, description)
+        freeze_time = time.time() - freeze_start
+        print 'Held fsfreeze on %s for %.3f seconds' % (freezedir,
+                                                        freeze_time)
+        if metrics:
+            metrics.observe('freeze', freeze_time, volume=volume,
+                            freezedir=freezedir)
+        if freeze_time >= freeze_timeout:
+            raise RuntimeError('Creating %s took longer than the %s second'
+                               ' freeze timeout, so it may not be consistent'
+                               % (snapshot_id, freeze_timeout))
+    else:
+        (snapshot_id, state) = ec2.create_snapshot(volume, description)
+
+    if state not in ('pending', 'completed'):
+        raise RuntimeError('Snapshot state not pending or completed:'
+                           ' %s is "%s"' % (snapshot_id, state))
+    print 'Created %s from %s' % (snapshot_id, volume)
+    return snapshot_id
+
+
+def wait_for_completion(snapshot_id, ec2, timeout):
+    """Wait for a new snapshot to complete, and return how long it took.
+
+    We check on it with exponential backoff.  If it ends up in any state
+    but completed, or is still pending after timeout seconds, we raise
+    RuntimeError.
+    """
+    start = time.time()
+    delay = COMPLETION_MIN_DELAY
+    while True:
+        state = ec2.describe_snapshot(snapshot_id).state
+        elapsed = time.time() - start
+        if state == 'completed':
+            return elapsed
+        if state != 'pending':
+            raise RuntimeError('Snapshot %s is "%s", not completed'
+                               % (snapshot_id, state))
+        if elapsed >= timeout:
+            raise RuntimeError('Snapshot %s is still pending after %d'
+                               ' seconds' % (snapshot_id, elapsed))
+        time.sleep(min(delay, timeout - elapsed))
+        delay = min(delay * 2, COMPLETION_MAX_DELAY)
+
+
+def _format_size(num_bytes):
+    for unit in ('bytes', 'KiB', 'MiB', 'GiB'):
+        if num_bytes < 1024:
+            return '%.1f %s' % (num_bytes, unit)
+        num_bytes /= 1024.0
+    return '%.1f TiB' % num_bytes
+
+
+def report_completion(volume, snapshot_id, snapshots, seconds, ec2,
+                      metrics=None):
+    """Say how long snapshot_id took to complete, and how much it added.
+
+    snapshots is a list of the volume's other Snapshots: what it added
+    is relative to the newest completed one.
+    """
+    print 'Snapshot %s completed after %d seconds' % (snapshot_id, seconds)
+    if metrics:
+        metrics.observe('completion', seconds, volume=volume)
+
+    completed = [s for s in snapshots if s.state == 'completed']
+    if not completed:
+        return
+    base = max(completed, key=lambda snapshot: snapshot.start_time)
+    num_bytes = ec2.incremental_size(base.id, snapshot_id)
+    if num_bytes is None:
+        return
+    print 'Snapshot %s changed %s since %s' % (snapshot_id,
+                                                _format_size(num_bytes), base)
+    if metrics:
+        metrics.set('incremental_bytes', num_bytes, volume=volume)
+
+
+def delete_snapshot(snapshot, ec2, dry_run):
+    if dry_run:
+        print '[DRY RUN] Deleting %s' % (snapshot,)
+        return
+
+    ec2.delete_snapshot(snapshot.id)
+    print 'Deleted %s' % (snapshot,)
+
+
+class TokenBucket(object):
+    """Rate-limits requests, to stay under ec2's API throttling.
+
+    Tokens trickle in at rate per second, up to a maximum of burst.
+    Each request takes a token, waiting for one if there are none.  A
+    single TokenBucket can be shared by many threads.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.last_refill = time.time()
+        self.lock = threading.Lock()
+
+    def take(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# What happened to the snapshots we tried to delete: lists of Snapshots.
+DeletionSummary = collections.namedtuple('DeletionSummary',
+                                         ('deleted', 'skipped', 'failed'))
+
+
+class SnapshotDeleter(object):
+    """Deletes snapshots concurrently, rate-limited and with retries."""
+    def __init__(self, ec2, dry_run, jobs=4, rate_limiter=None,
+                 max_retries=5, metrics=None, catalog=None):
+        """Arguments:
+            ec2: the backend used to talk to ec2.
+            dry_run: if True, just say what we'd delete.
+            jobs: how many snapshots to delete at the same time.
+            rate_limiter: a TokenBucket limiting how fast we delete
+              snapshots, or None for no limit.  It can be shared by
+              many SnapshotDeleters.
+            max_retries: how many times to retry a delete that failed
+              for a transient reason (such as being throttled).
+            metrics: if not None, an ops_metrics.Metrics to count
+              retries and deleted snapshots in.
+            catalog: if not None, a catalog.Catalog to forget the
+              snapshots we delete in.
+        """
+        self.ec2 = ec2
+        self.dry_run = dry_run
+        self.jobs = jobs
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.metrics = metrics
+        self.catalog = catalog
+
+    def _delete_one(self, snapshot):
+        """Return 'deleted', 'skipped' or 'failed'."""
+        for attempt in xrange(self.max_retries + 1):
+            # A dry run doesn't call ec2, so there's nothing to limit.
+            if self.rate_limiter and not self.dry_run:
+                self.rate_limiter.take()
+            try:
+                delete_snapshot(snapshot, self.ec2, self.dry_run)
+                if self.catalog and not self.dry_run:
+                    self.catalog.forget(snapshot.id)
+                return 'deleted'
+            except TransientError as why:
+                if attempt == self.max_retries:
+                    print 'Could not delete %s: %s' % (snapshot, why)
+                    return 'failed'
+                if self.metrics:
+                    self.metrics.count('retries',
+                                       operation='delete_snapshot')
+                # Exponential backoff, with jitter so that our threads
+                # don't all retry at once.
+                time.sleep(min(2 ** attempt, 30) * random.uniform(1, 1.5))
+            except UndeletableSnapshotError as why:
+                print 'Skipping %s: %s' % (snapshot, why)
+                # We still want to delete one an AMI is using, once it
+                # isn't, but one that's gone will never come back.
+                if why.gone and self.catalog:
+                    self.catalog.forget(snapshot.id)
+                return 'skipped'
+            except Exception as why:
+                print 'Could not delete %s: %s' % (snapshot, why)
+                return 'failed'
+
+    def delete_all(self, snapshots, label):
+        """Delete all of snapshots, an iterable of Snapshots.
+
+        label is used to describe the snapshots in the summary we
+        print.  Returns a DeletionSummary.
+        """
+        summary = DeletionSummary([], [], [])
+        if self.dry_run or self.jobs == 1:
+            # Serially: on a dry run, so we say what we'd delete in a
+            # predictable order.
+            results = ((snapshot, self._delete_one(snapshot))
+                       for snapshot in snapshots)
+            self._tally(results, summary)
+        else:
+            pool = _thread_pool(self.jobs)
+            try:
+                self._tally(pool.imap_unordered(
+                    lambda snapshot: (snapshot, self._delete_one(snapshot)),
+                    snapshots),
+                    summary)
+            finally:
+                pool.close()
+                pool.join()
+
+        if self.metrics and not self.dry_run:
+            for (result, snapshots) in summary._asdict().iteritems():
+                self.metrics.count('snapshots_' + result, len(snapshots))
+
+        if self.dry_run:
+            print ('[DRY RUN] Would delete %d old snapshots of %s'
+                   % (len(summary.deleted), label))
+            return summary
+
+        print ('Deleted %d, skipped %d, failed to delete %d old snapshots'
+               ' of %s' % (len(summary.deleted), len(summary.skipped),
+                           len(summary.failed), label))
+        return summary
+
+    @staticmethod
+    def _tally(results, summary):
+        for (snapshot, result) in results:
+            getattr(summary, result).append(snapshot)
+
+
+def delete_old_snapshots(all_snapshots, retention, today, ec2, dry_run,
+                         deleter=None, label='the volume',
+                         protect_completed=False, new_snapshot=None):
+    """Delete the snapshots we shouldn't keep, and return a DeletionSummary.
+
+    all_snapshots is an iterable of Snapshots, and retention a list of
+    RetentionRules to apply at today (a datetime.date or
+    datetime.datetime, in UTC).  deleter is the SnapshotDeleter to use;
+    by default we make one with default settings.  label describes the
+    snapshots in the summary we print.  protect_completed is passed to
+    classify_snapshots().
+
+    new_snapshot, if given, is the Snapshot we just made, which is not
+    in all_snapshots.  It is classified with them, so that newest=N
+    leaves N snapshots in all, but it is never deleted.
+    """
+    if deleter is None:
+        deleter = SnapshotDeleter(ec2, dry_run)
+    if new_snapshot:
+        all_snapshots = itertools.chain(all_snapshots, [new_snapshot])
+    (keep, delete) = classify_snapshots(all_snapshots, retention,
+                                        as_datetime(today),
+                                        protect_completed)
+    if new_snapshot:
+        for (snapshot, reason) in delete:
+            if snapshot == new_snapshot:
+                delete.remove((snapshot, reason))
+                keep.append((snapshot, 'just made'))
+                break
+    if dry_run:
+        for (snapshot, reason) in keep:
+            print '[DRY RUN] Keeping %s: %s' % (snapshot, reason)
+    return deleter.delete_all((snapshot for (snapshot, _) in delete), label)
+
+
+def snapshot_volume(volume, snapshots, description, retention, freezedir,
+                    ec2, dry_run, freeze_timeout=60, metrics=None,
+                    deleter=None, today=None, completion_timeout=None,
+                    catalog=None):
+    """Snapshot one volume, then delete its 'old' snapshots.
+
+    snapshots is an iterable of the existing Snapshots of the volume.
+    It is not consumed until the new snapshot has been created.  See
+    snapshot_volumes() for the other arguments.
+    """
+    if today is None:
+        today = datetime.datetime.utcnow()
+    new_snapshot_id = create_snapshot(volume, description, freezedir, ec2,
+                                      dry_run, freeze_timeout, metrics)
+    # On a dry run, the one we pretended to make.  It's classified as
+    # made at today either way, so a dry run decides like a real one.
+    new_snapshot = Snapshot(new_snapshot_id or 'snapshot-TBD', volume,
+                            as_datetime(today), 'pending')
+    if catalog and new_snapshot_id:
+        catalog.record(Snapshot(new_snapshot_id, volume,
+                                datetime.datetime.utcnow(), 'pending'),
+                       description)
+    # If we list snapshots lazily, the new one may show up; we add it to
+    # the others ourselves.
+    snapshots = (s for s in snapshots if s.id != new_snapshot_id)
+    if completion_timeout is not None and not dry_run:
+        # Nothing gets deleted unless this succeeds.
+        seconds = wait_for_completion(new_snapshot_id, ec2,
+                                      completion_timeout)
+        described = ec2.describe_snapshot(new_snapshot_id)
+        if catalog:
+            catalog.record(described, description)
+        new_snapshot = new_snapshot._replace(state=described.state)
+        snapshots = list(snapshots)
+        report_completion(volume, new_snapshot_id, snapshots, seconds, ec2,
+                          metrics)
+    summary = delete_old_snapshots(snapshots, retention, today, ec2, dry_run,
+                                   deleter, volume,
+                                   completion_timeout is not None,
+                                   new_snapshot)
+    if summary.failed:
+        raise RuntimeError('Could not delete %s'
+                           % ', '.join(str(s) for s in summary.failed))
+
+
+def snapshot_volumes(volume_specs, description, freezedir, ec2, dry_run,
+                     jobs=4, freeze_timeout=60, metrics=None, delete_jobs=4,
+                     delete_rate=5, today=None, completion_timeout=None,
+                     catalog=None, catalog_resync=False):
+    """Delete 'old' snapshots matching 'description' on the given volumes.
+
+    NOTE: the ec2-* binaries must be on $PATH if ec2 is a CliBackend!
+
+    Arguments:
+        volume_specs: a list of VolumeSpecs, one for each ec2 EBS volume
+          to snapshot.  A VolumeSpec says how many snapshots to keep,
+          as a list of RetentionRules (see default_retention() and
+          parse_retention()).
+        description: used as the snapshot description.  All snapshots
+          sharing the same description (and volume) are part of a
+          'snapshot series'.
+        freezedir: if not None, call fsfreeze on this directory while
+          snapshotting.  This causes the disk to be frozen for writes,
+          yielding a more-likely-consistent snapshot.  Only the
+          create-snapshot call itself is made while the disk is frozen.
+          This only makes sense when snapshotting a single volume.
+        ec2: the backend used to talk to ec2: a CliBackend or a
+          SdkBackend.
+        dry_run: if True, just say what we'd do, but don't do it.
+        jobs: how many volumes to snapshot at the same time.
+        freeze_timeout: never keep freezedir frozen for longer than this
+          many seconds.  If creating the snapshot takes longer, the disk
+          is thawed anyway and we raise an exception.
+        metrics: if not None, an ops_metrics.Metrics to record how long
+          each step (listing, freezing, and every ec2 call) took in,
+          and to count retries and deleted snapshots in.  It's up to
+          the caller to write it out.
+        delete_jobs: how many snapshots to delete at the same time, for
+          each volume.
+        delete_rate: the most snapshots to delete per second, across all
+          volumes.  Deletes that ec2 throttles anyway are retried.
+        today: the time we start calculating snapshots to keep, from.
+          It should be a datetime.datetime (or datetime.date, meaning
+          midnight) in UTC.  Default is now.
+        completion_timeout: if not None, wait (for at most this many
+          seconds) for each new snapshot to complete before deleting
+          any old ones, and never delete the newest completed snapshot
+          that a retention rule covers.  If the new snapshot fails, or
+          doesn't complete in time, nothing is deleted and the volume
+          counts as failed.
+        catalog: if not None, a catalog.Catalog to take the existing
+          snapshots from, after syncing it with ec2, instead of listing
+          them all.  The snapshots we create and delete are recorded in
+          it.
+        catalog_resync: if True, relist every volume's snapshots from
+          ec2 into catalog, rather than only the stale ones.
+
+    Returns:
+        The list of volumes that we failed to snapshot (or prune).  The
+        reason for each failure has already been printed.
+    """
+    if today is None:
+        today = datetime.datetime.utcnow()
+    if freezedir and len(volume_specs) != 1:
+        raise ValueError('Can only use freezedir with a single volume,'
+                         ' not %s' % [spec.volume for spec in volume_specs])
+
+    if metrics:
+        import ops_metrics
+        ec2 = ops_metrics.Instrumented(ec2, metrics)
+
+    volumes = [spec.volume for spec in volume_specs]
+    if catalog:
+        if metrics:
+            with metrics.timer('catalog_sync'):
+                catalog.sync(volumes, description, ec2, catalog_resync)
+        else:
+            catalog.sync(volumes, description, ec2, catalog_resync)
+
+    if len(volumes) == 1:
+        # No need to bucket anything: we can stream the listing.
+        snapshots = {volumes[0]: all_snapshots(volumes, description, ec2,
+                                               catalog)}
+    else:
+        snapshots = snapshots_by_volume(
+            all_snapshots(volumes, description, ec2, catalog),
+            volumes)
+
+    # ec2 throttles us per-account, so all volumes share a rate limit.
+    deleter = SnapshotDeleter(ec2, dry_run, delete_jobs,
+                              TokenBucket(delete_rate), metrics=metrics,
+                              catalog=catalog)
+
+    def snapshot_one(spec):
+        start = time.time()
+        try:
+            snapshot_volume(spec.volume, snapshots[spec.volume], description,
+                            spec.retention, freezedir, ec2, dry_run,
+                            freeze_timeout, metrics, deleter, today,
+                            completion_timeout, catalog)
+            error = None
+        except Exception:
+            error = traceback.format_exc()
+        if metrics:
+            metrics.observe('volume', time.time() - start, not error,
+                            volume=spec.volume)
+        return error
+
+    if len(volume_specs) == 1 or jobs == 1:
+        errors = map(snapshot_one, volume_specs)
+    else:
+        pool = _thread_pool(min(jobs, len(volume_specs)))
+        try:
+            errors = pool.map(snapshot_one, volume_specs)
+        finally:
+            pool.close()
+            pool.join()
+
+    failed = []
+    for (spec, error) in zip(volume_specs, errors):
+        if error:
+            print 'FAILED %s:\n%s' % (spec.volume, error)
+            failed.append(spec.volume)
+        else:
+            print 'OK %s' % spec.volume
+    if metrics and not dry_run:
+        metrics.set('failed_volumes', len(failed))
+        metrics.set('last_run_timestamp_seconds', time.time())
+    return failed
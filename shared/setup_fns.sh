@@ -195,6 +195,9 @@ install_root_config_files() {
     # We also install all the shared files from ../shared/.
     # SHARED_EXCLUDE_FILES is (optionally) defined in a config-dir's setup.sh
     _install_root_config_files "`dirname $CONFIG_DIR`/shared" "$SHARED_FILE_EXCLUDES"
+    # shared/etc/init/host-health-agent.conf replaced these cron jobs.
+    sudo rm -f /etc/cron.d/oom-detector /etc/cron.hourly/check-diskspace
+    start_shared_daemons
 
     # Something makes /etc group-writable sometimes, which ssh doesn't
     # like.  Let's fix that.
@@ -475,3 +478,15 @@ start_daemons() {
         done
     fi
 }
+
+start_shared_daemons() {
+    # Like start_daemons, for the daemons every machine runs, except
+    # those excluded by SHARED_FILE_EXCLUDES.
+    echo "Starting daemons in `dirname $CONFIG_DIR`/shared/etc/init"
+    for daemon in "`dirname $CONFIG_DIR`"/shared/etc/init/*.conf; do
+        echo " $SHARED_FILE_EXCLUDES " \
+            | grep -q " /etc/init/`basename $daemon` " && continue
+        sudo stop `basename $daemon .conf` || true
+        sudo start `basename $daemon .conf`
+    done
+}
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+
+"""Try out ec2-create-rolling-snapshot.py's retention policies offline.
+
+This runs the real snapshot tool against an in-memory fake of ec2, so
+nothing here talks to AWS.  It has two modes:
+
+Simulate: replay some number of days of running the snapshot tool
+(from cron, say, once a day), and report what snapshots survive: how
+many there are in the steady state, how far back they go, how big the
+gaps between them are, and how many ec2 API calls a day it all costs.
+Use this before changing --max_snapshots or --retention, e.g.
+    simulate-rolling-snapshots.py -m 20 --days 1000
+    simulate-rolling-snapshots.py --retention=daily=7,monthly=12,yearly=5
+
+Benchmark (--benchmark): time listing, classifying and deleting large
+numbers of synthetic snapshots, to catch performance regressions in the
+retention code, e.g.
+    simulate-rolling-snapshots.py --retention=daily=30 \\
+        --benchmark=10000,100000,1000000
+"""
+
+import rolling_snapshot.simulator
+
+
+if __name__ == '__main__':
+    rolling_snapshot.simulator.main()